@@ -17,6 +17,7 @@ from jet.admin import CompactInline
 from websecmap.app.admin import generate_game_user
 from websecmap.app.models import GameUser
 from websecmap.game.models import Contest, OrganizationSubmission, Team, UrlSubmission
+from websecmap.game.scores import recalculate_contest_scores
 from websecmap.organizations.models import Coordinate, Organization, OrganizationType, Url
 from websecmap.scanners.scanner.http import resolves
 
@@ -128,6 +129,15 @@ class ContestAdmin(ImportExportModelAdmin, admin.ModelAdmin):
     add_a_dozen_teams.short_description = "Add 12 teams"
     actions.append("add_a_dozen_teams")
 
+    def recalculate_scores(self, request, queryset):
+        for contest in queryset:
+            recalculate_contest_scores(contest.pk)
+
+        self.message_user(request, "Scores have been recalculated.")
+
+    recalculate_scores.short_description = "Recalculate scores"
+    actions.append("recalculate_scores")
+
     # todo: generate a printout for teams and this contest, to hand out.
     def show_printout(self, request, queryset):
         for contest in queryset:
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class GameConfig(AppConfig):
     name = "websecmap.game"
+
+    def ready(self):
+        import websecmap.game.signals  # noqa
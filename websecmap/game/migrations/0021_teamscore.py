@@ -0,0 +1,50 @@
+# Generated by Django 3.1.6 on 2026-10-18 21:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0020_auto_20181207_1951"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TeamScore",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "high",
+                    models.PositiveIntegerField(default=0, help_text="High risk issues on accepted urls of this team."),
+                ),
+                (
+                    "medium",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Medium risk issues on accepted urls of this team."
+                    ),
+                ),
+                (
+                    "low",
+                    models.PositiveIntegerField(default=0, help_text="Low risk issues on accepted urls of this team."),
+                ),
+                ("added_urls", models.PositiveIntegerField(default=0)),
+                ("added_organizations", models.PositiveIntegerField(default=0)),
+                ("rejected_urls", models.PositiveIntegerField(default=0)),
+                ("rejected_organizations", models.PositiveIntegerField(default=0)),
+                ("total_score", models.IntegerField(db_index=True, default=0)),
+                ("at_when", models.DateTimeField(blank=True, help_text="When this score was last changed.", null=True)),
+                (
+                    "team",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="score", to="game.team"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "team score",
+                "verbose_name_plural": "team scores",
+            },
+        ),
+    ]
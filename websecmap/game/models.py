@@ -223,3 +223,32 @@ class UrlSubmission(models.Model):
     class Meta:
         verbose_name = _("url submission")
         verbose_name_plural = _("url submissions")
+
+
+class TeamScore(models.Model):
+    """
+    The score of a team, kept up to date so the scoreboard does not have to go through all scans of a contest.
+    See websecmap.game.scores for how the score is calculated and maintained.
+    """
+
+    team = models.OneToOneField(Team, on_delete=models.CASCADE, related_name="score")
+
+    high = models.PositiveIntegerField(default=0, help_text="High risk issues on accepted urls of this team.")
+    medium = models.PositiveIntegerField(default=0, help_text="Medium risk issues on accepted urls of this team.")
+    low = models.PositiveIntegerField(default=0, help_text="Low risk issues on accepted urls of this team.")
+
+    added_urls = models.PositiveIntegerField(default=0)
+    added_organizations = models.PositiveIntegerField(default=0)
+    rejected_urls = models.PositiveIntegerField(default=0)
+    rejected_organizations = models.PositiveIntegerField(default=0)
+
+    total_score = models.IntegerField(default=0, db_index=True)
+
+    at_when = models.DateTimeField(blank=True, null=True, help_text="When this score was last changed.")
+
+    def __str__(self):
+        return f"{self.team}: {self.total_score}"
+
+    class Meta:
+        verbose_name = _("team score")
+        verbose_name_plural = _("team scores")
@@ -0,0 +1,203 @@
+"""
+Scores of the teams in a contest.
+
+A team scores points for every issue found on the urls it submitted and for every accepted url and organization.
+Rejected submissions cost points. Issues are counted for all scans on the accepted urls, up to the end of the contest.
+
+Going through all scans of all teams is slow, so the score of every team is stored in a TeamScore. New scans are
+added to the scores of the teams that submitted their url, see add_scans_to_team_scores. Scans are stored all the time,
+so this is skipped when no contest is running. Scores are recalculated when submissions, teams or contests are saved
+or deleted, see signals. Use recalculate_team_scores when scores are out of sync, for example after deleting scans.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+from time import monotonic
+from typing import Dict, List, Type, Union
+
+import pytz
+from django.db import transaction
+from django.db.models import Count, F, Max, Q
+
+from websecmap.game.models import Contest, OrganizationSubmission, Team, TeamScore, UrlSubmission
+from websecmap.reporting.severity import get_severities
+from websecmap.scanners import ENDPOINT_SCAN_TYPES, URL_SCAN_TYPES
+from websecmap.scanners.models import EndpointGenericScan, UrlGenericScan
+
+log = logging.getLogger(__package__)
+
+SCORE_MULTIPLIER = {
+    "low": 100,
+    "medium": 250,
+    "high": 1000,
+    "rejected_organization": 1337,
+    "rejected_url": 1337,
+    "organization": 500,
+    "url": 250,
+}
+
+# scan model: the path from the scan to the url submissions, the path from the submission to the subject of the scan,
+# the subject of the scan and the scan types that count.
+SCORED_SCANS = {
+    EndpointGenericScan: (
+        "endpoint__url__urlsubmission",
+        "url_in_system__endpoint",
+        "endpoint_id",
+        ENDPOINT_SCAN_TYPES,
+    ),
+    UrlGenericScan: ("url__urlsubmission", "url_in_system", "url_id", URL_SCAN_TYPES),
+}
+
+# Whether a contest is running is checked once per this amount of seconds per process. Changing a contest in this
+# process is seen directly, see forget_running_contests.
+CONTEST_CHECK_INTERVAL = 60
+
+# the moment of the last check, and the end of the contest that ends last.
+running_contests = {"checked": None, "until": None}
+
+
+def empty_score() -> Dict[str, int]:
+    return {
+        "high": 0,
+        "medium": 0,
+        "low": 0,
+        "added_urls": 0,
+        "added_organizations": 0,
+        "rejected_urls": 0,
+        "rejected_organizations": 0,
+    }
+
+
+def total_score(score) -> int:
+    return (
+        score["high"] * SCORE_MULTIPLIER["high"]
+        + score["medium"] * SCORE_MULTIPLIER["medium"]
+        + score["low"] * SCORE_MULTIPLIER["low"]
+        + score["added_organizations"] * SCORE_MULTIPLIER["organization"]
+        + score["added_urls"] * SCORE_MULTIPLIER["url"]
+        - (
+            score["rejected_urls"] * SCORE_MULTIPLIER["rejected_url"]
+            + score["rejected_organizations"] * SCORE_MULTIPLIER["rejected_organization"]
+        )
+    )
+
+
+def recalculate_team_scores(teams: List[int]):
+    """Calculates the score of teams from all their submissions and all scans on their accepted urls."""
+    scores = {team: empty_score() for team in teams}
+
+    for model, (submission, _, _, scan_types) in SCORED_SCANS.items():
+        # One row per accepted submission of a url: a url that is submitted by several teams counts for all of them.
+        scans = list(
+            model.objects.all()
+            .filter(
+                **{
+                    f"{submission}__added_by_team__in": teams,
+                    f"{submission}__has_been_accepted": True,
+                    "rating_determined_on__lte": F(
+                        f"{submission}__added_by_team__participating_in_contest__until_moment"
+                    ),
+                },
+                type__in=scan_types,
+            )
+            .annotate(team=F(f"{submission}__added_by_team"))
+        )
+
+        for scan, severity in zip(scans, get_severities(scans)):
+            for level in ["high", "medium", "low"]:
+                scores[scan.team][level] += severity[level]
+
+    for model, kind in [(UrlSubmission, "urls"), (OrganizationSubmission, "organizations")]:
+        submissions = (
+            model.objects.all()
+            .filter(added_by_team__in=teams)
+            .values("added_by_team")
+            .annotate(
+                added=Count("id", filter=Q(has_been_accepted=True, has_been_rejected=False)),
+                rejected=Count("id", filter=Q(has_been_accepted=False, has_been_rejected=True)),
+            )
+            .order_by()
+        )
+        for submission in submissions:
+            scores[submission["added_by_team"]][f"added_{kind}"] = submission["added"]
+            scores[submission["added_by_team"]][f"rejected_{kind}"] = submission["rejected"]
+
+    now = datetime.now(pytz.utc)
+    with transaction.atomic():
+        for team, score in scores.items():
+            TeamScore.objects.update_or_create(
+                team_id=team, defaults={**score, "total_score": total_score(score), "at_when": now}
+            )
+
+
+def recalculate_contest_scores(contest: int):
+    recalculate_team_scores(
+        list(Team.objects.all().filter(participating_in_contest=contest).values_list("id", flat=True))
+    )
+
+
+def contest_is_running() -> bool:
+    if running_contests["checked"] is None or monotonic() - running_contests["checked"] >= CONTEST_CHECK_INTERVAL:
+        running_contests["until"] = Contest.objects.all().aggregate(until=Max("until_moment"))["until"]
+        running_contests["checked"] = monotonic()
+
+    return running_contests["until"] is not None and running_contests["until"] >= datetime.now(pytz.utc)
+
+
+def forget_running_contests():
+    running_contests.update(checked=None, until=None)
+
+
+def add_scans_to_team_scores(model: Type[Union[EndpointGenericScan, UrlGenericScan]], scans: List):
+    """
+    Adds the issues of new scans to the scores of the teams that accepted urls of these scans. This is called every
+    time scans are stored, so it only queries for the submissions of contests that have not ended yet.
+    """
+    _, subject_path, subject, scan_types = SCORED_SCANS[model]
+    scans = [scan for scan in scans if scan.type in scan_types]
+    if not scans:
+        return
+
+    # endpoint / url id: the teams that accepted the url and the end of the contest of that team.
+    submitted = defaultdict(list)
+    for subject_id, team, until_moment in (
+        UrlSubmission.objects.all()
+        .filter(
+            **{f"{subject_path}__in": {getattr(scan, subject) for scan in scans}},
+            has_been_accepted=True,
+            added_by_team__participating_in_contest__until_moment__gte=min(scan.rating_determined_on for scan in scans),
+        )
+        .values_list(subject_path, "added_by_team", "added_by_team__participating_in_contest__until_moment")
+    ):
+        submitted[subject_id].append((team, until_moment))
+
+    if not submitted:
+        return
+
+    increments = defaultdict(lambda: {"high": 0, "medium": 0, "low": 0})
+    for scan, severity in zip(scans, get_severities(scans)):
+        for team, until_moment in submitted.get(getattr(scan, subject), []):
+            if scan.rating_determined_on <= until_moment:
+                for level in ["high", "medium", "low"]:
+                    increments[team][level] += severity[level]
+
+    now = datetime.now(pytz.utc)
+    with transaction.atomic():
+        scored_teams = set(TeamScore.objects.all().filter(team__in=increments).values_list("team", flat=True))
+        for team in scored_teams:
+            increment = increments[team]
+            TeamScore.objects.all().filter(team=team).update(
+                high=F("high") + increment["high"],
+                medium=F("medium") + increment["medium"],
+                low=F("low") + increment["low"],
+                total_score=F("total_score")
+                + increment["high"] * SCORE_MULTIPLIER["high"]
+                + increment["medium"] * SCORE_MULTIPLIER["medium"]
+                + increment["low"] * SCORE_MULTIPLIER["low"],
+                at_when=now,
+            )
+
+    # teams without a score yet get a complete score, which includes these scans.
+    unscored_teams = [team for team in increments if team not in scored_teams]
+    if unscored_teams:
+        recalculate_team_scores(unscored_teams)
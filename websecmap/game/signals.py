@@ -0,0 +1,97 @@
+import itertools
+import logging
+from typing import Dict, Optional
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from websecmap.game.models import Contest, OrganizationSubmission, Team, UrlSubmission
+from websecmap.game.scores import (
+    add_scans_to_team_scores,
+    contest_is_running,
+    forget_running_contests,
+    recalculate_contest_scores,
+    recalculate_team_scores,
+)
+from websecmap.scanners.scanmanager import scans_created
+
+log = logging.getLogger(__package__)
+
+# Scores are recalculated after the transaction with the change is committed. A transaction can change many submissions
+# of the same team, such as accepting them in the admin. The score of a team is recalculated once for all changes that
+# were made before.
+changes = itertools.count()
+recalculated_after_change: Dict[int, int] = {}
+
+
+@receiver(scans_created)
+def add_scans_to_scores(sender, scans, **kwargs):
+    if not contest_is_running():
+        return
+
+    # Scores can be recalculated, so an error here should not fail storing the scans.
+    try:
+        with transaction.atomic():
+            add_scans_to_team_scores(sender, scans)
+    except Exception:
+        log.exception("Could not add new scans to the scores of contests.")
+
+
+@receiver(post_save, sender=Contest)
+def recalculate_scores_of_contest(sender, instance, **kwargs):
+    # the end of the contest might have changed, which changes what scans count.
+    forget_running_contests()
+    transaction.on_commit(lambda: recalculate_contest_scores(instance.pk))
+
+
+@receiver(post_delete, sender=Contest)
+def forget_deleted_contest(sender, instance, **kwargs):
+    forget_running_contests()
+
+
+@receiver(post_save, sender=Team)
+def recalculate_scores_of_team(sender, instance, **kwargs):
+    # the team might participate in another contest.
+    recalculate_scores_after_commit(instance.pk)
+
+
+@receiver(post_init, sender=UrlSubmission)
+@receiver(post_init, sender=OrganizationSubmission)
+def remember_submitter(sender, instance, **kwargs):
+    # a submission can be moved to another team, the score of the previous team also changes. Deferred fields are not
+    # loaded.
+    instance.previous_team_id = instance.__dict__.get("added_by_team_id", None)
+
+
+@receiver(post_save, sender=UrlSubmission)
+@receiver(post_save, sender=OrganizationSubmission)
+def recalculate_scores_of_submitter(sender, instance, **kwargs):
+    recalculate_scores_after_commit(instance.added_by_team_id)
+    if instance.previous_team_id != instance.added_by_team_id:
+        recalculate_scores_after_commit(instance.previous_team_id)
+    instance.previous_team_id = instance.added_by_team_id
+
+
+@receiver(post_delete, sender=UrlSubmission)
+@receiver(post_delete, sender=OrganizationSubmission)
+def recalculate_scores_of_deleted_submitter(sender, instance, **kwargs):
+    recalculate_scores_after_commit(instance.previous_team_id)
+
+
+def recalculate_scores_after_commit(team: Optional[int]):
+    if not team:
+        return
+
+    change = next(changes)
+    transaction.on_commit(lambda: recalculate_scores_of_changed_team(team, change))
+
+
+def recalculate_scores_of_changed_team(team: int, change: int):
+    if recalculated_after_change.get(team, -1) > change:
+        return
+
+    recalculated_after_change[team] = next(changes)
+    # submissions are also deleted when their team is deleted.
+    if Team.objects.all().filter(pk=team).exists():
+        recalculate_team_scores([team])
@@ -0,0 +1,61 @@
+import json
+from datetime import datetime, timedelta
+
+import pytz
+
+from websecmap.game import views
+from websecmap.game.models import Contest, Team, UrlSubmission
+from websecmap.organizations.models import Coordinate, OrganizationType
+from websecmap.scanners.tests.test_plannedscan import (
+    create_endpoint,
+    create_endpoint_scan,
+    create_organization,
+    create_url,
+    link_url_to_organization,
+)
+
+
+def test_contest_map_data(db, rf, django_assert_num_queries):
+    now = datetime.now(pytz.utc)
+    contest = Contest.objects.create(
+        name="running", from_moment=now - timedelta(days=1), until_moment=now + timedelta(days=1)
+    )
+    team = Team.objects.create(name="red", participating_in_contest=contest, allowed_to_submit_things=True)
+    OrganizationType.objects.get_or_create(id=1, defaults={"name": "municipality"})
+
+    city = create_organization("City")
+    province = create_organization("Province")
+    Coordinate.objects.create(organization=city, geojsontype="Point", area=[1, 1], created_on=now - timedelta(days=2))
+    Coordinate.objects.create(organization=city, geojsontype="Point", area="[2, 2]", created_on=now)
+
+    # the url of the province is also used by the city, its issues count for both.
+    for domain, organizations, rating in [("city.nl", [city], "F"), ("province.nl", [city, province], "C")]:
+        url = create_url(domain)
+        for organization in organizations:
+            link_url_to_organization(url, organization)
+        endpoint = create_endpoint(url, 4, "https", 443)
+        create_endpoint_scan(endpoint, "tls_qualys_encryption_quality", rating, now - timedelta(hours=1))
+        UrlSubmission.objects.create(
+            added_by_team=team,
+            url=domain,
+            url_in_system=url,
+            for_organization=organizations[-1],
+            has_been_accepted=True,
+        )
+
+    request = rf.get("/game/data/contest/")
+    request.session = {"contest": contest.pk}
+    # the amount of queries does not depend on the amount of scans and organizations.
+    with django_assert_num_queries(10):
+        response = views.contest_map_data(request)
+
+    features = {
+        feature["properties"]["organization_name"]: feature for feature in json.loads(response.content)["features"]
+    }
+    assert features["City"]["properties"]["high"] == 1
+    assert features["City"]["properties"]["low"] == 1
+    assert features["City"]["properties"]["color"] == "red"
+    assert features["City"]["geometry"] == {"type": "Point", "coordinates": [2, 2]}
+    assert features["Province"]["properties"]["low"] == 1
+    assert features["Province"]["properties"]["color"] == "yellow"
+    assert features["Province"]["geometry"] == {"type": "", "coordinates": ""}
@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+from websecmap.game import signals, views
+from websecmap.game.models import Contest, Team, TeamScore, UrlSubmission
+from websecmap.game.scores import recalculate_contest_scores
+from websecmap.scanners.scanmanager import store_endpoint_scan_results, store_url_scan_results
+from websecmap.scanners.tests.test_plannedscan import create_endpoint, create_endpoint_scan, create_url
+
+
+def create_submission(team, url, accepted=True):
+    return UrlSubmission.objects.create(
+        added_by_team=team, url=url.url, url_in_system=url, has_been_accepted=accepted, has_been_rejected=not accepted
+    )
+
+
+def test_team_scores(db, rf, monkeypatch):
+    now = datetime.now(pytz.utc)
+    contest = Contest.objects.create(
+        name="running", from_moment=now - timedelta(days=1), until_moment=now + timedelta(days=1)
+    )
+    ended = Contest.objects.create(
+        name="ended", from_moment=now - timedelta(days=3), until_moment=now - timedelta(days=2)
+    )
+    red = Team.objects.create(name="red", participating_in_contest=contest, allowed_to_submit_things=True)
+    blue = Team.objects.create(name="blue", participating_in_contest=contest, allowed_to_submit_things=True)
+    late = Team.objects.create(name="late", participating_in_contest=ended, allowed_to_submit_things=True)
+
+    url = create_url("example.nl")
+    endpoint = create_endpoint(url, 4, "https", 443)
+    create_endpoint_scan(endpoint, "tls_qualys_encryption_quality", "F", now - timedelta(hours=1))
+    create_submission(red, url)
+    create_submission(late, url)
+    create_submission(blue, create_url("example.com"), accepted=False)
+
+    recalculate_contest_scores(contest.pk)
+    recalculate_contest_scores(ended.pk)
+    assert TeamScore.objects.get(team=red).total_score == 1000 + 250
+    assert TeamScore.objects.get(team=blue).total_score == -1337
+    assert TeamScore.objects.get(team=late).total_score == 250
+
+    # new scans are added to the scores of teams in running contests.
+    store_endpoint_scan_results(
+        [
+            ("tls_qualys_encryption_quality", endpoint.pk, "B", ""),
+            ("tls_qualys_certificate_trusted", endpoint.pk, "not trusted", ""),
+        ]
+    )
+    store_url_scan_results([("DNSSEC", url.pk, "ERROR", "")])
+
+    score = TeamScore.objects.get(team=red)
+    assert (score.high, score.medium, score.low) == (3, 0, 1)
+    assert score.total_score == 3 * 1000 + 100 + 250
+    assert TeamScore.objects.get(team=late).total_score == 250
+
+    # unchanged scans are not counted again, and the maintained score is the same as a recalculated score.
+    store_endpoint_scan_results([("tls_qualys_encryption_quality", endpoint.pk, "B", "")])
+    recalculate_contest_scores(contest.pk)
+    assert TeamScore.objects.get(team=red).total_score == 3 * 1000 + 100 + 250
+
+    # the scoreboard is rendered from the scores, in order.
+    monkeypatch.setattr(views, "render", lambda request, template, context: context)
+    request = rf.get("/game/scores/", {"contest": contest.pk})
+    request.session = {}
+    context = views.scores.__wrapped__(request)
+    assert [score["team"] for score in context["scores"]] == ["red", "blue"]
+    assert context["scores"][0]["high_score"] == 3000
+
+
+def test_scores_follow_changes(db, monkeypatch):
+    now = datetime.now(pytz.utc)
+    contest = Contest.objects.create(
+        name="running", from_moment=now - timedelta(days=1), until_moment=now + timedelta(days=1)
+    )
+    red = Team.objects.create(name="red", participating_in_contest=contest, allowed_to_submit_things=True)
+    url = create_url("example.nl")
+    endpoint = create_endpoint(url, 4, "https", 443)
+    create_endpoint_scan(endpoint, "tls_qualys_encryption_quality", "F", now - timedelta(hours=1))
+    submission = create_submission(red, url)
+    recalculate_contest_scores(contest.pk)
+
+    # the test runs in a transaction that is never committed.
+    monkeypatch.setattr(signals.transaction, "on_commit", lambda callback: callback())
+    assert TeamScore.objects.get(team=red).total_score == 1000 + 250
+
+    # moving the end of the contest before the scan changes what counts.
+    contest.until_moment = now - timedelta(hours=2)
+    contest.save()
+    assert TeamScore.objects.get(team=red).total_score == 250
+
+    submission.delete()
+    assert TeamScore.objects.get(team=red).total_score == 0
+
+    contest.until_moment = now + timedelta(days=1)
+    contest.save()
+    submission = create_submission(red, url)
+    assert TeamScore.objects.get(team=red).total_score == 1000 + 250
+
+    # submissions can be moved to another team, and teams to another contest.
+    blue = Team.objects.create(name="blue", participating_in_contest=contest, allowed_to_submit_things=True)
+    submission.added_by_team = blue
+    submission.save()
+    assert TeamScore.objects.get(team=red).total_score == 0
+    assert TeamScore.objects.get(team=blue).total_score == 1000 + 250
+
+    blue.participating_in_contest = Contest.objects.create(
+        name="ended", from_moment=now - timedelta(days=3), until_moment=now - timedelta(days=2)
+    )
+    blue.save()
+    assert TeamScore.objects.get(team=blue).total_score == 250
+
+    submission.has_been_accepted = False
+    submission.has_been_rejected = True
+    submission.save()
+    assert TeamScore.objects.get(team=blue).total_score == -1337
+
+    # errors while scoring do not prevent storing scans.
+    create_submission(red, url)
+
+    def broken_scores(model, scans):
+        raise ValueError("No severity for this scan.")
+
+    monkeypatch.setattr(signals, "add_scans_to_team_scores", broken_scores)
+    store_endpoint_scan_results([("tls_qualys_encryption_quality", endpoint.pk, "B", "")])
+    assert endpoint.endpointgenericscan_set.filter(is_the_latest_scan=True).get().rating == "B"
+
+    # many changes to the same team in one transaction recalculate its score once, after the commit.
+    commit_callbacks = []
+    recalculated = []
+    monkeypatch.setattr(signals.transaction, "on_commit", commit_callbacks.append)
+    monkeypatch.setattr(signals, "recalculate_team_scores", recalculated.append)
+    for team_submission in UrlSubmission.objects.all().filter(added_by_team=red):
+        team_submission.save()
+    red.save()
+    for callback in commit_callbacks:
+        callback()
+    assert recalculated == [[red.pk]]
@@ -9,7 +9,7 @@ from constance import config
 from dal import autocomplete
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Count, Q
+from django.db.models import Count, OuterRef, Prefetch, Q, Subquery
 from django.db.models.functions import Lower
 from django.db.utils import OperationalError
 from django.http import JsonResponse
@@ -20,8 +20,9 @@ from django.views.decorators.cache import cache_page
 from websecmap.app.common import JSEncoder
 from websecmap.game.forms import ContestForm, OrganisationSubmissionForm, TeamForm, UrlSubmissionForm
 from websecmap.game.models import Contest, OrganizationSubmission, Team, UrlSubmission
-from websecmap.organizations.models import Organization, OrganizationType, Url
-from websecmap.reporting.severity import get_severity
+from websecmap.game.scores import SCORE_MULTIPLIER, recalculate_team_scores
+from websecmap.organizations.models import Coordinate, Organization, OrganizationType, Url
+from websecmap.reporting.severity import get_severities
 from websecmap.scanners import ENDPOINT_SCAN_TYPES, URL_SCAN_TYPES
 from websecmap.scanners.models import EndpointGenericScan, UrlGenericScan
 
@@ -172,7 +173,18 @@ def scores(request):
         contest = get_default_contest(request)
 
     # remove disqualified teams.
-    teams = Team.objects.all().filter(participating_in_contest=contest, allowed_to_submit_things=True)
+    teams = list(
+        Team.objects.all()
+        .filter(participating_in_contest=contest, allowed_to_submit_things=True)
+        .select_related("score")
+    )
+
+    # Scores are maintained when scans are stored and submissions are judged, see websecmap.game.scores. Teams that
+    # have not been scored yet, for example right after a team joined, are scored now.
+    unscored_teams = [team.pk for team in teams if not hasattr(team, "score")]
+    if unscored_teams:
+        recalculate_team_scores(unscored_teams)
+        teams = list(Team.objects.all().filter(pk__in=[team.pk for team in teams]).select_related("score"))
 
     scores = []
     for team in teams:
@@ -182,81 +194,7 @@ def scores(request):
         will change in a day or two. On the long run it might increase the score a bit when incorrect fixes are applied
         or a new error is found. If the discovered issue is fixed it doesn't deliver additional points.
         """
-        scans = list(
-            EndpointGenericScan.objects.all().filter(
-                endpoint__url__urlsubmission__added_by_team=team.id,
-                endpoint__url__urlsubmission__has_been_accepted=True,
-                rating_determined_on__lte=contest.until_moment,
-                type__in=ENDPOINT_SCAN_TYPES,
-            )
-        )
-
-        scans += list(
-            UrlGenericScan.objects.all().filter(
-                url__urlsubmission__added_by_team=team.id,
-                url__urlsubmission__has_been_accepted=True,
-                rating_determined_on__lte=contest.until_moment,
-                type__in=URL_SCAN_TYPES,
-            )
-        )
-
-        added_urls = (
-            UrlSubmission.objects.all()
-            .filter(
-                added_by_team=team.id,
-                has_been_accepted=True,
-                has_been_rejected=False,
-            )
-            .count()
-        )
-
-        added_organizations = (
-            OrganizationSubmission.objects.all()
-            .filter(added_by_team=team.id, has_been_accepted=True, has_been_rejected=False)
-            .count()
-        )
-
-        rejected_organizations = (
-            OrganizationSubmission.objects.all()
-            .filter(
-                added_by_team=team.id,
-                has_been_accepted=False,
-                has_been_rejected=True,
-            )
-            .count()
-        )
-
-        rejected_urls = (
-            UrlSubmission.objects.all()
-            .filter(
-                added_by_team=team.id,
-                has_been_accepted=False,
-                has_been_rejected=True,
-            )
-            .count()
-        )
-
-        final_calculation = {
-            "high": 0,
-            "medium": 0,
-            "low": 0,
-        }
-
-        for scan in scans:
-            temp_calculation = get_severity(scan)
-            final_calculation["high"] += temp_calculation["high"]
-            final_calculation["medium"] += temp_calculation["medium"]
-            final_calculation["low"] += temp_calculation["low"]
-
-        score_multiplier = {
-            "low": 100,
-            "medium": 250,
-            "high": 1000,
-            "rejected_organization": 1337,
-            "rejected_url": 1337,
-            "organization": 500,
-            "url": 250,
-        }
+        team_score = team.score
 
         # if you're too lazy to enter a color.
         # or the control doesn't work.
@@ -274,36 +212,29 @@ def scores(request):
             "team_color": team.color,
             # transparency makes it lighter and more beautiful.
             "team_color_soft": "%s%s" % (color_code, "33"),
-            "high": final_calculation["high"],
-            "high_multiplier": score_multiplier["high"],
-            "high_score": final_calculation["high"] * score_multiplier["high"],
-            "medium": final_calculation["medium"],
-            "medium_multiplier": score_multiplier["medium"],
-            "medium_score": final_calculation["medium"] * score_multiplier["medium"],
-            "low": final_calculation["low"],
-            "low_multiplier": score_multiplier["low"],
-            "low_score": final_calculation["low"] * score_multiplier["low"],
-            "added_organizations": added_organizations,
-            "added_organizations_multiplier": score_multiplier["organization"],
-            "added_organizations_score": added_organizations * score_multiplier["organization"],
-            "added_urls": added_urls,
-            "added_urls_multiplier": score_multiplier["url"],
-            "added_urls_score": added_urls * score_multiplier["url"],
-            "rejected_organizations": rejected_organizations,
-            "rejected_organizations_multiplier": score_multiplier["rejected_organization"],
-            "rejected_organizations_score": rejected_organizations * score_multiplier["rejected_organization"],
-            "rejected_urls": rejected_urls,
-            "rejected_urls_multiplier": score_multiplier["rejected_url"],
-            "rejected_urls_score": rejected_urls * score_multiplier["rejected_url"],
-            "total_score": final_calculation["high"] * score_multiplier["high"]
-            + final_calculation["medium"] * score_multiplier["medium"]
-            + final_calculation["low"] * score_multiplier["low"]
-            + added_organizations * score_multiplier["organization"]
-            + added_urls * score_multiplier["url"]
-            - (
-                rejected_urls * score_multiplier["rejected_url"]
-                + rejected_organizations * score_multiplier["rejected_organization"]
-            ),
+            "high": team_score.high,
+            "high_multiplier": SCORE_MULTIPLIER["high"],
+            "high_score": team_score.high * SCORE_MULTIPLIER["high"],
+            "medium": team_score.medium,
+            "medium_multiplier": SCORE_MULTIPLIER["medium"],
+            "medium_score": team_score.medium * SCORE_MULTIPLIER["medium"],
+            "low": team_score.low,
+            "low_multiplier": SCORE_MULTIPLIER["low"],
+            "low_score": team_score.low * SCORE_MULTIPLIER["low"],
+            "added_organizations": team_score.added_organizations,
+            "added_organizations_multiplier": SCORE_MULTIPLIER["organization"],
+            "added_organizations_score": team_score.added_organizations * SCORE_MULTIPLIER["organization"],
+            "added_urls": team_score.added_urls,
+            "added_urls_multiplier": SCORE_MULTIPLIER["url"],
+            "added_urls_score": team_score.added_urls * SCORE_MULTIPLIER["url"],
+            "rejected_organizations": team_score.rejected_organizations,
+            "rejected_organizations_multiplier": SCORE_MULTIPLIER["rejected_organization"],
+            "rejected_organizations_score": team_score.rejected_organizations
+            * SCORE_MULTIPLIER["rejected_organization"],
+            "rejected_urls": team_score.rejected_urls,
+            "rejected_urls_multiplier": SCORE_MULTIPLIER["rejected_url"],
+            "rejected_urls_score": team_score.rejected_urls * SCORE_MULTIPLIER["rejected_url"],
+            "total_score": team_score.total_score,
         }
 
         scores.append(score)
@@ -597,6 +528,7 @@ def contest_map_data(request):
     # We don't filter out only top level domains, because we might want to add some special subdomains from
     # third party service suppliers. For example: organization.thirdpartysupplier.com.
     # normal contests prohibit these subdomains.
+    organizations_with_type = Organization.objects.all().select_related("type")
     endpoint_scans = list(
         EndpointGenericScan.objects.all()
         .filter(
@@ -605,8 +537,7 @@ def contest_map_data(request):
             type__in=ENDPOINT_SCAN_TYPES,
             rating_determined_on__lte=contest.until_moment,
         )
-        .prefetch_related("endpoint__url__organization")
-        .order_by("endpoint__url__organization")
+        .prefetch_related(Prefetch("endpoint__url__organization", queryset=organizations_with_type))
     )
 
     url_scans = list(
@@ -617,8 +548,7 @@ def contest_map_data(request):
             type__in=URL_SCAN_TYPES,
             rating_determined_on__lte=contest.until_moment,
         )
-        .prefetch_related("url__organization")
-        .order_by("url__organization")
+        .prefetch_related(Prefetch("url__organization", queryset=organizations_with_type))
     )
 
     features = []
@@ -663,20 +593,12 @@ def contest_map_data(request):
     bare_urls = list(
         UrlSubmission.objects.all()
         .filter(has_been_accepted=False, has_been_rejected=False, added_by_team__participating_in_contest=contest.pk)
-        .prefetch_related("for_organization__coordinate_set")
+        .select_related("for_organization__type")
     )
     features = add_bare_url_features(features, bare_urls)
 
-    # loop over the organizations and calculate the ratings.
-    # you prefetch all the related objects, which still have to be iterated... damn,
-    # because now you can't simply iterate over the data.
-    # you can't sort by the first organization, as the second one might be different entirely.
-    # let's build the data iteratively based on organizations in the queryset.
-    for scan in endpoint_scans:
-        features = add_or_update_features(features, scan)
-
-    for scan in url_scans:
-        features = add_or_update_features(features, scan)
+    # one feature per organization, with the sum of the severity of all scans on the urls of that organization.
+    features += get_scan_features(endpoint_scans + url_scans)
 
     # update string features to json type.
     # todo: make sure that there are no strings in the database, because of this uglyness
@@ -694,60 +616,55 @@ def contest_map_data(request):
     return JsonResponse(data, encoder=JSEncoder)
 
 
-def add_or_update_features(features, scan):
-    # not really memory efficient
-    new_features = []
+def get_scan_features(scans):
+    """
+    Creates a feature per organization of the scanned urls, in a single pass over all scans. An url can belong to
+    several organizations, the scan then counts for each of them.
+    """
+    organizations_of_scans = [get_organizations(scan) for scan in scans]
+    coordinates = get_latest_coordinates(
+        {organization.pk for organizations in organizations_of_scans for organization in organizations}
+    )
 
     # features are unique by organization ID.
-    organizations = get_organizations(scan)
-
-    # First check if the feature exist, if not create it.
-    existing_features = []
-    for organization in organizations:
-        for feature in features:
-            if feature.get("properties", {}).get("organization_id", None) == organization.pk:
-                # todo: should also be able to add scan results here, as it exists anyway
-                new_features.append(update_feature(feature, scan))
-                existing_features.append(organization.pk)
-
-    not_featured_organizations = []
-    for organization in organizations:
-        if organization.pk not in existing_features:
-            not_featured_organizations.append(organization)
-
-    # create new features of the organizations that don't have one yet
-    for organization in not_featured_organizations:
-        new_features.append(make_new_feature(organization, scan))
-
-    # copy the features that where not relevant to this scan
-    for feature in features:
-        if feature["properties"]["organization_id"] not in existing_features:
-            new_features.append(feature)
-
-    return new_features
+    features = {}
+    for scan, organizations, calculation in zip(scans, organizations_of_scans, get_severities(scans)):
+        for organization in organizations:
+            if organization.pk in features:
+                update_feature(features[organization.pk], calculation)
+            else:
+                features[organization.pk] = make_new_feature(
+                    organization, scan, calculation, coordinates.get(organization.pk, ("", ""))
+                )
 
+    return list(features.values())
 
-def update_feature(feature, scan):
-    # log.debug('Updating feature %s, with scan %s' % (feature['properties']['organization_id'], scan))
-    calculation = get_severity(scan)
 
+def update_feature(feature, calculation):
     feature["properties"]["high"] += calculation["high"]
     feature["properties"]["medium"] += calculation["medium"]
     feature["properties"]["low"] += calculation["low"]
+    feature["properties"]["color"] = severity_color(feature["properties"])
+    return feature
 
-    color = (
-        "red"
-        if feature["properties"]["high"]
-        else "orange"
-        if feature["properties"]["medium"]
-        else "yellow"
-        if feature["properties"]["low"]
-        else "green"
-    )
 
-    feature["properties"]["color"] = color
+def severity_color(severity):
+    return "red" if severity["high"] else "orange" if severity["medium"] else "yellow" if severity["low"] else "green"
 
-    return feature
+
+def get_latest_coordinates(organizations):
+    """
+    Returns the area and geojsontype of the latest coordinate of each organization, in one query.
+
+    Early contests didn't require the pinpointing of a location, so not every organization has a coordinate.
+    """
+    latest = Coordinate.objects.all().filter(organization=OuterRef("organization")).order_by("-created_on")
+    return {
+        organization: (area, geojsontype)
+        for organization, area, geojsontype in Coordinate.objects.all()
+        .filter(organization__in=organizations, pk=Subquery(latest.values("pk")[:1]))
+        .values_list("organization", "area", "geojsontype")
+    }
 
 
 def get_bare_organization_feature(submitted_organization):
@@ -781,34 +698,32 @@ def get_bare_organization_feature(submitted_organization):
 
 
 def add_bare_url_features(features, submitted_urls):
+    # take into account that some contests / urls could not associated with a region. If there is no region
+    # attached to it, there is also nothing to plot. It doesn't matter much which coordinate is used, as it's more an
+    # indication than that it actually needs to be true.
+    coordinates = get_latest_coordinates({submitted_url.for_organization_id for submitted_url in submitted_urls})
+
+    # stored as string in the feature
+    featured_organizations = {feature["properties"]["organization_id"] for feature in features}
 
     # submitted url is always for a single organization.
     for submitted_url in submitted_urls:
         # as the submitted urls doesn't have ratings etc, we only check if we need to add the organization
         # to the list of features.
-
-        # check if the organization is not yet in the list of features.
-        if organization_in_features(submitted_url.for_organization, features):
-            continue
-
-        # take into account that some contests / urls could not associated with a region. If there is no region
-        # attached to it, there is also nothing to plot, thus return the existing features
-        if not submitted_url.for_organization.coordinate_set.count():
+        organization = submitted_url.for_organization
+        if not organization or str(organization.pk) in featured_organizations or organization.pk not in coordinates:
             continue
 
-        # get the last known coordinate from this set. They are (usually) ordered by date. But it doesn't matter much
-        # as it's more an indication than that it actually needs to be true/
-        coordinate = submitted_url.for_organization.coordinate_set.last()
-        geojsontype = coordinate.geojsontype
-        area = coordinate.area
+        area, geojsontype = coordinates[organization.pk]
+        featured_organizations.add(str(organization.pk))
 
         feature = {
             "type": "Feature",
             "properties": {
-                "organization_id": "%s" % submitted_url.for_organization.pk,
-                "organization_type": submitted_url.for_organization.type.name,
-                "organization_name": submitted_url.for_organization.name,
-                "organization_slug": slugify(submitted_url.for_organization.name),
+                "organization_id": "%s" % organization.pk,
+                "organization_type": organization.type.name,
+                "organization_name": organization.name,
+                "organization_slug": slugify(organization.name),
                 "overall": 0,
                 "high": 0,
                 "medium": 0,
@@ -833,43 +748,8 @@ def add_bare_url_features(features, submitted_urls):
     return features
 
 
-def organization_in_features(organization, features):
-    id = str(organization.pk)  # stored as string in the feature
-
-    for feature in features:
-        if feature["properties"]["organization_id"] == id:
-            return True
-
-    # not in there
-    return False
-
-
-def make_new_feature(organization, scan):
-    # log.debug('Making new feature %s, with scan %s' % (organization, scan))
-
-    calculation = get_severity(scan)
-    color = (
-        "red"
-        if calculation["high"]
-        else "orange"
-        if calculation["medium"]
-        else "yellow"
-        if calculation["low"]
-        else "green"
-    )
-
-    from websecmap.organizations.models import Coordinate
-
-    # only one multipoint or multipolygon. Unfortunately one query per organization :((((((((((((
-    coordinate = Coordinate.objects.all().filter(organization=organization).order_by("-created_on").first()
-
-    # early contest didn't require the pinpointing of a location, later contests an organization is always required
-    if not coordinate:
-        area = ""
-        geojsontype = ""
-    else:
-        area = coordinate.area
-        geojsontype = coordinate.geojsontype
+def make_new_feature(organization, scan, calculation, coordinate):
+    area, geojsontype = coordinate
 
     return {
         "type": "Feature",
@@ -883,7 +763,7 @@ def make_new_feature(organization, scan):
             "medium": calculation["medium"],
             "low": calculation["low"],
             "data_from": scan.last_scan_moment,
-            "color": color,
+            "color": severity_color(calculation),
             "total_urls": 0,  # = 100%
             "high_urls": 0,
             "medium_urls": 0,
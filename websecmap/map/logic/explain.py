@@ -5,7 +5,7 @@ from django.db.models import Count, Q
 from django.utils import timezone
 
 from websecmap.map.logic.map_defaults import get_country, get_organization_type
-from websecmap.reporting.severity import get_severity
+from websecmap.reporting.severity import get_severities
 from websecmap.scanners import ENDPOINT_SCAN_TYPES, URL_SCAN_TYPES
 from websecmap.scanners.models import EndpointGenericScan, UrlGenericScan
 
@@ -85,12 +85,13 @@ def get_all_explains(country, organization_type, limit=0):
     )
 
     explains = []
+    now = timezone.now()
 
-    for scan in ugss:
-        explains.append(get_explanation("url", scan))
+    for scan, calculation in zip(ugss, get_severities(ugss, now)):
+        explains.append(get_explanation("url", scan, calculation, now))
 
-    for scan in egss:
-        explains.append(get_explanation("endpoint", scan))
+    for scan, calculation in zip(egss, get_severities(egss, now)):
+        explains.append(get_explanation("endpoint", scan, calculation, now))
 
     # sorting
     explains = sorted(explains, key=lambda k: (k["explained_on"]), reverse=True)
@@ -98,11 +99,10 @@ def get_all_explains(country, organization_type, limit=0):
     return explains
 
 
-def get_explanation(type, scan):
-    calculation = get_severity(scan)
-
-    now = timezone.now().isoformat()
-    explained_on = scan.comply_or_explain_explained_on.isoformat() if scan.comply_or_explain_explained_on else now
+def get_explanation(type, scan, calculation, now):
+    explained_on = (
+        scan.comply_or_explain_explained_on.isoformat() if scan.comply_or_explain_explained_on else now.isoformat()
+    )
 
     this_explain = {
         "scan_type": scan.type,
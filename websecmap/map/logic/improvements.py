@@ -1,9 +1,11 @@
 from datetime import timedelta
+from typing import Dict
 
+from django.db.models import Sum
 from django.utils import timezone
 
 from websecmap.map.logic.map_defaults import get_country, get_organization_type, get_when
-from websecmap.reporting.models import UrlReport
+from websecmap.reporting.report import latest_url_report_scan_type_statistics
 
 
 def get_improvements(country, organization_type, weeks_back, weeks_duration):
@@ -22,120 +24,19 @@ def get_improvements(country, organization_type, weeks_back, weeks_duration):
 
     # compare the first urlrating to the last urlrating
     # but do not include urls that don't exist.
+    # The statistics per scan type of the latest url reports are summed in the database, instead of loading and
+    # summing the calculation of every url report.
+    organization_type_id = get_organization_type(organization_type)
+    country = get_country(country)
 
-    sql = """
-        SELECT
-            reporting_urlreport.id as id,
-            calculation
-        FROM
-            reporting_urlreport
-        INNER JOIN
-            (
-                SELECT MAX(id) as id2 FROM reporting_urlreport or2
-                WHERE at_when <= '%(when)s' GROUP BY url_id
-            ) as x
-        ON x.id2 = reporting_urlreport.id
-        INNER JOIN url ON reporting_urlreport.url_id = url.id
-        INNER JOIN url_organization on url.id = url_organization.url_id
-        INNER JOIN organization ON url_organization.organization_id = organization.id
-        WHERE organization.type_id = '%(OrganizationTypeId)s'
-        AND organization.country = '%(country)s'
-            """ % {
-        "when": when,
-        "OrganizationTypeId": get_organization_type(organization_type),
-        "country": get_country(country),
-    }
-
-    newest_urlratings = UrlReport.objects.raw(sql)
+    new_measurement = get_measurement(country, organization_type_id, when)
 
     # this of course doesn't work with the first day, as then we didn't measure
     # everything (and the ratings for several issues are 0...
-    sql = """
-        SELECT reporting_urlreport.id as id, calculation FROM
-            reporting_urlreport
-        INNER JOIN
-            (
-                SELECT MAX(id) as id2 FROM reporting_urlreport or2
-                WHERE at_when <= '%(when)s' GROUP BY url_id
-            ) as x
-        ON x.id2 = reporting_urlreport.id
-        INNER JOIN url ON reporting_urlreport.url_id = url.id
-        INNER JOIN url_organization on url.id = url_organization.url_id
-        INNER JOIN organization ON url_organization.organization_id = organization.id
-        WHERE organization.type_id = '%(OrganizationTypeId)s'
-        AND organization.country = '%(country)s'
-            """ % {
-        "when": when - timedelta(days=(weeks_duration * 7)),
-        "OrganizationTypeId": get_organization_type(organization_type),
-        "country": get_country(country),
-    }
-
-    oldest_urlratings = UrlReport.objects.raw(sql)
-
-    old_measurement = {}
-    new_measurement = {}
-    scan_types = []
-
-    # stats for the newest, should be made a function:
-    for urlrating in newest_urlratings:
-
-        # url level, why are there reports without url ratings / empty url ratings like
-        if "ratings" in urlrating.calculation:
-            for rating in urlrating.calculation["ratings"]:
-                if rating["type"] not in new_measurement:
-                    new_measurement[rating["type"]] = {"high": 0, "medium": 0, "low": 0}
-
-                if rating["type"] not in scan_types:
-                    scan_types.append(rating["type"])
-
-                new_measurement[rating["type"]]["high"] += rating["high"]
-                new_measurement[rating["type"]]["medium"] += rating["medium"]
-                new_measurement[rating["type"]]["low"] += rating["low"]
-
-        if "endpoints" not in urlrating.calculation:
-            continue
-
-        for endpoint in urlrating.calculation["endpoints"]:
-            for rating in endpoint["ratings"]:
-                if rating["type"] not in new_measurement:
-                    new_measurement[rating["type"]] = {"high": 0, "medium": 0, "low": 0}
-
-                if rating["type"] not in scan_types:
-                    scan_types.append(rating["type"])
+    old_measurement = get_measurement(country, organization_type_id, when - timedelta(days=(weeks_duration * 7)))
 
-                new_measurement[rating["type"]]["high"] += rating["high"]
-                new_measurement[rating["type"]]["medium"] += rating["medium"]
-                new_measurement[rating["type"]]["low"] += rating["low"]
-
-    # and the oldest stats, which should be the same function
-    for urlrating in oldest_urlratings:
-
-        if "ratings" in urlrating.calculation:
-            for rating in urlrating.calculation["ratings"]:
-                if rating["type"] not in old_measurement:
-                    old_measurement[rating["type"]] = {"high": 0, "medium": 0, "low": 0}
-
-                if rating["type"] not in scan_types:
-                    scan_types.append(rating["type"])
-
-                old_measurement[rating["type"]]["high"] += rating["high"]
-                old_measurement[rating["type"]]["medium"] += rating["medium"]
-                old_measurement[rating["type"]]["low"] += rating["low"]
-
-        if "endpoints" not in urlrating.calculation:
-            continue
-
-        for endpoint in urlrating.calculation["endpoints"]:
-            for rating in endpoint["ratings"]:
-                if rating["type"] not in old_measurement:
-                    old_measurement[rating["type"]] = {"high": 0, "medium": 0, "low": 0}
-
-                if rating["type"] not in scan_types:
-                    scan_types.append(rating["type"])
-
-                old_measurement[rating["type"]]["high"] += rating["high"]
-                old_measurement[rating["type"]]["medium"] += rating["medium"]
-                old_measurement[rating["type"]]["low"] += rating["low"]
+    scan_types = list(new_measurement.keys())
+    scan_types += [scan_type for scan_type in old_measurement.keys() if scan_type not in scan_types]
 
     # and now do some magic to see the changes in this timespan:
     changes = {}
@@ -195,3 +96,23 @@ def get_improvements(country, organization_type, weeks_back, weeks_duration):
         }
 
     return changes
+
+
+def get_measurement(country: str, organization_type_id: int, when) -> Dict[str, Dict[str, int]]:
+    statistics = (
+        latest_url_report_scan_type_statistics(when)
+        .filter(url__organization__type=organization_type_id, url__organization__country=country)
+        .exclude(scan_type="total")
+        .values("scan_type")
+        .annotate(high_sum=Sum("high"), medium_sum=Sum("medium"), low_sum=Sum("low"))
+        .order_by("scan_type")
+    )
+
+    return {
+        statistic["scan_type"]: {
+            "high": statistic["high_sum"],
+            "medium": statistic["medium_sum"],
+            "low": statistic["low_sum"],
+        }
+        for statistic in statistics
+    }
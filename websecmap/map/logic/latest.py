@@ -6,7 +6,7 @@ from django.utils import timezone
 
 from websecmap.map.logic.map_defaults import get_country, get_organization_type, remark
 from websecmap.map.report import PUBLISHED_ENDPOINT_SCAN_TYPES, PUBLISHED_URL_SCAN_TYPES
-from websecmap.reporting.severity import get_severity
+from websecmap.reporting.severity import get_severities
 from websecmap.scanners.models import EndpointGenericScan, UrlGenericScan
 
 
@@ -52,11 +52,17 @@ def get_all_latest_scans(country, organization_type):
                 "rating",
                 "type",
                 "explanation",
+                # used in the severity, which would otherwise retrieve these fields per scan.
+                "rating_determined_on",
+                "last_scan_moment",
+                "comply_or_explain_is_explained",
+                "comply_or_explain_explanation",
+                "comply_or_explain_explained_on",
+                "comply_or_explain_explanation_valid_until",
             )[0:20]
         )
 
-        for scan in scans:
-            calculation = get_severity(scan)
+        for scan, calculation in zip(scans, get_severities(scans)):
 
             dataset["scans"][scan_type].append(
                 {
@@ -97,8 +103,7 @@ def get_all_latest_scans(country, organization_type):
             .order_by("-rating_determined_on")[0:6]
         )
 
-        for scan in scans:
-            calculation = get_severity(scan)
+        for scan, calculation in zip(scans, get_severities(scans)):
 
             # url scans
             dataset["scans"][scan_type].append(
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List
+from typing import Any, Dict, List
 
 import pytz
 import simplejson as json
@@ -72,53 +72,69 @@ def get_cached_map_data(
 def get_map_data(
     country: str = "NL", organization_type: str = "municipality", days_back: int = 0, displayed_issue: str = None
 ):
+    cached = get_cached_map_data(country, organization_type, days_back, map_data_filters(displayed_issue))
 
-    when = datetime.now(pytz.utc) - relativedelta(days=int(days_back))
-
-    desired_url_scans = []
-    desired_endpoint_scans = []
+    if cached:
+        return cached
 
-    if displayed_issue in URL_SCAN_TYPES:
-        desired_url_scans += [displayed_issue]
+    return get_map_data_per_issue(country, organization_type, days_back, [displayed_issue])[displayed_issue]
 
-    if displayed_issue in ENDPOINT_SCAN_TYPES:
-        desired_endpoint_scans += [displayed_issue]
 
+def map_data_filters(displayed_issue: str = None) -> List[str]:
     # fallback if no data is "all", which is the default.
-    if not desired_url_scans and not desired_endpoint_scans:
-        desired_url_scans = URL_SCAN_TYPES
-        desired_endpoint_scans = ENDPOINT_SCAN_TYPES
+    if displayed_issue in URL_SCAN_TYPES or displayed_issue in ENDPOINT_SCAN_TYPES:
+        return [displayed_issue]
 
-        filters = ["all"]
-    else:
-        filters = desired_url_scans + desired_endpoint_scans
+    return ["all"]
 
-    cached = get_cached_map_data(country, organization_type, days_back, filters)
-
-    if cached:
-        return cached
 
+def get_map_data_per_issue(
+    country: str = "NL", organization_type: str = "municipality", days_back: int = 0, displayed_issues: List[str] = None
+) -> Dict[str, Dict[str, Any]]:
     """
-    Returns a json structure containing all current map data.
+    Returns a json structure containing all current map data, for each of the displayed issues.
     This is used by the client to render the map.
 
     Renditions of this dataset might be pushed to gitlab automatically.
 
-    :return:
+    The organizations, their shapes and their reports are retrieved once, for all displayed issues. Every report is
+    also parsed once, the high, medium and low values for all displayed issues are counted in the same loop.
+
+    :return: {displayed_issue: map data}
     """
 
+    when = datetime.now(pytz.utc) - relativedelta(days=int(days_back))
+
+    # prevent mutable default, an issue that is asked for twice would be counted twice.
+    displayed_issues = list(dict.fromkeys(displayed_issues)) if displayed_issues else [None]
+
+    # Per scan type: the displayed issues that count a rating of this type. An unknown issue shows all issues.
+    url_scan_issues = {scan_type: [] for scan_type in URL_SCAN_TYPES}
+    endpoint_scan_issues = {scan_type: [] for scan_type in ENDPOINT_SCAN_TYPES}
+    for displayed_issue in displayed_issues:
+        if map_data_filters(displayed_issue) == ["all"]:
+            for issues in list(url_scan_issues.values()) + list(endpoint_scan_issues.values()):
+                issues.append(displayed_issue)
+        elif displayed_issue in URL_SCAN_TYPES:
+            url_scan_issues[displayed_issue].append(displayed_issue)
+        else:
+            endpoint_scan_issues[displayed_issue].append(displayed_issue)
+
     data = {
-        "metadata": {
-            "type": "FeatureCollection",
-            "render_date": datetime.now(pytz.utc).isoformat(),
-            "data_from_time": when.isoformat(),
-            "remark": remark,
-            "applied filter": displayed_issue,
-            "layer": organization_type,
-            "country": country,
-        },
-        "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
-        "features": [],
+        displayed_issue: {
+            "metadata": {
+                "type": "FeatureCollection",
+                "render_date": datetime.now(pytz.utc).isoformat(),
+                "data_from_time": when.isoformat(),
+                "remark": remark,
+                "applied filter": displayed_issue,
+                "layer": organization_type,
+                "country": country,
+            },
+            "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
+            "features": [],
+        }
+        for displayed_issue in displayed_issues
     }
 
     cursor = connection.cursor()
@@ -245,71 +261,55 @@ def get_map_data(
         # filtering with javascript, which is error prone (todo: this will be done in the future, as it responds faster
         # but it will also mean an enormous increase of data sent to the client.)
         # It's actually reasonably fast.
-        high, medium, low, ok = 0, 0, 0, 0
+        # high, medium, low, ok per displayed issue
+        issue_counts = {displayed_issue: [0, 0, 0, 0] for displayed_issue in displayed_issues}
 
         calculation = json.loads(reports[i[6]])
 
         for url in calculation["organization"]["urls"]:
             for url_rating in url["ratings"]:
-                if (
-                    url_rating["type"] in desired_url_scans
-                    and url_rating.get("comply_or_explain_valid_at_time_of_report", False) is False
-                ):
-                    high += url_rating["high"]
-                    medium += url_rating["medium"]
-                    low += url_rating["low"]
-                    ok += url_rating["ok"]
+                if url_rating.get("comply_or_explain_valid_at_time_of_report", False) is False:
+                    for displayed_issue in url_scan_issues.get(url_rating["type"], []):
+                        counts = issue_counts[displayed_issue]
+                        counts[0] += url_rating["high"]
+                        counts[1] += url_rating["medium"]
+                        counts[2] += url_rating["low"]
+                        counts[3] += url_rating["ok"]
 
             # it's possible the url doesn't have ratings.
             for endpoint in url["endpoints"]:
                 for endpoint_rating in endpoint["ratings"]:
-                    if (
-                        endpoint_rating["type"] in desired_endpoint_scans
-                        and endpoint_rating.get("comply_or_explain_valid_at_time_of_report", False) is False
-                    ):
-                        high += endpoint_rating["high"]
-                        medium += endpoint_rating["medium"]
-                        low += endpoint_rating["low"]
-                        ok += endpoint_rating["ok"]
-
-        # figure out if red, orange or green:
-        # #162, only make things red if there is a critical issue.
-        # removed json parsing of the calculation. This saves time.
-        # no contents, no endpoint ever mentioned in any url (which is a standard attribute)
-        if "total_urls" not in calculation["organization"] or not calculation["organization"]["total_urls"]:
-            severity = "unknown"
-        else:
-            # things have to be OK in order to be colored. If it's all empty... then it's not OK.
-            severity = "high" if high else "medium" if medium else "low" if low else "good" if ok else "unknown"
-
-        dataset = {
-            "type": "Feature",
-            "properties": {
-                "organization_id": i[5],
-                "organization_type": i[2],
-                "organization_name": i[1],
-                "organization_name_lowercase": i[1].lower(),
-                "organization_slug": slugify(i[1]),
-                "additional_keywords": extract_domains(calculation),
-                "high": high,
-                "medium": medium,
-                "low": low,
-                "data_from": when.isoformat(),
-                "severity": severity,
-                "total_urls": i[11],  # = 100%
-                "high_urls": i[12],
-                "medium_urls": i[13],
-                "low_urls": i[14],
-            },
-            "geometry": {
-                # the coordinate ID makes it easy to check if the geometry has changed shape/location.
-                "coordinate_id": i[15],
-                "type": i[4],
-                # Sometimes the data is a string, sometimes it's a list. The admin
-                # interface might influence this. The fastest would be to use a string, instead of
-                # loading some json.
-                "coordinates": proper_coordinate(i[3], i[4]),
-            },
+                    if endpoint_rating.get("comply_or_explain_valid_at_time_of_report", False) is False:
+                        for displayed_issue in endpoint_scan_issues.get(endpoint_rating["type"], []):
+                            counts = issue_counts[displayed_issue]
+                            counts[0] += endpoint_rating["high"]
+                            counts[1] += endpoint_rating["medium"]
+                            counts[2] += endpoint_rating["low"]
+                            counts[3] += endpoint_rating["ok"]
+
+        # These properties are the same for every displayed issue.
+        properties = {
+            "organization_id": i[5],
+            "organization_type": i[2],
+            "organization_name": i[1],
+            "organization_name_lowercase": i[1].lower(),
+            "organization_slug": slugify(i[1]),
+            "additional_keywords": extract_domains(calculation),
+            "data_from": when.isoformat(),
+            "total_urls": i[11],  # = 100%
+            "high_urls": i[12],
+            "medium_urls": i[13],
+            "low_urls": i[14],
+        }
+
+        geometry = {
+            # the coordinate ID makes it easy to check if the geometry has changed shape/location.
+            "coordinate_id": i[15],
+            "type": i[4],
+            # Sometimes the data is a string, sometimes it's a list. The admin
+            # interface might influence this. The fastest would be to use a string, instead of
+            # loading some json.
+            "coordinates": proper_coordinate(i[3], i[4]),
         }
 
         # calculate some statistics, so the frontends do not have to...
@@ -319,21 +319,38 @@ def get_map_data(
             high_urls = int(i[12])
             medium_urls = int(i[13])
             low_urls = int(i[14])
-            dataset["properties"]["percentages"] = {
+            properties["percentages"] = {
                 "high_urls": round(high_urls / total_urls, 2) * 100,
                 "medium_urls": round(medium_urls / total_urls, 2) * 100,
                 "low_urls": round(low_urls / total_urls, 2) * 100,
                 "good_urls": round((total_urls - (high_urls + medium_urls + low_urls)) / total_urls, 2) * 100,
             }
         else:
-            dataset["properties"]["percentages"] = {
+            properties["percentages"] = {
                 "high_urls": 0,
                 "medium_urls": 0,
                 "low_urls": 0,
                 "good_urls": 0,
             }
 
-        data["features"].append(dataset)
+        for displayed_issue, (high, medium, low, ok) in issue_counts.items():
+            # figure out if red, orange or green:
+            # #162, only make things red if there is a critical issue.
+            # removed json parsing of the calculation. This saves time.
+            # no contents, no endpoint ever mentioned in any url (which is a standard attribute)
+            if "total_urls" not in calculation["organization"] or not calculation["organization"]["total_urls"]:
+                severity = "unknown"
+            else:
+                # things have to be OK in order to be colored. If it's all empty... then it's not OK.
+                severity = "high" if high else "medium" if medium else "low" if low else "good" if ok else "unknown"
+
+            dataset = {
+                "type": "Feature",
+                "properties": {**properties, "high": high, "medium": medium, "low": low, "severity": severity},
+                "geometry": geometry,
+            }
+
+            data[displayed_issue]["features"].append(dataset)
 
     return data
 
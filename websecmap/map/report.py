@@ -1,22 +1,23 @@
 import calendar
 import logging
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from copy import deepcopy
 from datetime import date, datetime, timedelta
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import pytz
 import simplejson as json
 from celery import group
 from deepdiff import DeepDiff
-from django.db.models import Count
+from django.db import transaction
+from django.db.models import Count, Max
 
 from websecmap.celery import Task, app
-from websecmap.map.logic.map import get_map_data, get_reports_by_ids
+from websecmap.map.logic.map import get_map_data_per_issue, get_reports_by_ids
 from websecmap.map.logic.map_health import update_map_health_reports
 from websecmap.map.map_configs import filter_map_configs
 from websecmap.map.models import HighLevelStatistic, MapDataCache, OrganizationReport, VulnerabilityStatistic
-from websecmap.organizations.models import Organization, OrganizationType, Url
+from websecmap.organizations.models import Coordinate, Organization, OrganizationType, Url
 from websecmap.reporting.report import (
     START_DATE,
     aggegrate_url_rating_scores,
@@ -27,7 +28,7 @@ from websecmap.reporting.report import (
     significant_moments,
 )
 from websecmap.scanners import ENDPOINT_SCAN_TYPES, URL_SCAN_TYPES
-from websecmap.scanners.scanner.__init__ import q_configurations_to_report
+from websecmap.scanners.scanner.__init__ import chunks2, q_configurations_to_report
 
 log = logging.getLogger(__package__)
 
@@ -108,7 +109,10 @@ def compose_task(
 
         url_ids = [u.id for u in urls]
         # make sure default organization rating is in place
-        tasks.append(recreate_url_reports.si(url_ids) | create_organization_reports_now.si([organization.pk]))
+        # Only what happened after the latest url reports is added, a complete rebuild is done in rebuild_report.
+        tasks.append(
+            recreate_url_reports.si(url_ids, incremental=True) | create_organization_reports_now.si([organization.pk])
+        )
 
     if not tasks:
         log.error("Could not rebuild reports, filters resulted in no tasks created.")
@@ -153,314 +157,264 @@ def calculate_vulnerability_statistics(days: int = 366, countries: List = None,
     map_configurations = filter_map_configs(countries=countries, organization_types=organization_types)
 
     for map_configuration in map_configurations:
-        scan_types = set()  # set instead of list to prevent checking if something is in there already.
-        scan_types.add("total")  # the total would be separated per char if directly passed into set()
         organization_type_id = map_configuration["organization_type"]
         country = map_configuration["country"]
 
         # for the entire year, starting with oldest (in case the other tasks are not ready)
-        for days_back in list(reversed(range(0, days))):
-            measurement = {
-                "total": {
-                    "high": 0,
-                    "medium": 0,
-                    "low": 0,
-                    "ok_urls": 0,
-                    "ok_endpoints": 0,
-                    "applicable_endpoints": 0,
-                    "applicable_urls": 0,
-                }
-            }
-            when = datetime.now(pytz.utc) - timedelta(days=days_back)
-            log.info("Days back:%s Date: %s" % (days_back, when))
+        moments = [datetime.now(pytz.utc) - timedelta(days=days_back) for days_back in reversed(range(0, days))]
+        if not moments:
+            continue
 
-            # delete this specific moment as it's going to be replaced, so it's not really noticable an update is
-            # taking place.
+        statistics = vulnerability_statistics_over_time(country, organization_type_id, moments)
+
+        # Replace all days at once, so the graphs are never shown half way a rebuild.
+        with transaction.atomic():
             VulnerabilityStatistic.objects.all().filter(
-                at_when=when, country=country, organization_type=OrganizationType(pk=organization_type_id)
+                at_when__gte=moments[0],
+                at_when__lte=moments[-1],
+                country=country,
+                organization_type=OrganizationType(pk=organization_type_id),
             ).delete()
+            VulnerabilityStatistic.objects.bulk_create(statistics, batch_size=500)
 
-            # about 1 second per query, while it seems to use indexes.
-            # Also moved the calculation field here also from another table, which greatly improves joins on Mysql.
-            # see map_data for more info.
-
-            # this query removes the double urls (see below) and makes the joins straightforward. But it's way slower.
-            # In the end this would be the query we should use... but can't right now
-            # sql = """SELECT MAX(map_urlrating.id) as id, map_urlrating2.calculation FROM map_urlrating
-            #        INNER JOIN url ON map_urlrating.url_id = url.id
-            #        INNER JOIN url_organization on url.id = url_organization.url_id
-            #        INNER JOIN organization ON url_organization.organization_id = organization.id
-            #        INNER JOIN map_urlrating as map_urlrating2 ON map_urlrating2.id = map_urlrating.id
-            #         WHERE organization.type_id = '%(OrganizationTypeId)s'
-            #         AND organization.country = '%(country)s'
-            #         AND map_urlrating.`when` <= '%(when)s'
-            #         GROUP BY map_urlrating.url_id
-            #     """ % {"when": when, "OrganizationTypeId": get_organization_type(organization_type),
-            #            "country": get_country(country)}
-
-            # parse the query here instead of outside the function to save a second or so.
-            # The ID is included for convenience of the rawquery.
-            # This query will deliver double ratings for urls that are doubly listed, which is dubious.
-            # this happens because multiple organizations can have the same URL.
-            # It's fair that there are more issues if more organizations share the same url?
-
-            # you also have to include a filter on reagions that are not shown on the map anymore,
-            # those are mostly dead organizations... that's why this query works on map data...
-
-            # gets all url-ratings, even on urls that are dead / not relevant at a certain time period.
-            # this doesn't really work out it seems... as you dont know what url ratings are relevant when
-            sql = """SELECT reporting_urlreport.id as id, reporting_urlreport.id as my_id,
-                            reporting_urlreport.total_endpoints,
-                            reporting_urlreport2.calculation as calculation, url.id as url_id2
-                   FROM reporting_urlreport
-                   INNER JOIN
-                   (SELECT MAX(id) as id2 FROM reporting_urlreport or2
-                   WHERE at_when <= '%(when)s' GROUP BY url_id) as x
-                   ON x.id2 = reporting_urlreport.id
-                   INNER JOIN url ON reporting_urlreport.url_id = url.id
-                   INNER JOIN url_organization on url.id = url_organization.url_id
-                   INNER JOIN organization ON url_organization.organization_id = organization.id
-                   INNER JOIN reporting_urlreport as reporting_urlreport2
-                        ON reporting_urlreport2.id = reporting_urlreport.id
-                    WHERE organization.type_id = '%(OrganizationTypeId)s'
-                    AND organization.country = '%(country)s'
-                    AND reporting_urlreport.total_endpoints > 0
-                    ORDER BY reporting_urlreport.url_id
-                """ % {
-                "when": when,
-                "OrganizationTypeId": organization_type_id,
-                "country": country,
-            }
 
-            # There is a cartesian product on organization, for the simple reason that organizations sometimes
-            # use the same url. The filter on organization cannot be changed to left outer join, because it might
-            # remove relevant organizations.... it has to be a left outer join with the  WHERE filter included then.
-            # Left joining doesnt' solve it because the link of url_organization. We might get a random organization
-            # for the urlrating that fits it. But there should only be one organization per urlrating? No. Because
-            # url ratings are shared amongst organization. That's why it works on the map, but not here.
+def vulnerability_statistics_over_time(
+    country: str, organization_type_id: int, moments: List[datetime]
+) -> List[VulnerabilityStatistic]:
+    """
+    Sweeps forward through the moments, starting with the oldest. Every organization report is only retrieved and
+    parsed once: on the first moment it is the latest report of an organization that is shown on the map. The
+    measurement is carried over to the next moment, only the urls of organizations that changed are added and
+    subtracted.
 
-            # So we're doing something else: filter out the url_ratings we've already processed in the python
-            # code, which is slow and ugly. But for the moment it makes sense as the query is very complicated otherwise
+    Some urls are in multiple organizations, these are counted only once. The url of the organization report with the
+    lowest id is used. The amount of urls does include the doubles.
+    """
 
-            # so instead use the map data as a starter and dig down from that data.
+    organizations = list(
+        Organization.objects.all()
+        .filter(country=country, type_id=organization_type_id)
+        .values_list("id", "created_on", "is_dead", "is_dead_since")
+    )
 
-            sql = """
-                    SELECT
-                        map_organizationreport.id
-                    FROM map_organizationreport
-                    INNER JOIN
-
-
-                      (SELECT stacked_organization.id as stacked_organization_id
-                      FROM organization stacked_organization
-                      WHERE (
-                        stacked_organization.created_on <= '%(when)s'
-                        AND stacked_organization.is_dead = 0
-                        AND stacked_organization.type_id=%(OrganizationTypeId)s
-                        AND stacked_organization.country='%(country)s'
-                        )
-                      OR (
-                      '%(when)s' BETWEEN stacked_organization.created_on AND stacked_organization.is_dead_since
-                        AND stacked_organization.is_dead = 1
-                        AND stacked_organization.type_id=%(OrganizationTypeId)s
-                        AND stacked_organization.country='%(country)s'
-                      )) as organization_stack
-                      ON organization_stack.stacked_organization_id = map_organizationreport.organization_id
-
-
-                    INNER JOIN
-                      organization on organization.id = stacked_organization_id
-                    INNER JOIN
-                      organizations_organizationtype on organizations_organizationtype.id = organization.type_id
-                    INNER JOIN
-
-
-
-                      (SELECT MAX(stacked_coordinate.id) as stacked_coordinate_id, area, geoJsonType, organization_id
-                      FROM coordinate stacked_coordinate
-                      INNER JOIN organization filter_organization
-                        ON (stacked_coordinate.organization_id = filter_organization.id)
-                      WHERE (
-                        stacked_coordinate.created_on <= '%(when)s'
-                        AND stacked_coordinate.is_dead = 0
-                        AND filter_organization.country='%(country)s'
-                        AND filter_organization.type_id=%(OrganizationTypeId)s
-                        )
-                      OR
-                        ('%(when)s' BETWEEN stacked_coordinate.created_on AND stacked_coordinate.is_dead_since
-                        AND stacked_coordinate.is_dead = 1
-                        AND filter_organization.country='%(country)s'
-                        AND filter_organization.type_id=%(OrganizationTypeId)s
-                        ) GROUP BY calculated_area_hash, organization_id
-                      ) as coordinate_stack
-                      ON coordinate_stack.organization_id = map_organizationreport.organization_id
+    regions = defaultdict(list)
+    for organization_id, created_on, is_dead, is_dead_since in (
+        Coordinate.objects.all()
+        .filter(organization__country=country, organization__type_id=organization_type_id)
+        .values_list("organization_id", "created_on", "is_dead", "is_dead_since")
+    ):
+        regions[organization_id].append((created_on, is_dead, is_dead_since))
+
+    # organization id: id of the latest report of the organization
+    latest_reports = {}
+    # organization id: id of the report that is counted in the measurement
+    counted_reports = {}
+    # report id: (amount of urls, {url: (amount of endpoints, measurement of the url)})
+    report_urls = {}
+    # url: {report id: (amount of endpoints, measurement of the url in that report)}
+    url_versions = defaultdict(dict)
+
+    measurement = {"total": empty_vulnerability_measurement()}
+    number_of_urls = 0
+    number_of_endpoints = 0
+
+    statistics = []
+    previous_when = None
+    for when in moments:
+        log.info("Date: %s" % when)
+
+        # The latest report is the one with the highest id, as reports are added in chronological order.
+        new_reports = OrganizationReport.objects.all().filter(
+            organization__country=country, organization__type_id=organization_type_id, at_when__lte=when
+        )
+        if previous_when:
+            new_reports = new_reports.filter(at_when__gt=previous_when)
+        for organization_id, report_id in (
+            new_reports.order_by()
+            .values("organization_id")
+            .annotate(latest=Max("id"))
+            .values_list("organization_id", "latest")
+        ):
+            latest_reports[organization_id] = max(report_id, latest_reports.get(organization_id, 0))
+        previous_when = when
+
+        # Only organizations that are shown on the map at this moment are counted.
+        shown_reports = {
+            organization_id: latest_reports[organization_id]
+            for organization_id, created_on, is_dead, is_dead_since in organizations
+            if organization_id in latest_reports
+            and alive_at(when, created_on, is_dead, is_dead_since)
+            and any(alive_at(when, *region) for region in regions[organization_id])
+        }
+
+        needed_reports = [str(report_id) for report_id in shown_reports.values() if report_id not in report_urls]
+        for report_ids in chunks2(needed_reports, 500):
+            for report_id, calculation in get_reports_by_ids(report_ids).items():
+                report_urls[report_id] = url_vulnerability_measurements(json.loads(calculation))
+
+        for organization_id in set(counted_reports) | set(shown_reports):
+            counted_report = counted_reports.get(organization_id, None)
+            shown_report = shown_reports.get(organization_id, None)
+            if counted_report == shown_report:
+                continue
+
+            changed_urls = set()
+            if counted_report:
+                amount_of_urls, urls = report_urls.pop(counted_report)
+                number_of_urls -= amount_of_urls
+                changed_urls.update(urls.keys())
+            if shown_report:
+                amount_of_urls, urls = report_urls[shown_report]
+                number_of_urls += amount_of_urls
+                changed_urls.update(urls.keys())
+
+            for url in changed_urls:
+                # subtract the version of the url that was counted, and add the version that is counted now.
+                versions = url_versions[url]
+                if versions:
+                    endpoints, url_measurement = versions[min(versions)]
+                    number_of_endpoints -= endpoints
+                    add_vulnerability_measurement(measurement, url_measurement, -1)
+
+                versions.pop(counted_report, None)
+                if shown_report and url in report_urls[shown_report][1]:
+                    versions[shown_report] = report_urls[shown_report][1][url]
+
+                if versions:
+                    endpoints, url_measurement = versions[min(versions)]
+                    number_of_endpoints += endpoints
+                    add_vulnerability_measurement(measurement, url_measurement, 1)
+                else:
+                    del url_versions[url]
+
+            if shown_report:
+                counted_reports[organization_id] = shown_report
+            else:
+                del counted_reports[organization_id]
+
+        # store these results per scan type, and only retrieve this per scan type...
+        for scan_type in measurement:
+            # scan types that are not rated anymore are not stored, just as types that never have been rated.
+            if scan_type != "total" and not (
+                measurement[scan_type]["applicable_urls"] or measurement[scan_type]["applicable_endpoints"]
+            ):
+                continue
+
+            vs = VulnerabilityStatistic()
+            vs.at_when = when
+            vs.organization_type = OrganizationType(pk=organization_type_id)
+            vs.country = country
+            vs.scan_type = scan_type
+            vs.high = measurement[scan_type]["high"]
+            vs.medium = measurement[scan_type]["medium"]
+            vs.low = measurement[scan_type]["low"]
+            vs.ok_urls = measurement[scan_type]["ok_urls"]
+            vs.ok_endpoints = measurement[scan_type]["ok_endpoints"]
+
+            if scan_type in PUBLISHED_SCAN_TYPES:
+                vs.urls = measurement[scan_type]["applicable_urls"]
+                vs.endpoints = measurement[scan_type]["applicable_endpoints"]
+            else:
+                # total
+                vs.urls = number_of_urls
+                vs.endpoints = number_of_endpoints
+
+            if scan_type in ENDPOINT_SCAN_TYPES:
+                vs.ok = measurement[scan_type]["ok_endpoints"]
+            elif scan_type in URL_SCAN_TYPES:
+                vs.ok = measurement[scan_type]["ok_urls"]
+            else:
+                # total: everything together.
+                vs.ok = measurement[scan_type]["ok_urls"] + measurement[scan_type]["ok_endpoints"]
 
+            statistics.append(vs)
 
-                    INNER JOIN
+    return statistics
 
 
-                      (SELECT MAX(map_organizationreport.id) as stacked_organizationrating_id
-                      FROM map_organizationreport
-                      INNER JOIN organization filter_organization2
-                        ON (filter_organization2.id = map_organizationreport.organization_id)
-                      WHERE at_when <= '%(when)s'
-                      AND filter_organization2.country='%(country)s'
-                      AND filter_organization2.type_id=%(OrganizationTypeId)s
-                      GROUP BY organization_id
-                      ) as stacked_organizationrating
-                      ON stacked_organizationrating.stacked_organizationrating_id = map_organizationreport.id
+def alive_at(when: datetime, created_on: datetime, is_dead: bool, is_dead_since: datetime) -> bool:
+    # The stacking is_dead pattern, for organizations and coordinates.
+    if not created_on or created_on > when:
+        return False
 
-                    WHERE organization.type_id = '%(OrganizationTypeId)s' AND organization.country= '%(country)s'
-                    GROUP BY coordinate_stack.area, organization.name
-                    ORDER BY map_organizationreport.at_when ASC
-                    """ % {
-                "when": when,
-                "OrganizationTypeId": organization_type_id,
-                "country": country,
-            }
+    if not is_dead:
+        return True
 
-            organizationratings = OrganizationReport.objects.raw(sql)
+    return bool(is_dead_since) and when <= is_dead_since
 
-            needed_reports = []
-            for organizationrating in organizationratings:
-                needed_reports.append(str(organizationrating.pk))
 
-            reports = get_reports_by_ids(needed_reports)
+def empty_vulnerability_measurement() -> Dict[str, int]:
+    return {
+        "high": 0,
+        "medium": 0,
+        "low": 0,
+        "ok_urls": 0,
+        "ok_endpoints": 0,
+        "applicable_endpoints": 0,
+        "applicable_urls": 0,
+    }
 
-            direct_reports = []
-            for report in reports:
-                direct_reports.append(json.loads(reports[report]))
 
-            number_of_endpoints = 0
-            number_of_urls = 0
-            # log.debug(sql)
+def add_vulnerability_measurement(measurement, addition, sign: int):
+    for scan_type, values in addition.items():
+        if scan_type not in measurement:
+            measurement[scan_type] = empty_vulnerability_measurement()
+        for key, value in values.items():
+            measurement[scan_type][key] += sign * value
 
-            # some urls are in multiple organizaitons, make sure that it's only shown once.
-            processed_urls = []
 
-            for direct_report in direct_reports:
+def url_vulnerability_measurements(organization_report) -> Tuple[int, Dict[str, Tuple[int, Dict]]]:
+    """
+    The amount of urls in an organization report, and the amount of endpoints and measurement per scan type of each
+    url in that report.
+    """
+
+    urlratings = organization_report["organization"].get("urls", [])
 
-                # log.debug("Processing rating of %s " %
-                #     organizationrating.calculation["organization"].get("name", "UNKOWN"))
+    urls = {}
+    for urlrating in urlratings:
+        # prevent the same urls counting double or more...
+        if urlrating["url"] in urls:
+            continue
 
-                urlratings = direct_report["organization"].get("urls", [])
+        measurement = {"total": empty_vulnerability_measurement()}
 
-                number_of_urls += len(urlratings)
+        # url reports
+        for rating in urlrating["ratings"]:
+            if rating["type"] not in measurement:
+                measurement[rating["type"]] = empty_vulnerability_measurement()
 
-                # group by vulnerability type
-                for urlrating in urlratings:
+            measurement[rating["type"]]["high"] += rating["high"]
+            measurement[rating["type"]]["medium"] += rating["medium"]
+            measurement[rating["type"]]["low"] += rating["low"]
+            measurement[rating["type"]]["ok_urls"] += rating["ok"]
+            measurement[rating["type"]]["applicable_urls"] += 1
 
-                    # prevent the same urls counting double or more...
-                    if urlrating["url"] in processed_urls:
-                        # log.debug("Removed url because it's already in the report: %s" % urlrating["url"])
-                        continue
+            measurement["total"]["high"] += rating["high"]
+            measurement["total"]["medium"] += rating["medium"]
+            measurement["total"]["low"] += rating["low"]
+            measurement["total"]["ok_urls"] += rating["ok"]
 
-                    processed_urls.append(urlrating["url"])
-
-                    # log.debug("Url: %s" % (urlrating["url"]))
-
-                    number_of_endpoints += len(urlrating["endpoints"])
-
-                    # print(connection.queries)
-                    # exit()
-
-                    # www.kindpakket.groningen.nl is missing
-                    # url reports
-                    for rating in urlrating["ratings"]:
-
-                        # log.debug("- type: %s H: %s, M: %s, L: %s" %
-                        #     (rating['type'], rating['high'], rating['medium'], rating['low']))
-
-                        if rating["type"] not in measurement:
-                            measurement[rating["type"]] = {
-                                "high": 0,
-                                "medium": 0,
-                                "low": 0,
-                                "ok_urls": 0,
-                                "ok_endpoints": 0,
-                                "applicable_endpoints": 0,
-                                "applicable_urls": 0,
-                            }
-
-                        # if rating['type'] not in scan_types:
-                        scan_types.add(rating["type"])
-
-                        measurement[rating["type"]]["high"] += rating["high"]
-                        measurement[rating["type"]]["medium"] += rating["medium"]
-                        measurement[rating["type"]]["low"] += rating["low"]
-                        measurement[rating["type"]]["ok_urls"] += rating["ok"]
-                        measurement[rating["type"]]["applicable_urls"] += 1
-
-                        measurement["total"]["high"] += rating["high"]
-                        measurement["total"]["medium"] += rating["medium"]
-                        measurement["total"]["low"] += rating["low"]
-                        measurement["total"]["ok_urls"] += rating["ok"]
-
-                    # endpoint reports
-                    for endpoint in urlrating["endpoints"]:
-
-                        for rating in endpoint["ratings"]:
-                            if rating["type"] not in measurement:
-                                measurement[rating["type"]] = {
-                                    "high": 0,
-                                    "medium": 0,
-                                    "low": 0,
-                                    "ok_urls": 0,
-                                    "ok_endpoints": 0,
-                                    "applicable_endpoints": 0,
-                                    "applicable_urls": 0,
-                                }
-
-                            # debugging, perhaps it appears that the latest scan is not set properly
-                            # if rating['type'] == 'ftp' and rating['high']:
-                            #     log.debug("High ftp added for %s" % urlrating["url"])
-
-                            # if rating['type'] not in scan_types:
-                            scan_types.add(rating["type"])
-
-                            measurement[rating["type"]]["high"] += rating["high"]
-                            measurement[rating["type"]]["medium"] += rating["medium"]
-                            measurement[rating["type"]]["low"] += rating["low"]
-                            measurement[rating["type"]]["ok_endpoints"] += rating["ok"]
-                            measurement[rating["type"]]["applicable_endpoints"] += 1
-
-                            measurement["total"]["high"] += rating["high"]
-                            measurement["total"]["medium"] += rating["medium"]
-                            measurement["total"]["low"] += rating["low"]
-                            measurement["total"]["ok_endpoints"] += rating["ok"]
-
-            # store these results per scan type, and only retrieve this per scan type...
-            for scan_type in scan_types:
-                # log.debug(scan_type)
-                if scan_type in measurement:
-                    vs = VulnerabilityStatistic()
-                    vs.at_when = when
-                    vs.organization_type = OrganizationType(pk=organization_type_id)
-                    vs.country = country
-                    vs.scan_type = scan_type
-                    vs.high = measurement[scan_type]["high"]
-                    vs.medium = measurement[scan_type]["medium"]
-                    vs.low = measurement[scan_type]["low"]
-                    vs.ok_urls = measurement[scan_type]["ok_urls"]
-                    vs.ok_endpoints = measurement[scan_type]["ok_endpoints"]
-
-                    if scan_type in PUBLISHED_SCAN_TYPES:
-                        vs.urls = measurement[scan_type]["applicable_urls"]
-                        vs.endpoints = measurement[scan_type]["applicable_endpoints"]
-                    else:
-                        # total
-                        vs.urls = number_of_urls
-                        vs.endpoints = number_of_endpoints
-
-                    if scan_type in ENDPOINT_SCAN_TYPES:
-                        vs.ok = measurement[scan_type]["ok_endpoints"]
-                    elif scan_type in URL_SCAN_TYPES:
-                        vs.ok = measurement[scan_type]["ok_urls"]
-                    else:
-                        # total: everything together.
-                        vs.ok = measurement[scan_type]["ok_urls"] + measurement[scan_type]["ok_endpoints"]
-
-                    vs.save()
+        # endpoint reports
+        for endpoint in urlrating["endpoints"]:
+            for rating in endpoint["ratings"]:
+                if rating["type"] not in measurement:
+                    measurement[rating["type"]] = empty_vulnerability_measurement()
+
+                measurement[rating["type"]]["high"] += rating["high"]
+                measurement[rating["type"]]["medium"] += rating["medium"]
+                measurement[rating["type"]]["low"] += rating["low"]
+                measurement[rating["type"]]["ok_endpoints"] += rating["ok"]
+                measurement[rating["type"]]["applicable_endpoints"] += 1
+
+                measurement["total"]["high"] += rating["high"]
+                measurement["total"]["medium"] += rating["medium"]
+                measurement["total"]["low"] += rating["low"]
+                measurement["total"]["ok_endpoints"] += rating["ok"]
+
+        urls[urlrating["url"]] = (len(urlrating["endpoints"]), measurement)
+
+    return len(urlratings), urls
 
 
 @app.task(queue="reporting")
@@ -482,41 +436,46 @@ def calculate_map_data(days: int = 366, countries: List = None, organization_typ
     for map_configuration in map_configurations:
         for days_back in list(reversed(range(0, days))):
             when = datetime.now(pytz.utc) - timedelta(days=days_back)
-            for scan_type in scan_types:
 
-                # You can expect something to change each day. Therefore just store the map data each day.
-                MapDataCache.objects.all().filter(
-                    at_when=when,
-                    country=map_configuration["country"],
-                    organization_type=OrganizationType(pk=map_configuration["organization_type"]),
-                    filters=[scan_type],
-                ).delete()
-
-                log.debug(
-                    "Country: %s, Organization_type: %s, day: %s, date: %s, filter: %s"
-                    % (
-                        map_configuration["country"],
-                        map_configuration["organization_type__name"],
-                        days_back,
-                        when,
-                        scan_type,
-                    )
-                )
-                data = get_map_data(
-                    map_configuration["country"], map_configuration["organization_type__name"], days_back, scan_type
+            log.debug(
+                "Country: %s, Organization_type: %s, day: %s, date: %s"
+                % (
+                    map_configuration["country"],
+                    map_configuration["organization_type__name"],
+                    days_back,
+                    when,
                 )
+            )
+
+            # The map data of all filters is made at once, which retrieves and parses the reports only once.
+            datasets = get_map_data_per_issue(
+                map_configuration["country"], map_configuration["organization_type__name"], days_back, scan_types
+            )
 
-                try:
-                    cached = MapDataCache()
-                    cached.organization_type = OrganizationType(pk=map_configuration["organization_type"])
-                    cached.country = map_configuration["country"]
-                    cached.filters = [scan_type]
-                    cached.at_when = when
-                    cached.dataset = data
-                    cached.save()
-                except OperationalError as a:
-                    # The public user does not have permission to run insert statements....
-                    log.exception(a)
+            cached_datasets = []
+            for scan_type in scan_types:
+                cached = MapDataCache()
+                cached.organization_type = OrganizationType(pk=map_configuration["organization_type"])
+                cached.country = map_configuration["country"]
+                cached.filters = [scan_type]
+                cached.at_when = when
+                cached.dataset = datasets[scan_type]
+                cached_datasets.append(cached)
+
+            try:
+                with transaction.atomic():
+                    # You can expect something to change each day. Therefore just store the map data each day.
+                    MapDataCache.objects.all().filter(
+                        at_when=when,
+                        country=map_configuration["country"],
+                        organization_type=OrganizationType(pk=map_configuration["organization_type"]),
+                        filters__in=[[scan_type] for scan_type in scan_types],
+                    ).delete()
+
+                    MapDataCache.objects.bulk_create(cached_datasets)
+            except OperationalError as a:
+                # The public user does not have permission to run insert statements....
+                log.exception(a)
 
 
 @app.task(queue="reporting")
@@ -1054,7 +1013,9 @@ def update_report_tasks(url_chunk: List[int]):
         # Note that you cannot determine the moment to be "now" as the urls have to be re-reated.
         # the moment to rerate organizations is when the url_ratings has finished.
 
-        tasks.append(recreate_url_reports.si([url]) | create_organization_reports_now.si(organizations))
+        tasks.append(
+            recreate_url_reports.si([url], incremental=True) | create_organization_reports_now.si(organizations)
+        )
 
         # Calculating statistics is _extremely slow_ so we're not doing that in this method to keep the pace.
         # Otherwise you'd have a 1000 statistic rebuilds pending, all doing a marginal job.
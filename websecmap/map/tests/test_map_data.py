@@ -4,8 +4,9 @@ import pytz
 from dateutil.relativedelta import relativedelta
 
 from websecmap.map.logic.map import get_map_data, get_cached_map_data
-from websecmap.map.models import MapDataCache
-from websecmap.organizations.models import OrganizationType
+from websecmap.map.models import Configuration, MapDataCache, OrganizationReport
+from websecmap.map.report import PUBLISHED_SCAN_TYPES, calculate_map_data
+from websecmap.organizations.models import Coordinate, Organization, OrganizationType
 
 
 def test_get_cached_map_data(db):
@@ -26,3 +27,59 @@ def test_get_cached_map_data(db):
 
     assert get_map_data(country="NL", organization_type="test", days_back=8) == expected_result
     assert get_cached_map_data(country="NL", organization_type="test", days_back=8) == expected_result
+
+
+def test_calculate_map_data(db):
+    organization_type, created = OrganizationType.objects.all().get_or_create(name="municipality")
+    Configuration.objects.all().create(country="NL", organization_type=organization_type, is_reported=True)
+    organization = Organization.objects.all().create(
+        name="Test", country="NL", type=organization_type, created_on=datetime(2020, 1, 1, tzinfo=pytz.utc)
+    )
+    Coordinate.objects.all().create(
+        organization=organization,
+        geojsontype="Point",
+        area=[4.0, 52.0],
+        calculated_area_hash="point",
+        created_on=datetime(2020, 1, 1, tzinfo=pytz.utc),
+    )
+
+    def rating(scan_type, high, medium):
+        return {"type": scan_type, "high": high, "medium": medium, "low": 0, "ok": int(not high and not medium)}
+
+    OrganizationReport.objects.all().create(
+        organization=organization,
+        at_when=datetime.now(pytz.utc) - relativedelta(days=1),
+        total_urls=1,
+        calculation={
+            "organization": {
+                "total_urls": 1,
+                "urls": [
+                    {
+                        "url": "example.nl",
+                        "ratings": [rating("DNSSEC", 0, 0)],
+                        "endpoints": [{"ratings": [rating("ftp", 0, 1), rating("plain_https", 1, 0)]}],
+                    }
+                ],
+            }
+        },
+    )
+
+    # running it twice replaces the map data of today
+    calculate_map_data(1)
+    calculate_map_data(1)
+    assert MapDataCache.objects.all().count() == len(PUBLISHED_SCAN_TYPES) + 1
+
+    def feature(displayed_issue):
+        properties = get_map_data("NL", "municipality", 0, displayed_issue)["features"][0]["properties"]
+        return properties["high"], properties["medium"], properties["low"], properties["severity"]
+
+    assert feature("all") == (1, 1, 0, "high")
+    assert feature("DNSSEC") == (0, 0, 0, "good")
+    assert feature("ftp") == (0, 1, 0, "medium")
+    assert feature("plain_https") == (1, 0, 0, "high")
+    assert feature("tls_qualys_encryption_quality") == (0, 0, 0, "unknown")
+
+    # the same as the map data that is not cached
+    MapDataCache.objects.all().delete()
+    assert feature("ftp") == (0, 1, 0, "medium")
+    assert get_map_data("NL", "municipality", 0, "ftp")["features"][0]["geometry"]["coordinates"] == [52.0, 4.0]
@@ -0,0 +1,108 @@
+from datetime import datetime
+
+import pytz
+from freezegun import freeze_time
+
+from websecmap.map.models import Configuration, OrganizationReport, VulnerabilityStatistic
+from websecmap.map.report import calculate_vulnerability_statistics
+from websecmap.organizations.models import Coordinate, Organization, OrganizationType
+
+
+def url_rating(url, dnssec_high, endpoint_ratings):
+    return {
+        "url": url,
+        "ratings": [{"type": "DNSSEC", "high": dnssec_high, "medium": 0, "low": 0, "ok": 1 - dnssec_high}],
+        "endpoints": [
+            {"ratings": [{"type": scan_type, "high": high, "medium": 0, "low": 0, "ok": 1 - high}]}
+            for scan_type, high in endpoint_ratings
+        ],
+    }
+
+
+def add_organization_report(organization, at_when, urls):
+    OrganizationReport.objects.all().create(
+        organization=organization, at_when=at_when, calculation={"organization": {"urls": urls}}
+    )
+
+
+def statistics():
+    return sorted(
+        (
+            str(statistic.at_when),
+            statistic.scan_type,
+            statistic.high,
+            statistic.medium,
+            statistic.low,
+            statistic.urls,
+            statistic.endpoints,
+            statistic.ok,
+            statistic.ok_urls,
+            statistic.ok_endpoints,
+        )
+        for statistic in VulnerabilityStatistic.objects.all()
+    )
+
+
+def test_calculate_vulnerability_statistics(db):
+    day_0 = datetime(2020, 1, 1, tzinfo=pytz.utc)
+    day_1 = datetime(2020, 1, 2, 6, tzinfo=pytz.utc)
+    day_2 = datetime(2020, 1, 3, 12, tzinfo=pytz.utc)
+    day_3 = datetime(2020, 1, 4, 12, tzinfo=pytz.utc)
+
+    organization_type = OrganizationType.objects.all().create(name="municipality")
+    Configuration.objects.all().create(country="NL", organization_type=organization_type, is_reported=True)
+
+    first = Organization.objects.all().create(name="first", country="NL", type=organization_type, created_on=day_0)
+    second = Organization.objects.all().create(name="second", country="NL", type=organization_type, created_on=day_0)
+    # this organization is dead from day 2 on, and is not counted anymore from then.
+    dead = Organization.objects.all().create(
+        name="dead",
+        country="NL",
+        type=organization_type,
+        created_on=day_0,
+        is_dead=True,
+        is_dead_since=datetime(2020, 1, 3, tzinfo=pytz.utc),
+    )
+    # organizations without a region on the map are not counted.
+    Organization.objects.all().create(name="no region", country="NL", type=organization_type, created_on=day_0)
+    for organization in [first, second, dead]:
+        Coordinate.objects.all().create(
+            organization=organization,
+            area=[organization.name],
+            calculated_area_hash=organization.name,
+            created_on=day_0,
+        )
+
+    shared_url = url_rating("shared.nl", 1, [("plain_https", 0)])
+    add_organization_report(first, day_0, [url_rating("first.nl", 0, [("ftp", 1)]), shared_url])
+    add_organization_report(second, day_0, [shared_url])
+    add_organization_report(dead, day_0, [url_rating("dead.nl", 1, [("ftp", 1), ("plain_https", 1)])])
+
+    # first fixes the ftp issue, the shared url stays the same.
+    add_organization_report(first, day_1, [url_rating("first.nl", 0, [("ftp", 0)]), shared_url])
+    # a report that is made after the last day is not used.
+    add_organization_report(second, day_3, [])
+
+    # there are statistics of an earlier run that have to be replaced.
+    VulnerabilityStatistic.objects.all().create(
+        country="NL", organization_type=organization_type, at_when=day_1, scan_type="total", high=100
+    )
+
+    with freeze_time(day_2):
+        calculate_vulnerability_statistics(3)
+
+    # the shared url is counted only once, the amount of urls also counts the doubles.
+    assert statistics() == [
+        ("2020-01-01", "DNSSEC", 2, 0, 0, 3, 0, 1, 1, 0),
+        ("2020-01-01", "ftp", 2, 0, 0, 0, 2, 0, 0, 0),
+        ("2020-01-01", "plain_https", 1, 0, 0, 0, 2, 1, 0, 1),
+        ("2020-01-01", "total", 5, 0, 0, 4, 4, 2, 1, 1),
+        ("2020-01-02", "DNSSEC", 2, 0, 0, 3, 0, 1, 1, 0),
+        ("2020-01-02", "ftp", 1, 0, 0, 0, 2, 1, 0, 1),
+        ("2020-01-02", "plain_https", 1, 0, 0, 0, 2, 1, 0, 1),
+        ("2020-01-02", "total", 4, 0, 0, 4, 4, 3, 1, 2),
+        ("2020-01-03", "DNSSEC", 1, 0, 0, 2, 0, 1, 1, 0),
+        ("2020-01-03", "ftp", 0, 0, 0, 0, 1, 1, 0, 1),
+        ("2020-01-03", "plain_https", 0, 0, 0, 0, 1, 1, 0, 1),
+        ("2020-01-03", "total", 1, 0, 0, 3, 2, 3, 1, 2),
+    ]
@@ -0,0 +1,115 @@
+# Generated by Django 3.1.6 on 2026-10-18 20:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def statistics_of_calculation(calculation):
+    statistics = {"total": {"high": 0, "medium": 0, "low": 0, "ok": 0, "ratings": 0}}
+
+    ratings = list(calculation.get("ratings", []))
+    for endpoint in calculation.get("endpoints", []):
+        ratings += endpoint.get("ratings", [])
+
+    for rating in ratings:
+        for scan_type in ["total", rating["type"]]:
+            if scan_type not in statistics:
+                statistics[scan_type] = {"high": 0, "medium": 0, "low": 0, "ok": 0, "ratings": 0}
+            statistics[scan_type]["high"] += rating["high"]
+            statistics[scan_type]["medium"] += rating["medium"]
+            statistics[scan_type]["low"] += rating["low"]
+            statistics[scan_type]["ok"] += rating["ok"]
+            statistics[scan_type]["ratings"] += 1
+
+    return statistics
+
+
+def fill_url_report_scan_type_statistics(apps, schema_editor):
+    """
+    Adds statistics for all existing url reports. Reports are processed per url in chronological order, so the
+    previous report of an url is superseded by the next one.
+    """
+    UrlReport = apps.get_model("reporting", "UrlReport")
+    UrlReportScanTypeStatistic = apps.get_model("reporting", "UrlReportScanTypeStatistic")
+
+    rows = []
+    previous_rows = []
+    previous_url_id = None
+
+    reports = UrlReport.objects.all().only("id", "url_id", "at_when", "calculation").order_by("url_id", "at_when", "id")
+    for report in reports.iterator():
+        if report.url_id == previous_url_id:
+            for row in previous_rows:
+                row.superseded_on = report.at_when
+        rows += previous_rows
+
+        previous_rows = [
+            UrlReportScanTypeStatistic(
+                url_report_id=report.id, url_id=report.url_id, at_when=report.at_when, scan_type=scan_type, **values
+            )
+            for scan_type, values in statistics_of_calculation(report.calculation).items()
+        ]
+        previous_url_id = report.url_id
+
+        if len(rows) > 1000:
+            UrlReportScanTypeStatistic.objects.bulk_create(rows)
+            rows = []
+
+    UrlReportScanTypeStatistic.objects.bulk_create(rows + previous_rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("organizations", "0060_auto_20200908_1055"),
+        ("reporting", "0010_urlreport_is_the_newest"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UrlReportScanTypeStatistic",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("at_when", models.DateTimeField(db_index=True, help_text="Copied from the url report.")),
+                (
+                    "superseded_on",
+                    models.DateTimeField(
+                        blank=True,
+                        db_index=True,
+                        help_text="The moment a newer report of this url was made. Empty for the newest report of the url.",
+                        null=True,
+                    ),
+                ),
+                ("scan_type", models.CharField(db_index=True, help_text="A scan type or 'total'.", max_length=255)),
+                ("high", models.IntegerField(default=0)),
+                ("medium", models.IntegerField(default=0)),
+                ("low", models.IntegerField(default=0)),
+                ("ok", models.IntegerField(default=0)),
+                (
+                    "ratings",
+                    models.IntegerField(
+                        default=0,
+                        help_text="The number of ratings of this scan type in the report. Endpoint scan types can be rated once per endpoint.",
+                    ),
+                ),
+                (
+                    "url",
+                    models.ForeignKey(
+                        help_text="Copied from the url report for faster joins.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="organizations.url",
+                    ),
+                ),
+                (
+                    "url_report",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="reporting.urlreport"),
+                ),
+            ],
+            options={
+                "verbose_name": "Url report scan type statistic",
+                "verbose_name_plural": "Url report scan type statistics",
+                "managed": True,
+            },
+        ),
+        migrations.RunPython(fill_url_report_scan_type_statistics, migrations.RunPython.noop),
+    ]
@@ -323,4 +323,48 @@ class UrlReport(
         )
 
 
+class UrlReportScanTypeStatistic(models.Model):
+    """
+    The high, medium, low and ok counts per scan type of a url report. This allows retrieving and aggregating the
+    latest url reports at any moment with plain SQL, instead of finding the latest report per url and loading its
+    (huge) calculation.
+
+    Each url report has a "total" row, also when it has no ratings at all. The latest report of a url at a certain
+    moment is the report where at_when <= moment and superseded_on is empty or after that moment.
+
+    These rows are written when a url report is saved, see reporting.report.save_url_report.
+    """
+
+    url_report = models.ForeignKey(UrlReport, on_delete=models.CASCADE)
+
+    url = models.ForeignKey(Url, on_delete=models.CASCADE, help_text="Copied from the url report for faster joins.")
+
+    at_when = models.DateTimeField(db_index=True, help_text="Copied from the url report.")
+
+    superseded_on = models.DateTimeField(
+        db_index=True,
+        null=True,
+        blank=True,
+        help_text="The moment a newer report of this url was made. Empty for the newest report of the url.",
+    )
+
+    scan_type = models.CharField(max_length=255, db_index=True, help_text="A scan type or 'total'.")
+
+    high = models.IntegerField(default=0)
+    medium = models.IntegerField(default=0)
+    low = models.IntegerField(default=0)
+    ok = models.IntegerField(default=0)
+
+    ratings = models.IntegerField(
+        default=0,
+        help_text="The number of ratings of this scan type in the report. Endpoint scan types can be rated once per "
+        "endpoint.",
+    )
+
+    class Meta:
+        managed = True
+        verbose_name = _("Url report scan type statistic")
+        verbose_name_plural = _("Url report scan type statistics")
+
+
 # todo: we can make a vulnerabilitystatistic per organization type or per tag. But not per country, list etc.
@@ -2,7 +2,7 @@ import logging
 from collections import defaultdict
 from copy import copy, deepcopy
 from datetime import datetime
-from typing import List
+from typing import Dict, List
 
 import pytz
 from django.db.models import Q
@@ -10,16 +10,21 @@ from django.db.models import Q
 from websecmap.app.constance import constance_cached_value
 from websecmap.celery import app
 from websecmap.organizations.models import Url
-from websecmap.reporting.models import UrlReport
+from websecmap.reporting.models import UrlReport, UrlReportScanTypeStatistic
 from websecmap.reporting.severity import get_severity
 from websecmap.scanners import ALL_SCAN_TYPES, ENDPOINT_SCAN_TYPES, URL_SCAN_TYPES
 from websecmap.scanners.models import Endpoint, EndpointGenericScan, UrlGenericScan
+from websecmap.scanners.scanner.__init__ import chunks2
 
 log = logging.getLogger(__package__)
 
 
 START_DATE = datetime(year=2016, month=1, day=1, hour=13, minute=37, second=42, tzinfo=pytz.utc)
 
+# The amount of urls of which the timeline is created at the same time. The amount of variables in a query is limited
+# in sqlite (SQLITE_LIMIT_VARIABLE_NUMBER, 999 by default). The scan types that are reported are also variables.
+TIMELINE_CHUNK_SIZE = 500
+
 """
 Warning: Make sure the output of a rebuild has ID's in chronological order.
 
@@ -44,24 +49,169 @@ def get_allowed_to_report():
 
 
 @app.task(queue="reporting")
-def recreate_url_reports(urls: List[int]):
-    """Remove the rating of one url and rebuild anew."""
+def recreate_url_reports(urls: List[int], incremental: bool = False):
+    """
+    Remove the rating of one url and rebuild anew.
+
+    :param urls: list of url ids
+    :param incremental: only add reports for what happened after the latest report, see update_url_report.
+    """
+
+    if incremental:
+        for url_id in urls:
+            url = Url.objects.all().filter(id=url_id).only("id").first()
+            if not url:
+                continue
+
+            update_url_report(url)
+        return
+
+    # Creating timelines for a series of urls at the same time saves a lot of queries.
+    for chunk in chunks2(list(urls), TIMELINE_CHUNK_SIZE):
+        rebuild_url_reports(chunk)
+
+
+def rebuild_url_reports(urls: List[int]):
+    urls = list(Url.objects.all().filter(id__in=urls).only("id", "url"))
+    if not urls:
+        return
+
+    # Delete the ratings for these urls, they are going to be rebuilt
+    UrlReport.objects.all().filter(url__in=urls).delete()
+
+    # Creating a timeline and rating it is much faster than doing an individual calculation.
+    # Mainly because it gets all data in just a few queries and then builds upon that.
+    timelines = create_timelines(urls)
+    for url in urls:
+        create_url_report(timelines[url.id], url)
+
+
+def update_url_report(url: Url):
+    """
+    Adds reports for everything that happened after the latest report, instead of replaying all history since
+    START_DATE. Most urls have years of unchanged history and only a single new scan, so this is much faster.
+
+    The newest report is always rebuilt: it is based on the report before it. This makes sure the newest report
+    contains the current last_scan_moment of all scans, which is used when planning new scans.
+
+    If the state of the report before the newest one cannot be reconstructed, a complete rebuild is performed.
+    This is the case for urls with less than two reports, dead or non-resolvable urls and reports containing
+    repeated findings (which do not refer to a scan).
+    """
+
+    url = Url.objects.all().filter(id=url.id).first()
+    if not url:
+        return
+
+    # A dead or not resolvable url ends the report with an empty rating. Keep this simple and correct.
+    if url.is_dead or url.not_resolvable:
+        return rebuild_url_reports([url.id])
+
+    reports = list(UrlReport.objects.all().filter(url=url).order_by("-at_when", "-id")[0:2])
+    if len(reports) < 2:
+        return rebuild_url_reports([url.id])
+
+    newest_report, previous_report = reports
+
+    reported_scan_types = get_allowed_to_report()
+    state = url_report_state(url, previous_report, reported_scan_types)
+    if not state:
+        log.debug("Could not reconstruct the state of the report of %s, rebuilding all reports." % url)
+        return rebuild_url_reports([url.id])
+
+    newest_report.delete()
+    UrlReportScanTypeStatistic.objects.all().filter(url_report=previous_report).update(superseded_on=None)
+
+    create_url_report(
+        create_timeline(url, since=previous_report.at_when, reported_scan_types=reported_scan_types), url, state
+    )
+
+    # Nothing happened after the previous report (for example a scan has been removed), so it is the newest again.
+    if not UrlReport.objects.all().filter(url=url, at_when__gt=previous_report.at_when).exists():
+        previous_report.is_the_newest = True
+        previous_report.save(update_fields=["is_the_newest"])
+
+
+def empty_url_report_state():
+    """
+    The state that is carried over from moment to moment while creating url reports. See create_url_report.
+    """
+    return {
+        # endpoint id: {scan type: scan}
+        "previous_endpoint_ratings": {},
+        # url id: {scan type: scan}
+        "previous_url_ratings": {},
+        "previous_endpoints": [],
+        "url_was_once_rated": False,
+        "dead_endpoints": set(),
+    }
+
+
+def url_report_state(url: Url, report: UrlReport, reported_scan_types: List[str]):
+    """
+    Reconstructs the state of create_url_report right after the given report has been made. The scans that
+    are referred to in the calculation are retrieved again, so they can be carried over to the next moments.
+
+    :return: state, or None if the state cannot be reconstructed.
+    """
+
+    calculation = report.calculation
+
+    endpoint_scan_ids = []
+    for endpoint in calculation["endpoints"]:
+        for rating in endpoint["ratings"]:
+            # repeated findings do not refer to the scan they repeat.
+            if "scan" not in rating:
+                return None
+            endpoint_scan_ids.append(rating["scan"])
+
+    url_scan_ids = []
+    for rating in calculation["ratings"]:
+        if "scan" not in rating:
+            return None
+        url_scan_ids.append(rating["scan"])
+
+    endpoint_scans = list(
+        EndpointGenericScan.objects.all()
+        .filter(pk__in=endpoint_scan_ids)
+        .prefetch_related("endpoint")
+        .defer("endpoint__url")
+    )
+    url_scans = list(UrlGenericScan.objects.all().filter(pk__in=url_scan_ids))
 
-    for url_id in urls:
+    # scans that have been removed since the report was made.
+    if len(endpoint_scans) != len(set(endpoint_scan_ids)) or len(url_scans) != len(set(url_scan_ids)):
+        return None
 
-        url = Url.objects.all().filter(id=url_id).only("id").first()
-        if not url:
+    state = empty_url_report_state()
+
+    for scan in endpoint_scans:
+        if scan.type not in reported_scan_types:
             continue
+        if scan.endpoint_id not in state["previous_endpoint_ratings"]:
+            state["previous_endpoint_ratings"][scan.endpoint_id] = {}
+        state["previous_endpoint_ratings"][scan.endpoint_id][scan.type] = scan
 
-        # Delete the ratings for this url, they are going to be rebuilt
-        UrlReport.objects.all().filter(url=url).delete()
+    state["previous_url_ratings"][url.id] = {scan.type: scan for scan in url_scans if scan.type in reported_scan_types}
 
-        # Creating a timeline and rating it is much faster than doing an individual calculation.
-        # Mainly because it gets all data in just a few queries and then builds upon that.
-        create_url_report(create_timeline(url), url)
+    state["previous_endpoints"] = list(
+        Endpoint.objects.all().filter(pk__in=[endpoint["id"] for endpoint in calculation["endpoints"]])
+    )
+
+    # a url is rated if it ever had an endpoint in a report.
+    state["url_was_once_rated"] = (
+        UrlReport.objects.all().filter(url=url, at_when__lte=report.at_when, total_endpoints__gt=0).exists()
+    )
+
+    # endpoints cannot be revived, scans on endpoints that died before the report are never added again.
+    state["dead_endpoints"] = set(
+        Endpoint.objects.all().filter(url=url, is_dead=True, is_dead_since__lte=report.at_when)
+    )
+
+    return state
 
 
-def significant_moments(urls: List[Url] = None, reported_scan_types: List[str] = None):
+def significant_moments(urls: List[Url] = None, reported_scan_types: List[str] = None, since: datetime = None):
     """
     Searches for all significant point in times that something changed. The goal is to save
     unneeded queries when rebuilding ratings. When you know when things changed, you know
@@ -77,6 +227,7 @@ def significant_moments(urls: List[Url] = None, reported_scan_types: List[str] =
 
     Note: something is considered alive again after a scan has been found on the endpoint or url.
 
+    :param since: only moments after this moment are returned, used to add reports to the existing reports.
     :return:
     """
 
@@ -106,21 +257,102 @@ def significant_moments(urls: List[Url] = None, reported_scan_types: List[str] =
         .prefetch_related("endpoint")
         .defer("endpoint__url")
     )
-    endpoint_scans = latest_rating_per_day_only(endpoint_scans)
-    endpoint_scan_dates = [x.rating_determined_on for x in endpoint_scans]
-
     url_scans = UrlGenericScan.objects.all().filter(type__in=reported_scan_types, url__in=urls).prefetch_related("url")
-    url_scans = latest_rating_per_day_only(url_scans)
-    url_scan_dates = [x.rating_determined_on for x in url_scans]
-
     dead_endpoints = Endpoint.objects.all().filter(url__in=urls, is_dead=True)
-    dead_scan_dates = [x.is_dead_since for x in dead_endpoints]
-
     non_resolvable_urls = Url.objects.filter(not_resolvable=True, url__in=urls)
-    non_resolvable_dates = [x.not_resolvable_since for x in non_resolvable_urls]
-
     dead_urls = Url.objects.filter(is_dead=True, url__in=urls)
-    dead_url_dates = [x.is_dead_since for x in dead_urls]
+
+    if since:
+        endpoint_scans = endpoint_scans.filter(rating_determined_on__gt=since)
+        url_scans = url_scans.filter(rating_determined_on__gt=since)
+        dead_endpoints = dead_endpoints.filter(is_dead_since__gt=since)
+        non_resolvable_urls = non_resolvable_urls.filter(not_resolvable_since__gt=since)
+        dead_urls = dead_urls.filter(is_dead_since__gt=since)
+
+    # using scans, the query of "what scan happened when" doesn't need to be answered anymore.
+    # the one thing is that scans have to be mapped to the moments (called a timeline)
+    happenings = {
+        "endpoint_scans": latest_rating_per_day_only(endpoint_scans),
+        "url_scans": latest_rating_per_day_only(url_scans),
+        "dead_endpoints": dead_endpoints,
+        "non_resolvable_urls": non_resolvable_urls,
+        "dead_urls": dead_urls,
+    }
+
+    moments = moments_from_happenings(happenings)
+
+    # If there are no scans at all, just return instead of storing useless junk or make other mistakes
+    if not moments:
+        return [], empty_happenings()
+
+    # count_queries()
+    return moments, happenings
+
+
+def significant_moments_per_url(urls: List[Url], reported_scan_types: List[str]):
+    """
+    The same as significant_moments, but for a series of urls at the same time. Each query is performed once for
+    all urls instead of once per url, the results are grouped per url afterwards. Make sure the amount of urls
+    stays within SQLITE_LIMIT_VARIABLE_NUMBER, see create_timelines.
+
+    :return: {url id: (moments, happenings)}
+    """
+
+    url_ids = [url.id for url in urls]
+    happenings_per_url = {url_id: empty_happenings() for url_id in url_ids}
+
+    endpoint_scans_per_url = defaultdict(list)
+    for scan in (
+        EndpointGenericScan.objects.all()
+        .filter(type__in=reported_scan_types, endpoint__url__in=url_ids)
+        .prefetch_related("endpoint")
+        .defer("endpoint__url")
+    ):
+        endpoint_scans_per_url[scan.endpoint.url_id].append(scan)
+
+    url_scans_per_url = defaultdict(list)
+    for scan in (
+        UrlGenericScan.objects.all().filter(type__in=reported_scan_types, url__in=url_ids).prefetch_related("url")
+    ):
+        url_scans_per_url[scan.url_id].append(scan)
+
+    for endpoint in Endpoint.objects.all().filter(url__in=url_ids, is_dead=True):
+        happenings_per_url[endpoint.url_id]["dead_endpoints"].append(endpoint)
+
+    for url in Url.objects.all().filter(not_resolvable=True, id__in=url_ids):
+        happenings_per_url[url.id]["non_resolvable_urls"].append(url)
+
+    for url in Url.objects.all().filter(is_dead=True, id__in=url_ids):
+        happenings_per_url[url.id]["dead_urls"].append(url)
+
+    moments_per_url = {}
+    for url_id, happenings in happenings_per_url.items():
+        # reduce per url, which keeps the amount of scans that are compared small.
+        happenings["endpoint_scans"] = latest_rating_per_day_only(endpoint_scans_per_url[url_id])
+        happenings["url_scans"] = latest_rating_per_day_only(url_scans_per_url[url_id])
+
+        moments = moments_from_happenings(happenings)
+        moments_per_url[url_id] = (moments, happenings) if moments else ([], empty_happenings())
+
+    return moments_per_url
+
+
+def empty_happenings():
+    return {
+        "endpoint_scans": [],
+        "url_scans": [],
+        "dead_endpoints": [],
+        "non_resolvable_urls": [],
+        "dead_urls": [],
+    }
+
+
+def moments_from_happenings(happenings) -> List[datetime]:
+    endpoint_scan_dates = [x.rating_determined_on for x in happenings["endpoint_scans"]]
+    url_scan_dates = [x.rating_determined_on for x in happenings["url_scans"]]
+    dead_scan_dates = [x.is_dead_since for x in happenings["dead_endpoints"]]
+    non_resolvable_dates = [x.not_resolvable_since for x in happenings["non_resolvable_urls"]]
+    dead_url_dates = [x.is_dead_since for x in happenings["dead_urls"]]
 
     # reduce this to one moment per day only, otherwise there will be a report for every change
     # which is highly inefficient. Using the latest possible time of the day is used.
@@ -128,15 +360,8 @@ def significant_moments(urls: List[Url] = None, reported_scan_types: List[str] =
     moments = [latest_moment_of_datetime(x) for x in moments]
     moments = sorted(set(moments))
 
-    # If there are no scans at all, just return instead of storing useless junk or make other mistakes
     if not moments:
-        return [], {
-            "endpoint_scans": [],
-            "url_scans": [],
-            "dead_endpoints": [],
-            "non_resolvable_urls": [],
-            "dead_urls": [],
-        }
+        return []
 
     # make sure you don't save the scan for today at the end of the day (which would make it visible only at the end
     # of the day). Just make it "now" so you can immediately see the results.
@@ -144,18 +369,7 @@ def significant_moments(urls: List[Url] = None, reported_scan_types: List[str] =
         moments[-1] = datetime.now(pytz.utc)
 
     # log.debug("Moments found: %s", len(moments))
-
-    # using scans, the query of "what scan happened when" doesn't need to be answered anymore.
-    # the one thing is that scans have to be mapped to the moments (called a timeline)
-    happenings = {
-        "endpoint_scans": endpoint_scans,
-        "url_scans": url_scans,
-        "dead_endpoints": dead_endpoints,
-        "non_resolvable_urls": non_resolvable_urls,
-        "dead_urls": dead_urls,
-    }
-    # count_queries()
-    return moments, happenings
+    return moments
 
 
 def latest_rating_per_day_only(scans):
@@ -206,8 +420,8 @@ def latest_rating_per_day_only(scans):
     """
     # we don't want to care about the order the scans came in: it can by any set of scans in any order, and it will
     # get the correct result quickly. For this we use a hash table of all scans, matched with the scan.
-
-    hash_table = []
+    # The dictionary is ordered: replacing a scan moves it to the end, just like the list that was used before.
+    hash_table = {}
     # build the hash table
     for scan in scans:
         # A combination that is unique, enough to identify a scan, but that will cause a collision if we don't
@@ -215,13 +429,13 @@ def latest_rating_per_day_only(scans):
         hash = hash_scan_per_day_and_type(scan)
         # use a high precision here, since we want to have the absolute latest scan
         # only when a rating changes, a new scan is added, this makes it fairly easy to get the latest
-        if not in_hash_table(hash_table, hash):
-            hash_table.append({"hash": hash, "scan": scan})
+        existing_scan = hash_table.get(hash, None)
+        if existing_scan is None:
+            hash_table[hash] = scan
         else:
             # here is where the magic happens: only the scan with the highest rating_determined_on can stay
             # find the one, check it and replace it.
-            existing_item = in_hash_table(hash_table, hash)
-            if existing_item["scan"].rating_determined_on < scan.rating_determined_on:
+            if existing_scan.rating_determined_on < scan.rating_determined_on:
                 # Due to the ordering of the scans, usually this message will NEVER appear and the first scan
                 # was always the latest. Perhaps per database this default ordering differs. Since we don't have
                 # testcases, i don't dare to touch the rest of this code.
@@ -229,8 +443,8 @@ def latest_rating_per_day_only(scans):
                     "Scan ID %s on %s had also another scan today that had a rating that lasted longer."
                     % (scan.pk, scan.type)
                 )
-                hash_table.remove(existing_item)
-                hash_table.append({"hash": hash, "scan": scan})
+                del hash_table[hash]
+                hash_table[hash] = scan
             else:
                 log.debug(
                     "Scan ID %s on %s had also another scan today that had a rating that lasted shorter. IGNORED"
@@ -238,34 +452,20 @@ def latest_rating_per_day_only(scans):
                 )
 
     # return a list of scans:
-    filtered_scans = []
-    for hash in hash_table:
-        filtered_scans.append(hash["scan"])
-
-    return filtered_scans
-
-
-def in_hash_table(hash_table, hash):
-    # https://stackoverflow.com/questions/8653516/python-list-of-dictionaries-search
-    try:
-        return next((item for item in hash_table if item["hash"] == hash))
-
-    except StopIteration:
-        return False
+    return list(hash_table.values())
 
 
 def hash_scan_per_day_and_type(scan):
-
-    # hopefully it doesn't run extra queries?
+    # Use the foreign keys directly, retrieving the related url or endpoint can cause extra queries.
     if scan.type in URL_SCAN_TYPES:
-        pk = scan.url.pk
+        pk = scan.url_id
     else:
-        pk = scan.endpoint.pk
+        pk = scan.endpoint_id
 
-    return "%s%s%s" % (pk, scan.type, scan.rating_determined_on.replace(second=59, microsecond=999999))
+    return pk, scan.type, scan.rating_determined_on.replace(second=59, microsecond=999999)
 
 
-def create_timeline(url: Url):
+def create_timeline(url: Url, since: datetime = None, reported_scan_types: List[str] = None):
     """
     Maps happenings to moments.
 
@@ -284,10 +484,36 @@ def create_timeline(url: Url):
     01-04-2017 - TLS scan update
                  HTTP Scan update
 
+    :param since: only add things that happened after this moment, see update_url_report.
     :return:
     """
-    moments, happenings = significant_moments(urls=[url], reported_scan_types=get_allowed_to_report())
+    if reported_scan_types is None:
+        reported_scan_types = get_allowed_to_report()
+
+    moments, happenings = significant_moments(urls=[url], reported_scan_types=reported_scan_types, since=since)
+
+    return timeline_from_happenings(moments, happenings)
+
+
+def create_timelines(urls: List[Url], reported_scan_types: List[str] = None):
+    """
+    Creates the timelines of a series of urls in a few queries, instead of a few queries per url. See create_timeline.
+
+    :return: {url id: timeline}
+    """
+    if reported_scan_types is None:
+        reported_scan_types = get_allowed_to_report()
 
+    timelines = {}
+    # stay under SQLITE_LIMIT_VARIABLE_NUMBER, the scan types are also part of the query.
+    for chunk in chunks2(list(urls), TIMELINE_CHUNK_SIZE):
+        for url_id, (moments, happenings) in significant_moments_per_url(chunk, reported_scan_types).items():
+            timelines[url_id] = timeline_from_happenings(moments, happenings)
+
+    return timelines
+
+
+def timeline_from_happenings(moments: List[datetime], happenings):
     timeline = {}
 
     # reduce to date only, it's not useful to show 100 things on a day when building history.
@@ -358,7 +584,7 @@ def latest_moment_of_datetime(datetime_: datetime):
     return datetime_.replace(second=59, microsecond=999999, tzinfo=pytz.utc)
 
 
-def create_url_report(timeline, url: Url):
+def create_url_report(timeline, url: Url, state: dict = None):
     """
     This creates:
     {
@@ -373,15 +599,24 @@ def create_url_report(timeline, url: Url):
 
     :param timeline:
     :param url:
+    :param state: what is known before the first moment in the timeline, see url_report_state.
     :return:
     """
 
     log.info("Rebuilding ratings for url %s on %s moments" % (url, len(timeline)))
-    previous_endpoint_ratings = {}
-    previous_url_ratings = {}
-    previous_endpoints = []
-    url_was_once_rated = False
-    dead_endpoints = set()
+    if not state:
+        state = empty_url_report_state()
+
+    previous_endpoint_ratings = state["previous_endpoint_ratings"]
+    previous_url_ratings = state["previous_url_ratings"]
+    previous_endpoints = state["previous_endpoints"]
+    url_was_once_rated = state["url_was_once_rated"]
+    dead_endpoints = state["dead_endpoints"]
+
+    # A scan is reported on every moment until it is replaced by a newer scan, so its severity is calculated once.
+    # The validity of explanations is determined at the moment the report is created.
+    severities = {}
+    report_moment = datetime.now(pytz.utc)
 
     # work on a sorted timeline as otherwise this code is non-deterministic!
     for index, moment in enumerate(sorted(timeline)):
@@ -502,7 +737,10 @@ def create_url_report(timeline, url: Url):
             for endpoint_scan_type in ENDPOINT_SCAN_TYPES:
                 if endpoint_scan_type in these_endpoint_scans:
                     if endpoint_scan_type not in given_ratings[label]:
-                        calculations.append(get_severity(these_endpoint_scans[endpoint_scan_type]))
+                        scan = these_endpoint_scans[endpoint_scan_type]
+                        if scan not in severities:
+                            severities[scan] = get_severity(scan, report_moment)
+                        calculations.append(severities[scan])
 
                         given_ratings[label].append(endpoint_scan_type)
                     else:
@@ -564,7 +802,10 @@ def create_url_report(timeline, url: Url):
 
         for url_scan_type in url_scan_types:
             if url_scan_type in these_url_scans:
-                url_calculations.append(get_severity(these_url_scans[url_scan_type]))
+                scan = these_url_scans[url_scan_type]
+                if scan not in severities:
+                    severities[scan] = get_severity(scan, report_moment)
+                url_calculations.append(severities[scan])
 
         # prevent empty ratings cluttering the database and skewing the stats.
         # todo: only do this if there never was a urlrating before this.
@@ -843,6 +1084,8 @@ def save_url_report(url: Url, date: datetime, calculation, is_the_newest=False):
     u.is_the_newest = is_the_newest
     u.save()
 
+    save_url_report_scan_type_statistics(u)
+
     # Make sure the new urlreport is seen as the latest, so retrieval of the last report is a direct lookup
     # This of course makes the adding process much slower.
     # This is not used because it's much faster to reduce queries by precalculating if this is the newest report.
@@ -851,6 +1094,64 @@ def save_url_report(url: Url, date: datetime, calculation, is_the_newest=False):
     # )
 
 
+def save_url_report_scan_type_statistics(url_report: UrlReport):
+    """
+    Stores the counts per scan type of this report, so the latest reports can be aggregated without loading the
+    calculation. See UrlReportScanTypeStatistic.
+    """
+
+    # The previous report of this url is not the latest anymore from this moment on. Reports of an url are made in
+    # chronological order, which means only the previous report is affected.
+    UrlReportScanTypeStatistic.objects.all().filter(url=url_report.url, at_when__lte=url_report.at_when).filter(
+        Q(superseded_on__isnull=True) | Q(superseded_on__gt=url_report.at_when)
+    ).exclude(url_report=url_report).update(superseded_on=url_report.at_when)
+
+    UrlReportScanTypeStatistic.objects.bulk_create(
+        [
+            UrlReportScanTypeStatistic(
+                url_report=url_report, url=url_report.url, at_when=url_report.at_when, scan_type=scan_type, **values
+            )
+            for scan_type, values in url_report_scan_type_statistics(url_report.calculation).items()
+        ]
+    )
+
+
+def url_report_scan_type_statistics(calculation) -> Dict[str, Dict[str, int]]:
+    """
+    Sums the high, medium, low and ok values of all url and endpoint ratings per scan type, and for all scan types
+    together in "total".
+    """
+
+    statistics = {"total": {"high": 0, "medium": 0, "low": 0, "ok": 0, "ratings": 0}}
+
+    ratings = list(calculation.get("ratings", []))
+    for endpoint in calculation.get("endpoints", []):
+        ratings += endpoint.get("ratings", [])
+
+    for rating in ratings:
+        for scan_type in ["total", rating["type"]]:
+            if scan_type not in statistics:
+                statistics[scan_type] = {"high": 0, "medium": 0, "low": 0, "ok": 0, "ratings": 0}
+            statistics[scan_type]["high"] += rating["high"]
+            statistics[scan_type]["medium"] += rating["medium"]
+            statistics[scan_type]["low"] += rating["low"]
+            statistics[scan_type]["ok"] += rating["ok"]
+            statistics[scan_type]["ratings"] += 1
+
+    return statistics
+
+
+def latest_url_report_scan_type_statistics(when: datetime):
+    """
+    The statistics of the latest url report of every url at the given moment.
+    """
+    return (
+        UrlReportScanTypeStatistic.objects.all()
+        .filter(at_when__lte=when)
+        .filter(Q(superseded_on__isnull=True) | Q(superseded_on__gt=when))
+    )
+
+
 def add_statistics_to_calculation(calculation, amount_of_issues):
 
     # inject all kinds of statistics inside the json for easier(?) representation.
@@ -1119,17 +1420,17 @@ def get_latest_urlratings_fast(urls: List[Url], when):
 
     # get all columns, instead of naming each of the 20 columns separately, and having the chance that you missed one
     # and then django performs a separate lookup query for that value (a few times).
+    # The latest report per url is looked up in the statistics table, which is a lot faster than grouping all reports.
     sql = (
         """SELECT *
                 FROM reporting_urlreport
-                INNER JOIN
-                  (SELECT MAX(id) as id2 FROM reporting_urlreport or2
-                  WHERE at_when <= '%s' AND url_id IN ("""
-        % (when,)
+                WHERE id IN
+                  (SELECT url_report_id FROM reporting_urlreportscantypestatistic
+                  WHERE scan_type = 'total' AND at_when <= '%(when)s'
+                  AND (superseded_on IS NULL OR superseded_on > '%(when)s') AND url_id IN ("""
+        % {"when": when}
         + ",".join(map(str, urls))
-        + """)
-                  GROUP BY url_id) as x
-                  ON x.id2 = reporting_urlreport.id
+        + """))
                 ORDER BY high DESC, medium DESC, low DESC, url_id ASC
                 """
     )
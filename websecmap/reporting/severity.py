@@ -7,7 +7,7 @@ This file contains (or should) verbose explantion of why points are given.
 import json
 import logging
 from datetime import datetime
-from typing import Union
+from typing import Dict, Iterable, List, Tuple, Union
 
 import pytz
 from django.conf import settings
@@ -667,12 +667,43 @@ calculation_methods = {
 }
 
 
-def get_severity(scan: Union[EndpointGenericScan, UrlGenericScan]):
+# The severity of these types only depends on the type and rating of the scan, the explanation of the scan is not
+# used. Their calculation is made once per (type, rating) and stored in severity_table. The strict transport security
+# header is not in here, as it uses the explanation of the scan to see if an insecure alternative is offered.
+DETERMINISTIC_TYPES = {
+    "http_security_header_x_content_type_options",
+    "http_security_header_x_frame_options",
+    "http_security_header_x_xss_protection",
+    "tls_qualys_certificate_trusted",
+    "tls_qualys_encryption_quality",
+    "Dummy",
+}
+
+# Ratings of deterministic types that still copy the explanation of the scan into the calculation.
+SCAN_SPECIFIC_RATINGS = {"scan_error"}
+
+# (type, rating) -> calculation without the scan specific fields
+severity_table: Dict[Tuple[str, str], dict] = {}
+
+
+def get_severities(scans: Iterable[Union[EndpointGenericScan, UrlGenericScan]], at_when: datetime = None) -> List[dict]:
+    """
+    Calculates the severity of many scans at once, for example all scans in a report. The validity of comply or
+    explain is determined for a single moment, which is now when at_when is not given.
+    """
+    at_when = at_when if at_when else datetime.now(pytz.utc)
+    return [get_severity(scan, at_when) for scan in scans]
+
+
+def get_severity(scan: Union[EndpointGenericScan, UrlGenericScan], at_when: datetime = None):
     # Can be probably more efficient by adding some methods to scan.
     if not calculation_methods.get(scan.type, None):
         raise ValueError("No calculation available for this scan type: %s" % scan.type)
 
-    calculation = calculation_methods[scan.type](scan)
+    if scan.type in DETERMINISTIC_TYPES and scan.rating not in SCAN_SPECIFIC_RATINGS:
+        calculation = get_deterministic_calculation(scan)
+    else:
+        calculation = calculation_methods[scan.type](scan)
 
     if not calculation:
         raise ValueError(f"No calculation created for scan {scan.type}")
@@ -694,7 +725,7 @@ def get_severity(scan: Union[EndpointGenericScan, UrlGenericScan]):
         calculation["comply_or_explain_explanation_valid_until"] = ""
 
     valid = scan.comply_or_explain_is_explained and (
-        scan.comply_or_explain_explanation_valid_until > datetime.now(pytz.utc)
+        scan.comply_or_explain_explanation_valid_until > (at_when if at_when else datetime.now(pytz.utc))
     )
     calculation["comply_or_explain_valid_at_time_of_report"] = valid
 
@@ -703,3 +734,15 @@ def get_severity(scan: Union[EndpointGenericScan, UrlGenericScan]):
     calculation["scan_type"] = scan.type
 
     return calculation
+
+
+def get_deterministic_calculation(scan: Union[EndpointGenericScan, UrlGenericScan]):
+    key = (scan.type, scan.rating)
+    if key not in severity_table:
+        severity_table[key] = calculation_methods[scan.type](scan)
+
+    # copy, as the calculation is extended per scan.
+    calculation = dict(severity_table[key])
+    calculation["since"] = scan.rating_determined_on.isoformat()
+    calculation["last_scan"] = scan.last_scan_moment.isoformat()
+    return calculation
@@ -0,0 +1,125 @@
+import logging
+import random
+from datetime import datetime, timedelta
+
+import pytz
+
+from websecmap.organizations.models import Url
+from websecmap.reporting import report
+from websecmap.reporting.report import latest_rating_per_day_only
+from websecmap.scanners import URL_SCAN_TYPES
+from websecmap.scanners.models import Endpoint, EndpointGenericScan, UrlGenericScan
+
+
+def previous_latest_rating_per_day_only(scans):
+    """
+    The list based implementation that was used before, to compare results and speed with. It searched the list of
+    hashes for every scan, which made it quadratic.
+    """
+
+    def in_hash_table(hash_table, hash):
+        try:
+            return next((item for item in hash_table if item["hash"] == hash))
+        except StopIteration:
+            return False
+
+    def hash_scan_per_day_and_type(scan):
+        if scan.type in URL_SCAN_TYPES:
+            pk = scan.url.pk
+        else:
+            pk = scan.endpoint.pk
+
+        return "%s%s%s" % (pk, scan.type, scan.rating_determined_on.replace(second=59, microsecond=999999))
+
+    hash_table = []
+    for scan in scans:
+        hash = hash_scan_per_day_and_type(scan)
+        if not in_hash_table(hash_table, hash):
+            hash_table.append({"hash": hash, "scan": scan})
+        else:
+            existing_item = in_hash_table(hash_table, hash)
+            if existing_item["scan"].rating_determined_on < scan.rating_determined_on:
+                hash_table.remove(existing_item)
+                hash_table.append({"hash": hash, "scan": scan})
+
+    return [item["scan"] for item in hash_table]
+
+
+def create_scans(amount: int):
+    """
+    Creates a lot of (unsaved) scans over a few endpoints and a url, with some scans on the same minute. The order
+    is shuffled, so scans are replaced in the hash table.
+    """
+    random.seed(42)
+    start = datetime(2020, 1, 1, tzinfo=pytz.utc)
+
+    url = Url(id=1, url="example.nl")
+    endpoints = [Endpoint(id=endpoint_id, url=url) for endpoint_id in range(1, 6)]
+    endpoint_scan_types = [
+        "http_security_header_strict_transport_security",
+        "http_security_header_x_content_type_options",
+        "internet_nl_web_https_tls_version",
+    ]
+
+    scans = []
+    for scan_id in range(1, amount + 1):
+        # there are about three scans per minute per endpoint and type.
+        moment = start + timedelta(minutes=random.randint(0, amount // 3), seconds=random.randint(0, 59))
+
+        if scan_id % 10 == 0:
+            scan = UrlGenericScan(id=scan_id, url=url, type="DNSSEC")
+        else:
+            scan = EndpointGenericScan(
+                id=scan_id, endpoint=random.choice(endpoints), type=random.choice(endpoint_scan_types)
+            )
+
+        scan.rating_determined_on = moment
+        scans.append(scan)
+
+    random.shuffle(scans)
+    return scans
+
+
+def test_latest_rating_per_day_only_is_identical():
+    scans = create_scans(1000)
+
+    expected = previous_latest_rating_per_day_only(scans)
+    result = latest_rating_per_day_only(scans)
+
+    # same scans, in the same order
+    assert [(type(scan), scan.pk) for scan in result] == [(type(scan), scan.pk) for scan in expected]
+    # sanity check that the reduction actually did something.
+    assert len(scans) > len(result)
+
+
+class ComparedKey:
+    """A hash table key that counts how often it is compared to other keys."""
+
+    comparisons = 0
+
+    def __init__(self, key):
+        self.key = key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        ComparedKey.comparisons += 1
+        return self.key == other.key
+
+
+def test_latest_rating_per_day_only_is_linear(monkeypatch, caplog):
+    # the debug messages about replaced scans are not part of the comparison.
+    caplog.set_level(logging.INFO, logger="websecmap.reporting")
+    scans = create_scans(4000)
+    expected = previous_latest_rating_per_day_only(scans)
+
+    hash_scan = report.hash_scan_per_day_and_type
+    monkeypatch.setattr(report, "hash_scan_per_day_and_type", lambda scan: ComparedKey(hash_scan(scan)))
+    ComparedKey.comparisons = 0
+    result = latest_rating_per_day_only(scans)
+
+    assert [scan.pk for scan in result] == [scan.pk for scan in expected]
+
+    # every scan is compared with about one other scan, instead of with every scan in the table.
+    assert ComparedKey.comparisons < 2 * len(scans)
@@ -1,6 +1,9 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from websecmap.reporting.severity import standard_calculation_for_internet_nl
+import pytz
+
+from websecmap.reporting import severity
+from websecmap.reporting.severity import get_severities, get_severity, standard_calculation_for_internet_nl
 from websecmap.scanners.models import EndpointGenericScan
 
 
@@ -51,3 +54,57 @@ def test_internet_nl_standard_calculation(db):
         "error_in_test": False,
         "test_result": 0,
     }
+
+
+def test_get_severities(db):
+    severity.severity_table.clear()
+    now = datetime.now(pytz.utc)
+
+    scans = []
+    for pk, (type, rating, explanation) in enumerate(
+        [
+            ("tls_qualys_encryption_quality", "F", ""),
+            ("tls_qualys_encryption_quality", "F", ""),
+            ("tls_qualys_encryption_quality", "scan_error", "Could not connect."),
+            ("tls_qualys_encryption_quality", "scan_error", "Timeout."),
+            ("http_security_header_x_frame_options", "False", ""),
+            (
+                "plain_https",
+                "0",
+                "Redirects to a secure site, while a secure counterpart on the standard port is missing.",
+            ),
+        ]
+    ):
+        scan = EndpointGenericScan(pk=pk, type=type, rating=rating, explanation=explanation)
+        scan.rating_determined_on = now - timedelta(days=pk)
+        scan.last_scan_moment = now
+        scans.append(scan)
+
+    scans[1].comply_or_explain_is_explained = True
+    scans[1].comply_or_explain_explanation_valid_until = now + timedelta(days=1)
+
+    calculations = get_severities(scans, now)
+
+    # the batch gives the same results as calculating every scan on its own.
+    assert calculations == [get_severity(scan, now) for scan in scans]
+
+    # the severity of a type and rating is only calculated once, scan specific fields are still set per scan.
+    assert list(severity.severity_table) == [
+        ("tls_qualys_encryption_quality", "F"),
+        ("http_security_header_x_frame_options", "False"),
+    ]
+    assert calculations[0]["high"] == calculations[1]["high"] == 1
+    assert calculations[1]["since"] == scans[1].rating_determined_on.isoformat()
+    assert calculations[1]["scan"] == 1
+    assert calculations[0]["comply_or_explain_valid_at_time_of_report"] is False
+    assert calculations[1]["comply_or_explain_valid_at_time_of_report"] is True
+    assert "is_explained" not in severity.severity_table[("tls_qualys_encryption_quality", "F")]
+
+    # scan errors copy the explanation of the scan.
+    assert calculations[2]["explanation"] == "Could not connect."
+    assert calculations[3]["explanation"] == "Timeout."
+    assert calculations[4]["low"] == 1
+    assert calculations[5]["medium"] == 1
+
+    # explanations expire
+    assert not get_severities(scans[1:2], now + timedelta(days=2))[0]["comply_or_explain_valid_at_time_of_report"]
@@ -4,7 +4,13 @@ import pytz
 
 from websecmap.organizations.models import Url
 from websecmap.reporting.models import UrlReport
-from websecmap.reporting.report import create_timeline, create_url_report
+from websecmap.reporting.report import (
+    create_timeline,
+    create_timelines,
+    create_url_report,
+    latest_url_report_scan_type_statistics,
+    recreate_url_reports,
+)
 from websecmap.scanners.models import Endpoint, EndpointGenericScan
 
 
@@ -155,3 +161,169 @@ def test_aggegrate_error_in_report(db):
     # This is 0 because this is not an endpoint level error, but an url_level_error
     assert report.url_error_in_test == 0
     assert report.error_in_test == 1
+
+
+def test_incremental_url_report(db):
+    """
+    Adding only the new moments to the existing reports should result in the same reports as a complete rebuild.
+    """
+
+    day_0 = datetime(day=1, month=1, year=2000, tzinfo=pytz.utc)
+    day_1 = datetime(day=2, month=1, year=2000, tzinfo=pytz.utc)
+    day_2 = datetime(day=3, month=1, year=2000, tzinfo=pytz.utc)
+    day_3 = datetime(day=4, month=1, year=2000, tzinfo=pytz.utc)
+    day_4 = datetime(day=5, month=1, year=2000, tzinfo=pytz.utc)
+
+    url, created = Url.objects.all().get_or_create(url="test.nl", created_on=day_0, not_resolvable=False)
+    first_endpoint, created = Endpoint.objects.all().get_or_create(
+        url=url, protocol="https", port="443", ip_version=4, discovered_on=day_1, is_dead=False
+    )
+    second_endpoint, created = Endpoint.objects.all().get_or_create(
+        url=url, protocol="http", port="80", ip_version=4, discovered_on=day_1, is_dead=False
+    )
+
+    def add_scan(endpoint, scan_type, rating, when):
+        EndpointGenericScan.objects.all().create(
+            endpoint=endpoint,
+            type=scan_type,
+            rating=rating,
+            rating_determined_on=when,
+            last_scan_moment=when,
+            comply_or_explain_is_explained=False,
+            is_the_latest_scan=True,
+        )
+
+    def reports():
+        return [
+            (report.at_when, report.high, report.medium, report.low, report.is_the_newest, report.calculation)
+            for report in UrlReport.objects.all().filter(url=url).order_by("at_when")
+        ]
+
+    add_scan(first_endpoint, "tls_qualys_encryption_quality", "A+", day_1)
+    add_scan(second_endpoint, "plain_https", "0", day_1)
+    add_scan(first_endpoint, "tls_qualys_encryption_quality", "F", day_2)
+    recreate_url_reports([url.id])
+    assert UrlReport.objects.all().count() == 2
+
+    # new things happen: a new scan, and an endpoint dies.
+    add_scan(first_endpoint, "http_security_header_strict_transport_security", "False", day_3)
+    second_endpoint.is_dead = True
+    second_endpoint.is_dead_since = day_4
+    second_endpoint.save()
+    add_scan(first_endpoint, "tls_qualys_encryption_quality", "A", day_4)
+
+    recreate_url_reports([url.id], incremental=True)
+    incremental_reports = reports()
+
+    recreate_url_reports([url.id])
+    assert incremental_reports == reports()
+    assert len(incremental_reports) == 4
+    assert incremental_reports[-1][4] is True
+
+
+def test_create_timelines(db):
+    """
+    Creating the timelines of many urls at the same time should give the same timelines as creating them one by one.
+    """
+
+    day_0 = datetime(day=1, month=1, year=2000, tzinfo=pytz.utc)
+    day_1 = datetime(day=2, month=1, year=2000, tzinfo=pytz.utc)
+    day_2 = datetime(day=3, month=1, year=2000, tzinfo=pytz.utc)
+    day_3 = datetime(day=4, month=1, year=2000, tzinfo=pytz.utc)
+
+    first_url, created = Url.objects.all().get_or_create(url="test.nl", created_on=day_0, not_resolvable=False)
+    second_url, created = Url.objects.all().get_or_create(url="example.nl", created_on=day_0, not_resolvable=False)
+    # no scans at all
+    third_url, created = Url.objects.all().get_or_create(url="example.com", created_on=day_0, not_resolvable=False)
+
+    for url in [first_url, second_url]:
+        endpoint, created = Endpoint.objects.all().get_or_create(
+            url=url, protocol="https", port="443", ip_version=4, discovered_on=day_1, is_dead=False
+        )
+        for rating, when in [("A+", day_1), ("F", day_2)]:
+            EndpointGenericScan.objects.all().create(
+                endpoint=endpoint,
+                type="tls_qualys_encryption_quality",
+                rating=rating,
+                rating_determined_on=when,
+                last_scan_moment=when,
+                comply_or_explain_is_explained=False,
+                is_the_latest_scan=True,
+            )
+
+    endpoint.is_dead = True
+    endpoint.is_dead_since = day_3
+    endpoint.save()
+
+    first_url.not_resolvable = True
+    first_url.not_resolvable_since = day_3
+    first_url.save()
+
+    timelines = create_timelines([first_url, second_url, third_url])
+    assert timelines == {
+        first_url.id: create_timeline(first_url),
+        second_url.id: create_timeline(second_url),
+        third_url.id: {},
+    }
+    assert len(timelines[first_url.id]) == 3
+
+
+def test_url_report_scan_type_statistics(db):
+    """
+    The statistics per scan type should always point to the latest report of a url at any moment, also after an
+    incremental update.
+    """
+
+    day_0 = datetime(day=1, month=1, year=2000, tzinfo=pytz.utc)
+    day_1 = datetime(day=2, month=1, year=2000, tzinfo=pytz.utc)
+    day_2 = datetime(day=3, month=1, year=2000, tzinfo=pytz.utc)
+    day_3 = datetime(day=4, month=1, year=2000, tzinfo=pytz.utc)
+
+    url, created = Url.objects.all().get_or_create(url="test.nl", created_on=day_0, not_resolvable=False)
+    endpoint, created = Endpoint.objects.all().get_or_create(
+        url=url, protocol="https", port="443", ip_version=4, discovered_on=day_1, is_dead=False
+    )
+
+    def add_scan(scan_type, rating, when):
+        EndpointGenericScan.objects.all().create(
+            endpoint=endpoint,
+            type=scan_type,
+            rating=rating,
+            rating_determined_on=when,
+            last_scan_moment=when,
+            comply_or_explain_is_explained=False,
+            is_the_latest_scan=True,
+        )
+
+    def statistics(when):
+        return {
+            statistic.scan_type: (statistic.high, statistic.medium, statistic.low, statistic.ok, statistic.ratings)
+            for statistic in latest_url_report_scan_type_statistics(when).filter(url=url)
+        }
+
+    add_scan("tls_qualys_encryption_quality", "A+", day_1)
+    add_scan("tls_qualys_encryption_quality", "F", day_2)
+    recreate_url_reports([url.id])
+
+    assert statistics(day_0) == {}
+    assert statistics(day_1.replace(hour=12)) == {
+        "total": (0, 0, 0, 1, 1),
+        "tls_qualys_encryption_quality": (0, 0, 0, 1, 1),
+    }
+    assert statistics(day_2.replace(hour=12)) == {
+        "total": (1, 0, 0, 0, 1),
+        "tls_qualys_encryption_quality": (1, 0, 0, 0, 1),
+    }
+
+    add_scan("tls_qualys_encryption_quality", "A", day_3)
+    recreate_url_reports([url.id], incremental=True)
+
+    # the report of day 2 is now superseded, and the newest report is the only one without an end.
+    assert statistics(day_2.replace(hour=12))["total"] == (1, 0, 0, 0, 1)
+    assert statistics(day_3.replace(hour=12))["total"] == (0, 0, 0, 1, 1)
+    newest = UrlReport.objects.all().get(url=url, is_the_newest=True)
+    assert list(
+        latest_url_report_scan_type_statistics(datetime.now(pytz.utc))
+        .filter(scan_type="total")
+        .values_list("url_report", flat=True)
+    ) == [newest.id]
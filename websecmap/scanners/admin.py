@@ -338,6 +338,10 @@ class ScanProxyAdmin(ImportExportModelAdmin, admin.ModelAdmin):
         "manually_disabled",
         "is_dead",
         "request_speed_in_ms",
+        "latency_p50_in_ms",
+        "latency_p95_in_ms",
+        "error_rate",
+        "score",
         "qualys_capacity_current",
         "qualys_capacity_max",
         "qualys_capacity_this_client",
@@ -362,6 +366,11 @@ class ScanProxyAdmin(ImportExportModelAdmin, admin.ModelAdmin):
         "check_result",
         "check_result_date",
         "request_speed_in_ms",
+        "latency_window",
+        "latency_p50_in_ms",
+        "latency_p95_in_ms",
+        "error_rate",
+        "score",
         "qualys_capacity_current",
         "qualys_capacity_max",
         "qualys_capacity_this_client",
@@ -0,0 +1,90 @@
+"""
+Pooled http sessions for scanners that contact the same hosts back to back, such as the http endpoint verification,
+plain http and security header scanners.
+
+A requests session keeps connections open (keep-alive), so a next request to the same host does not need a new TCP
+and TLS handshake. Sessions are kept per host and ip version in the worker process. The amount of sessions is bounded,
+the least recently used session is dropped. The amount of concurrent requests per host is limited, which matters
+for workers that run tasks in threads or greenlets.
+
+Cookies are not stored, so every request is performed as if it was the first visit to the site.
+
+Hits and misses are sent to statsd as scan.http_pool.hit and scan.http_pool.miss.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, Iterator, Tuple
+
+from django_statsd.clients import statsd
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__package__)
+
+# the number of hosts a worker process keeps connections with.
+MAX_SESSIONS = 64
+
+# the number of concurrent requests and open connections per host and ip version.
+MAX_CONNECTIONS_PER_HOST = 4
+
+sessions: "OrderedDict[Tuple[str, int], Session]" = OrderedDict()
+host_limits: Dict[Tuple[str, int], threading.BoundedSemaphore] = {}
+lock = threading.Lock()
+
+
+@contextmanager
+def pooled_session(host: str, ip_version: int = 0) -> Iterator[Session]:
+    """
+    Usage:
+    with pooled_session("example.com", 4) as session:
+        response = session.get("https://example.com", timeout=(10, 10))
+
+    :param host: the hostname the requests are for, also when connecting to an ip address with a host header.
+    :param ip_version: 4 or 6, or 0 when any network can be used.
+    """
+    key = (host.lower(), ip_version)
+
+    with lock:
+        session = sessions.get(key, None)
+        if session:
+            statsd.incr("scan.http_pool.hit")
+            sessions.move_to_end(key)
+        else:
+            statsd.incr("scan.http_pool.miss")
+            session = sessions[key] = create_session()
+            host_limits[key] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+
+            # Dropped sessions are not closed explicitly, as they might still be used in another thread. Their
+            # connections are closed when the session is garbage collected.
+            while len(sessions) > MAX_SESSIONS:
+                dropped_key, dropped_session = sessions.popitem(last=False)
+                del host_limits[dropped_key]
+
+        limit = host_limits[key]
+
+    with limit:
+        yield session
+
+
+def create_session() -> Session:
+    session = Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    # No retries: the scanners decide when to retry. A host is often contacted via its ip address and via its name
+    # on several ports, each of these have their own pool. Connections per pool are limited to the amount of
+    # concurrent requests, as more connections would not be reused.
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=MAX_CONNECTIONS_PER_HOST, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def clear_sessions():
+    with lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+        host_limits.clear()
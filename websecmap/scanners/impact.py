@@ -6,7 +6,7 @@ from logging import getLogger
 from constance import config
 
 from websecmap.map.report import PUBLISHED_ENDPOINT_SCAN_TYPES, PUBLISHED_URL_SCAN_TYPES
-from websecmap.reporting.severity import get_severity
+from websecmap.reporting.severity import get_severities
 from websecmap.scanners.models import Endpoint, EndpointGenericScan
 
 log = getLogger(__package__)
@@ -140,8 +140,7 @@ def calculate_impact():
             # only creates double numbers and total amounts:
             if first_scan == last_scan:
                 continue
-            severity_first = get_severity(first_scan)
-            severity_last = get_severity(last_scan)
+            severity_first, severity_last = get_severities([first_scan, last_scan])
             # we also don't need to see the same severity, as nothing practically changed
             if severity_first == severity_last:
                 continue
@@ -0,0 +1,49 @@
+# Generated by Django 3.1.6 on 2026-10-18 20:47
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scanners", "0002_auto_20210419_1408"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scanproxy",
+            name="error_rate",
+            field=models.FloatField(
+                default=0, help_text="The fraction of failed measurements in the latency window, from 0 to 1."
+            ),
+        ),
+        migrations.AddField(
+            model_name="scanproxy",
+            name="latency_p50_in_ms",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="scanproxy",
+            name="latency_p95_in_ms",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="scanproxy",
+            name="latency_window",
+            field=jsonfield.fields.JSONField(
+                blank=True,
+                default=list,
+                help_text="The latest latency measurements in milliseconds, newest last. Failed measurements are null.",
+            ),
+        ),
+        migrations.AddField(
+            model_name="scanproxy",
+            name="score",
+            field=models.FloatField(
+                blank=True,
+                help_text="Lower is better. Proxies with the lowest score are claimed first. Based on the latency and error rate.",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.6 on 2026-10-18 22:05
+
+from django.db import migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scanners", "0003_auto_20261018_2047"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="internetnlv2scan",
+            name="retrieved_scan_report_batches",
+            field=jsonfield.fields.JSONField(
+                blank=True,
+                default=None,
+                help_text="The start and end of every batch of domains in the retrieved scan report, in characters. Batches are processed separately, reading only their own part of the report.",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.6 on 2026-10-18 22:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scanners", "0004_internetnlv2scan_retrieved_scan_report_batches"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="plannedscan",
+            name="claim_token",
+            field=models.UUIDField(
+                blank=True,
+                help_text="Set when the scan is picked up, identifies the scans claimed together.",
+                null=True,
+            ),
+        ),
+    ]
@@ -208,6 +208,27 @@ class ScanProxy(models.Model):
         "number makes it easy not to use this proxy anymore.",
     )
 
+    latency_window = JSONField(
+        default=list,
+        blank=True,
+        help_text="The latest latency measurements in milliseconds, newest last. Failed measurements are null.",
+    )
+
+    latency_p50_in_ms = models.IntegerField(null=True, blank=True)
+
+    latency_p95_in_ms = models.IntegerField(null=True, blank=True)
+
+    error_rate = models.FloatField(
+        default=0, help_text="The fraction of failed measurements in the latency window, from 0 to 1."
+    )
+
+    score = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Lower is better. Proxies with the lowest score are claimed first. Based on the latency and "
+        "error rate.",
+    )
+
     def as_dict(self):
         return {
             "id": self.pk,
@@ -479,6 +500,10 @@ class PlannedScan(models.Model):
 
     finished_at_when = models.DateTimeField(null=True, help_text="when finished, timeout, error")
 
+    claim_token = models.UUIDField(
+        null=True, blank=True, help_text="Set when the scan is picked up, identifies the scans claimed together."
+    )
+
     # add joined index over scanner, activity, state, so queries are faster:
     # see: https://docs.djangoproject.com/en/3.0/ref/models/options/#indexes
     class Meta:
@@ -650,6 +675,14 @@ class InternetNLV2Scan(models.Model):
     # for error recovery and debugging reasons, store the entire result (which can be pretty huge).
     retrieved_scan_report = JSONField(default=None, blank=True, null=True)
 
+    retrieved_scan_report_batches = JSONField(
+        default=None,
+        blank=True,
+        null=True,
+        help_text="The start and end of every batch of domains in the retrieved scan report, in characters. Batches "
+        "are processed separately, reading only their own part of the report.",
+    )
+
     def __str__(self):
         return "%s: %s %s" % (self.pk, self.scan_id, self.state)
 
@@ -1,22 +1,36 @@
 import logging
+import uuid
+from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Set, Union
 
-import dateutil.parser
 import pytz
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import F
 from django_statsd.clients import statsd
 
 from websecmap.celery import app
-from websecmap.map.logic.map_health import get_outdated_ratings
 from websecmap.map.map_configs import filter_map_configs
 from websecmap.map.report import PUBLISHED_SCAN_TYPES
-from websecmap.organizations.models import Organization, Url
+from websecmap.organizations.models import Url
 from websecmap.scanners import SCAN_TYPES_TO_SCANNER, SCANNERS_BY_NAME
-from websecmap.scanners.models import Endpoint, PlannedScan, PlannedScanStatistic, Activity, Scanner, State
+from websecmap.scanners.models import (
+    Activity,
+    Endpoint,
+    EndpointGenericScan,
+    PlannedScan,
+    PlannedScanStatistic,
+    Scanner,
+    State,
+    UrlGenericScan,
+)
+from websecmap.scanners.scanner.__init__ import chunks2
 
 log = logging.getLogger(__name__)
 
+# Planned scans are written and altered in batches, well below the max number of variables in a query on SQLite.
+PLANNED_SCAN_BATCH_SIZE = 500
+
 
 @app.task(queue="storage")
 def store_progress():
@@ -97,50 +111,89 @@ def pickup(activity: str, scanner: str, amount: int = 10) -> List[Url]:
     amount: the amount of plannedscans to pick up
     """
 
-    # oldest first, so ascending dates.
-    scans = (
-        PlannedScan.objects.all()
-        .filter(activity=Activity[activity].value, scanner=Scanner[scanner].value, state=State["requested"].value)
-        .order_by("requested_at_when")[0:amount]
-    )
-    for scan in scans:
-        # todo: should there be a state log? Probably.
-        scan.state = State["picked_up"].value
-        scan.last_state_change_at = datetime.now(pytz.utc)
-        scan.save()
-
-    urls = [scan.url for scan in scans]
+    urls = [scan.url for scan in claim(activity, scanner, amount)]
     log.debug(f"Picked up {len(urls)} to {activity} with {scanner}.")
-    statsd.incr(f"scan.planned.pickup.{scanner}.{activity}", count=amount)
+    statsd.incr(f"scan.planned.pickup.{scanner}.{activity}", count=len(urls))
     return urls
 
 
-def request(activity: str, scanner: str, urls: List[int]):
+def claim(activity: str, scanner: str, amount: int = 10) -> List[PlannedScan]:
+    """
+    Picks up the oldest requested scans, with their url. Multiple planners can claim scans for the same scanner at
+    the same time: a scan is only claimed once.
+
+    On databases that support it, the rows are locked with SELECT ... FOR UPDATE SKIP LOCKED, rows that are being
+    claimed elsewhere are skipped. Otherwise (SQLite, older MySQL versions) the state change only happens if the scan
+    is still requested, which means a concurrent claim might return fewer scans than requested.
+    """
+
+    with transaction.atomic():
+        # oldest first, so ascending dates.
+        scans = (
+            PlannedScan.objects.all()
+            .filter(activity=Activity[activity].value, scanner=Scanner[scanner].value, state=State["requested"].value)
+            .order_by("requested_at_when")
+        )
+        if connection.features.has_select_for_update_skip_locked:
+            scans = scans.select_for_update(skip_locked=True)
+        scan_ids = list(scans.values_list("id", flat=True)[0:amount])
+
+        claimed_ids = mark_picked_up(scan_ids)
+
+    return list(
+        PlannedScan.objects.all().filter(id__in=claimed_ids).select_related("url").order_by("requested_at_when")
+    )
+
+
+def mark_picked_up(scan_ids: List[int]) -> List[int]:
+    """
+    Sets the requested scans to picked up, and returns the ids of the scans that were changed. Scans that are not
+    requested anymore are picked up by someone else.
+    """
+
+    # A token that is unique to this call identifies the scans altered here, also when another planner picks up
+    # scans at the same moment.
+    token = uuid.uuid4()
+
+    # todo: should there be a state log? Probably.
+    PlannedScan.objects.all().filter(id__in=scan_ids, state=State["requested"].value).update(
+        state=State["picked_up"].value, last_state_change_at=datetime.now(pytz.utc), claim_token=token
+    )
+
+    return list(PlannedScan.objects.all().filter(id__in=scan_ids, claim_token=token).values_list("id", flat=True))
+
+
+def request(activity: str, scanner: str, urls: List[Union[Url, int]]):
     # should it be deduplicated? i mean: if there already is a specific planned scan, it doesn't
     # need to be created again: that would just be more work. Think so, otherwise the finish and start will
-    # mix for different scans. So we can't do bulk inserts, but we can do better state logging
-
-    for url in urls:
-        if already_requested(activity, scanner, url):
-            log.debug(f"Already registered: {activity} on {scanner} for {url}.")
-            continue
-
-        now = datetime.now(pytz.utc)
-
-        ps = PlannedScan()
-        ps.activity = Activity[activity].value
-        ps.scanner = Scanner[scanner].value
-        ps.url = url
-        ps.state = State["requested"].value
-        ps.last_state_change_at = now
-        # To use the index on requested_at_when times are reduced to whole hours.
-        # This is sane enough to allow tons of scans per day still, but the creation
-        # of status reports is much faster. Still gives an idea of how many scans are made.
-        # The minutes are rounded to every 10 minutes. So there is still a sense of progress and use the index
-        discard = timedelta(minutes=now.minute % 10, seconds=now.second, microseconds=now.microsecond)
-        ps.requested_at_when = now - discard
-        ps.save()
-        statsd.incr(f"scan.planned.request.{scanner}.{activity}", count=1)
+    # mix for different scans. The existing planned scans are filtered out before a bulk insert.
+
+    url_ids = list(dict.fromkeys(to_url_ids(urls)))
+    requested = already_requested_urls(activity, scanner, url_ids)
+    if requested:
+        log.debug(f"Already registered: {activity} on {scanner} for {len(requested)} urls.")
+
+    now = datetime.now(pytz.utc)
+    # To use the index on requested_at_when times are reduced to whole hours.
+    # This is sane enough to allow tons of scans per day still, but the creation
+    # of status reports is much faster. Still gives an idea of how many scans are made.
+    # The minutes are rounded to every 10 minutes. So there is still a sense of progress and use the index
+    discard = timedelta(minutes=now.minute % 10, seconds=now.second, microseconds=now.microsecond)
+
+    new_scans = [
+        PlannedScan(
+            activity=Activity[activity].value,
+            scanner=Scanner[scanner].value,
+            url_id=url_id,
+            state=State["requested"].value,
+            last_state_change_at=now,
+            requested_at_when=now - discard,
+        )
+        for url_id in url_ids
+        if url_id not in requested
+    ]
+    PlannedScan.objects.bulk_create(new_scans, batch_size=PLANNED_SCAN_BATCH_SIZE)
+    statsd.incr(f"scan.planned.request.{scanner}.{activity}", count=len(new_scans))
 
     log.debug(f"Requested {activity} with {scanner} on {len(urls)} urls.")
 
@@ -158,6 +211,27 @@ def already_requested(activity: str, scanner: str, url_id: int):
     )
 
 
+def already_requested_urls(activity: str, scanner: str, url_ids: List[int]) -> Set[int]:
+    requested = set()
+    for url_ids_batch in chunks2(url_ids, PLANNED_SCAN_BATCH_SIZE):
+        requested.update(
+            PlannedScan.objects.all()
+            .filter(
+                activity=Activity[activity].value,
+                scanner=Scanner[scanner].value,
+                url__in=url_ids_batch,
+                state__in=[State["requested"].value, State["picked_up"].value],
+            )
+            .values_list("url_id", flat=True)
+        )
+    return requested
+
+
+def to_url_ids(urls: List[Union[Url, int]]) -> List[int]:
+    # Urls are passed as objects when called directly, and as id's when called via a (json serialized) task.
+    return [url.pk if isinstance(url, Url) else url for url in urls]
+
+
 @app.task(queue="storage")
 def finish(activity: str, scanner: str, url_id: int):
     set_scan_state(activity, scanner, url_id, "finished")
@@ -186,10 +260,29 @@ def set_scan_state(activity: str, scanner: str, url_id: int, state="finished"):
         log.debug(f"No planned scan found for {url_id}. Ignored.")
 
 
+def set_scan_state_multiple(activity: str, scanner: str, urls: List[Union[Url, int]], state="finished"):
+    # A url is requested only once while it's requested or picked up, so there is one picked up scan per url.
+    now = datetime.now(pytz.utc)
+    altered = 0
+    for url_ids in chunks2(to_url_ids(urls), PLANNED_SCAN_BATCH_SIZE):
+        altered += (
+            PlannedScan.objects.all()
+            .filter(
+                activity=Activity[activity].value,
+                scanner=Scanner[scanner].value,
+                url__in=url_ids,
+                state=State["picked_up"].value,
+            )
+            .update(state=State[state].value, last_state_change_at=now, finished_at_when=now)
+        )
+
+    log.debug(f"Altered planned scan state of {altered} out of {len(urls)} urls to {state}.")
+
+
 @app.task(queue="storage")
-def finish_multiple(activity: str, scanner: str, urls: List[int]):
-    for url in urls:
-        finish(activity, scanner, url)
+def finish_multiple(activity: str, scanner: str, urls: List[Union[Url, int]]):
+    set_scan_state_multiple(activity, scanner, urls, "finished")
+    statsd.incr(f"scan.planned.finish.{scanner}.{activity}", count=len(urls))
 
 
 def retrieve_endpoints_from_urls(
@@ -240,31 +333,23 @@ def websecmap_list_outdated():
 def list_outdated(published_scan_types):
     for map_configuration in filter_map_configs():
         print(f"Outdated items for {map_configuration['country']}/{map_configuration['organization_type__name']}:")
-        organizations_on_map = Organization.objects.all().filter(
-            country=map_configuration["country"], type=map_configuration["organization_type"]
-        )
         # Outdated is earlier than the map_health says something is outdated. Otherwise we're always
         # one day behind with scans, and thus is always something outdated.
-        outdated = get_outdated_ratings(organizations_on_map, 24 * 5)
-        relevant_outdated = [item for item in outdated if item.get("scan_type", "unknown") in published_scan_types]
+        outdated = get_outdated_scans(map_configuration, published_scan_types, 24 * 5)
         plan = []
-        for outdated_result in relevant_outdated:
-            scanner = SCAN_TYPES_TO_SCANNER[outdated_result["scan_type"]]
+        for outdated_result in outdated:
+            scanner = SCAN_TYPES_TO_SCANNER[outdated_result["type"]]
             plan.append(
                 {
                     "scanner": Scanner[scanner["name"]].value,
-                    "url": outdated_result["url"],
+                    "url": outdated_result["url_name"],
                     "activity": Activity["scan"].value,
-                    "last_scan": outdated_result["last_scan"],
-                    "scan": outdated_result["scan"],
+                    "last_scan": outdated_result["last_scan_moment"],
+                    "scan": outdated_result["id"],
                 }
             )
         plan = deduplicate_plan(plan)
 
-        # update the dates to match:
-        for activity in plan:
-            activity["last_scan"] = dateutil.parser.isoparse(activity["last_scan"])
-
         plan = sorted(plan, key=lambda mplan: mplan["last_scan"])
         print(f" For a total of {len(plan)} items:")
         print("-------------------------------------------------------------------------------------------------------")
@@ -280,16 +365,57 @@ def list_outdated(published_scan_types):
 
 
 def deduplicate_plan(planned_items):
-    hashed_items = []
-    clean_plan = []
+    clean_plan = {}
     for item in planned_items:
-        hashed_item = f"{item['activity']} {item['scanner']} {item['url']}"
+        clean_plan.setdefault((item["activity"], item["scanner"], item["url"]), item)
 
-        if hashed_item not in hashed_items:
-            hashed_items.append(hashed_item)
-            clean_plan.append(item)
+    return list(clean_plan.values())
 
-    return clean_plan
+
+def get_outdated_scans(
+    map_configuration: Dict[str, Any], published_scan_types: List[str], expiry_time_hours: int
+) -> List[Dict[str, Any]]:
+    """
+    The latest scans of alive urls and endpoints of the organizations on a map, that have not been performed in the
+    given amount of hours. This contains the id, type and last_scan_moment of the scan and the url_id and url_name of
+    the url that was scanned.
+    """
+
+    a_while_ago = datetime.now(pytz.utc) - timedelta(hours=expiry_time_hours)
+
+    # A url can be in multiple organizations on the same map, so the join can give the same scan multiple times.
+    endpoint_scans = (
+        EndpointGenericScan.objects.all()
+        .filter(
+            is_the_latest_scan=True,
+            last_scan_moment__lt=a_while_ago,
+            type__in=published_scan_types,
+            endpoint__is_dead=False,
+            endpoint__url__is_dead=False,
+            endpoint__url__not_resolvable=False,
+            endpoint__url__organization__country=map_configuration["country"],
+            endpoint__url__organization__type=map_configuration["organization_type"],
+        )
+        .values("id", "type", "last_scan_moment", url_id=F("endpoint__url__id"), url_name=F("endpoint__url__url"))
+        .distinct()
+    )
+
+    url_scans = (
+        UrlGenericScan.objects.all()
+        .filter(
+            is_the_latest_scan=True,
+            last_scan_moment__lt=a_while_ago,
+            type__in=published_scan_types,
+            url__is_dead=False,
+            url__not_resolvable=False,
+            url__organization__country=map_configuration["country"],
+            url__organization__type=map_configuration["organization_type"],
+        )
+        .values("id", "type", "last_scan_moment", "url_id", url_name=F("url__url"))
+        .distinct()
+    )
+
+    return list(endpoint_scans) + list(url_scans)
 
 
 @app.task(queue="storage")
@@ -297,25 +423,18 @@ def plan_outdated_scans(published_scan_types):
     for map_configuration in filter_map_configs():
         log.debug(f"Retrieving outdated scans from config: {map_configuration}.")
 
-        organizations_on_map = Organization.objects.all().filter(
-            country=map_configuration["country"], type=map_configuration["organization_type"]
-        )
-
-        log.debug(f"There are {len(organizations_on_map)} organizations on this map.")
-
         # Outdated is earlier than the map_health says something is outdated. Otherwise we're always
         # one day behind with scans, and thus is always something outdated.
-        outdated = get_outdated_ratings(organizations_on_map, 24 * 5)
-        relevant_outdated = [item for item in outdated if item.get("scan_type", "unknown") in published_scan_types]
+        outdated = get_outdated_scans(map_configuration, published_scan_types, 24 * 5)
 
         # plan scans for outdated results:
         plan = []
-        for outdated_result in relevant_outdated:
-            scanner = SCAN_TYPES_TO_SCANNER[outdated_result["scan_type"]]
+        for outdated_result in outdated:
+            scanner = SCAN_TYPES_TO_SCANNER[outdated_result["type"]]
             plan.append(
                 {
                     "scanner": scanner["name"],
-                    "url": outdated_result["url"],
+                    "url": outdated_result["url_id"],
                     "activity": "scan",
                 }
             )
@@ -331,28 +450,28 @@ def plan_outdated_scans(published_scan_types):
                         underlaying_scanner_details["can discover urls"],
                     ]
                 ):
-                    plan.append({"scanner": underlaying_scanner, "url": outdated_result["url"], "activity": "discover"})
+                    plan.append(
+                        {"scanner": underlaying_scanner, "url": outdated_result["url_id"], "activity": "discover"}
+                    )
                 if any(
                     [
                         underlaying_scanner_details["can verify endpoints"],
                         underlaying_scanner_details["can verify urls"],
                     ]
                 ):
-                    plan.append({"scanner": underlaying_scanner, "url": outdated_result["url"], "activity": "verify"})
+                    plan.append(
+                        {"scanner": underlaying_scanner, "url": outdated_result["url_id"], "activity": "verify"}
+                    )
 
         # there can be many duplicate tasks, especially when there are multiple scan results from a single scanner.
         clean_plan = deduplicate_plan(plan)
 
-        # make sure the urls are actual urls. Only plan for alive urls anyway.
-        clean_plan_with_urls = []
+        # and finally, plan it. All urls of the same activity and scanner are requested at once.
+        urls_per_task = defaultdict(list)
         for item in clean_plan:
-            url = Url.objects.all().filter(url=item["url"], is_dead=False, not_resolvable=False).first()
-            if url:
-                item["url"] = url
-                clean_plan_with_urls.append(item)
+            urls_per_task[(item["activity"], item["scanner"])].append(item["url"])
 
-        # and finally, plan it...
-        for item in clean_plan_with_urls:
-            request(item["activity"], item["scanner"], [item["url"]])
+        for (activity, scanner), url_ids in urls_per_task.items():
+            request(activity, scanner, url_ids)
 
-        log.debug(f"Planned {len(clean_plan_with_urls)} scans / verify and discovery tasks.")
+        log.debug(f"Planned {len(clean_plan)} scans / verify and discovery tasks.")
@@ -1,14 +1,18 @@
+import asyncio
 import logging
+import math
+import ssl
+from base64 import b64encode
 from datetime import datetime, timedelta
 from http.client import BadStatusLine
-from multiprocessing.pool import ThreadPool
-from time import sleep
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
+from urllib.parse import unquote, urlparse
 
 import pytz
 import requests
 from constance import config
-from django.db import transaction
+from celery import group
+from django.db.models import F, Q
 from requests.exceptions import ConnectTimeout, ProxyError, SSLError
 from tenacity import RetryError, before_log, retry, stop_after_attempt, wait_fixed
 from urllib3.exceptions import ProtocolError
@@ -19,82 +23,111 @@ from websecmap.scanners.models import ScanProxy
 PROXY_NETWORK_TIMEOUT = 30
 PROXY_SERVER_TIMEOUT = 30
 
+# A claimed proxy can be claimed again after this time, in case the scan that claimed it crashed.
+PROXY_CLAIM_LEASE = timedelta(hours=3)
+
+# Seconds until a claim is tried again when there is no proxy available.
+CLAIM_RETRY_DELAY = 60
+
+# The amount of proxies that is tried when other claims are taking the fastest proxies at the same time.
+CLAIM_CANDIDATES = 10
+
+# Latency is measured by setting up a connection to this host via the proxy.
+LATENCY_MEASUREMENT_HOST = "api.ssllabs.com"
+LATENCY_MEASUREMENT_TIMEOUT = 10
+MEASUREMENTS_PER_CHECK = 3
+MAX_CONCURRENT_MEASUREMENTS = 100
+
+# The amount of latency measurements per proxy used for the percentiles and the error rate.
+LATENCY_WINDOW_SIZE = 30
+
+# Proxies that fail more often than this are not claimed.
+MAX_ERROR_RATE = 0.5
+
+# How bad a failed request is in the score of a proxy, comparable to a network timeout.
+ERROR_PENALTY_IN_MS = PROXY_NETWORK_TIMEOUT * 1000
+
 log = logging.getLogger(__name__)
 
 
-@app.task(queue="claim_proxy")
-def claim_proxy(tracing_label="") -> Dict[str, Any]:
+@app.task(queue="claim_proxy", bind=True, max_retries=None)
+def claim_proxy(self, tracing_label="") -> Dict[str, Any]:
     """A proxy should first be claimed and then checked. If not, several scans might use the same proxy and thus
     crash.
 
-    This is run on a dedicated worker as this is a blocking task.
+    A claim is a lease: it expires after PROXY_CLAIM_LEASE, after which the proxy can be claimed again. This prevents
+    proxies from being claimed forever when a scan crashes without releasing the proxy.
+
+    When no proxy is available, this task is retried after CLAIM_RETRY_DELAY seconds. The worker is free to handle other
+    claims in the meantime.
 
     There used to be rate limiting to 30/hour. But that is not needed anymore since all scan tasks are now planned.
     These planned tasks claim whatever free proxy is available, if there are none, no proxies are even attempted to
     be claimed.
     """
 
+    log.debug(f"Attempting to claim a proxy to scan {tracing_label} et al...")
+
     # try to get the first available, fastest, proxy
-    while True:
+    proxy = claim_available_proxy()
+    if proxy:
+        log.debug(f"Proxy {proxy.id} claimed for {tracing_label} et al...")
 
-        log.debug(f"Attempting to claim a proxy to scan {tracing_label} et al...")
+        # we can't check for proxy quality here, as that will fill up the strorage with long tasks.
+        # instead run the proxy checking worker every hour or so to make sure the list stays fresh.
+        return {"id": proxy.pk, "address": proxy.address, "protocol": proxy.protocol}
 
-        try:
+    # do not log an error here, when forgetting to add proxies or if there are no clean proxies anymore,
+    # the queue might fill up with too many claim_proxy tasks. This can lead up to 30.000 issues per day.
+    # When you have over 500 proxy requests, things are off. It's better to start with a clean slate then.
+    log.debug(
+        f"No proxies available for {tracing_label} et al. "
+        f"You can add more proxies to solve this. Will try again in {CLAIM_RETRY_DELAY} seconds."
+    )
+    raise self.retry(countdown=CLAIM_RETRY_DELAY)
 
-            with transaction.atomic():
-
-                # proxies can die if they are limited too often.
-                proxy = (
-                    ScanProxy.objects.all()
-                    .filter(
-                        is_dead=False,
-                        currently_used_in_tls_qualys_scan=False,
-                        manually_disabled=False,
-                        request_speed_in_ms__gte=1,
-                        # proxies that are too slow tend to have timeout errors
-                        # self hosted proxies are between 150 and 300 ms.
-                        # more proxy checks at the same time make slower results... disabled for now
-                        # request_speed_in_ms__lte=2000
-                    )
-                    .order_by("request_speed_in_ms")
-                    .first()
-                )
-
-                if proxy:
-
-                    # first claim to prevent duplicate claims
-                    log.debug(f"Proxy {proxy.id} claimed for {tracing_label} et al...")
-                    proxy.currently_used_in_tls_qualys_scan = True
-                    proxy.last_claim_at = datetime.now(pytz.utc)
-                    proxy.save(update_fields=["currently_used_in_tls_qualys_scan", "last_claim_at"])
-
-                    # we can't check for proxy quality here, as that will fill up the strorage with long tasks.
-                    # instead run the proxy checking worker every hour or so to make sure the list stays fresh.
-                    # if check_proxy(proxy):
-                    #    log.debug('Using proxy %s for scan.' % proxy)
-                    return {"id": proxy.pk, "address": proxy.address, "protocol": proxy.protocol}
-                    # else:
-                    #     log.debug('Proxy %s was not suitable for scanning. Trying another one in 60 seconds.' % proxy)
-
-                else:
-                    # do not log an error here, when forgetting to add proxies or if there are no clean proxies anymore,
-                    # the queue might fill up with too many claim_proxy tasks. Each of them continuing in their own
-                    # thread
-                    # to get a proxy every 2 minutes (30/h). This can lead up to 30.000 issues per day.
-                    # When you have over 500 proxy requests, things are off. It's better to start with a clean
-                    # slate then.
-                    log.debug(
-                        f"No proxies available for {tracing_label} et al. "
-                        f"You can add more proxies to solve this. Will try again in 60 seconds."
-                    )
-
-        except BaseException as e:
-            # In some rare cases this method crashes, while it should be as reliable as can be.
-            log.error(f"Exception occurred when requesting a proxy for {tracing_label} et al")
-            log.exception(e)
-            raise e
-
-        sleep(60)
+
+def claim_available_proxy() -> Optional[ScanProxy]:
+    """
+    Claims the fastest proxy that is not claimed, or of which the claim expired. A claim is made with a conditional
+    update, which only succeeds if nobody claimed the proxy in the meantime. So there is no need for locking.
+    """
+    now = datetime.now(pytz.utc)
+
+    # proxies can die if they are limited too often.
+    candidates = (
+        ScanProxy.objects.all()
+        .filter(
+            q_claimable(now),
+            is_dead=False,
+            manually_disabled=False,
+            request_speed_in_ms__gte=1,
+            # flaky proxies cause scans that stall for hours.
+            error_rate__lte=MAX_ERROR_RATE,
+            # proxies that are too slow tend to have timeout errors
+            # self hosted proxies are between 150 and 300 ms.
+            # more proxy checks at the same time make slower results... disabled for now
+            # request_speed_in_ms__lte=2000
+        )
+        # proxies of which the latency has not been measured yet are used last.
+        .order_by(F("score").asc(nulls_last=True), "request_speed_in_ms")
+        .only("id", "address", "protocol")
+    )
+
+    for proxy in candidates[:CLAIM_CANDIDATES]:
+        claimed = (
+            ScanProxy.objects.all()
+            .filter(q_claimable(now), pk=proxy.pk)
+            .update(currently_used_in_tls_qualys_scan=True, last_claim_at=now)
+        )
+        if claimed:
+            return proxy
+
+    return None
+
+
+def q_claimable(now: datetime) -> Q:
+    return Q(currently_used_in_tls_qualys_scan=False) | Q(last_claim_at__lt=now - PROXY_CLAIM_LEASE)
 
 
 @app.task(queue="storage")
@@ -112,44 +145,119 @@ def release_proxy(proxy: Dict[str, Any], tracing_label=""):
 
 @app.task(queue="storage")
 def check_all_proxies():
-    # celery doesn't work with asyncio. But it does work with threadpools.
+    timeout_claims()
 
-    pool = ThreadPool(100)
+    proxies = [proxy.as_dict() for proxy in ScanProxy.objects.all()]
 
-    timeout_claims()
+    # The latency of all proxies is measured at the same time, with a strict timeout.
+    store_latency_measurements(asyncio.run(measure_proxies(proxies)))
+
+    # The capacity at qualys is checked per proxy, on the workers that can reach the internet.
+    group([check_proxy.si(proxy) for proxy in proxies]).apply_async()
+
+
+async def measure_proxies(proxies: List[Dict[str, Any]]) -> Dict[int, List[Optional[int]]]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_MEASUREMENTS)
+    measurements = await asyncio.gather(*[measure_proxy(semaphore, proxy["address"]) for proxy in proxies])
+    return {proxy["id"]: measurement for proxy, measurement in zip(proxies, measurements)}
+
+
+async def measure_proxy(semaphore: asyncio.Semaphore, address: str) -> List[Optional[int]]:
+    async with semaphore:
+        return [await measure_latency(address) for _ in range(MEASUREMENTS_PER_CHECK)]
 
-    proxies = ScanProxy.objects.all()
+
+async def measure_latency(address: str) -> Optional[int]:
+    """
+    The time it takes to set up a tunnel to the qualys api via the proxy, in milliseconds. This is the first step of
+    every request to qualys. None when the proxy failed or did not respond in time.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        connected = await asyncio.wait_for(open_tunnel(address, LATENCY_MEASUREMENT_HOST), LATENCY_MEASUREMENT_TIMEOUT)
+    except (asyncio.TimeoutError, OSError, ValueError) as e:
+        log.debug(f"Could not measure latency of proxy {address}: {e!r}")
+        return None
+
+    return round((loop.time() - started) * 1000) if connected else None
+
+
+async def open_tunnel(address: str, host: str) -> bool:
+    proxy = urlparse(address)
+    if not proxy.hostname:
+        raise ValueError(f"Proxy address {address} has no host.")
+
+    request = f"CONNECT {host}:443 HTTP/1.1\r\nHost: {host}:443\r\n"
+    if proxy.username:
+        credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+        request += f"Proxy-Authorization: Basic {b64encode(credentials.encode()).decode()}\r\n"
+
+    # https proxies are contacted over tls, the certificate is not checked, as many proxies use their ip address.
+    context = None
+    if proxy.scheme == "https":
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE  # nosec only the latency is measured
+
+    port = proxy.port or (443 if proxy.scheme == "https" else 80)
+    reader, writer = await asyncio.open_connection(proxy.hostname, port, ssl=context)
+    try:
+        writer.write(f"{request}\r\n".encode())
+        await writer.drain()
+        status_line = await reader.readline()
+    finally:
+        writer.close()
+
+    # HTTP/1.1 200 Connection established
+    return status_line.split(b" ")[1:2] == [b"200"]
+
+
+def store_latency_measurements(measurements: Dict[int, List[Optional[int]]]):
+    proxies = list(ScanProxy.objects.all().filter(pk__in=measurements.keys()).only("id", "latency_window"))
     for proxy in proxies:
-        pool.apply_async(check_proxy, [proxy.as_dict()])
+        proxy.latency_window = (list(proxy.latency_window or []) + measurements[proxy.pk])[-LATENCY_WINDOW_SIZE:]
 
-    pool.close()
-    pool.join()
+        latencies = sorted(latency for latency in proxy.latency_window if latency is not None)
+        proxy.latency_p50_in_ms = percentile(latencies, 50)
+        proxy.latency_p95_in_ms = percentile(latencies, 95)
+        proxy.error_rate = (len(proxy.latency_window) - len(latencies)) / len(proxy.latency_window)
+        proxy.score = proxy_score(proxy.latency_p95_in_ms, proxy.error_rate)
 
+    ScanProxy.objects.bulk_update(
+        proxies, ["latency_window", "latency_p50_in_ms", "latency_p95_in_ms", "error_rate", "score"]
+    )
 
-def timeout_claims():
-    for proxy in ScanProxy.objects.all():
-        release_claim_after_timeout(proxy.as_dict())
 
+def percentile(sorted_values: List[int], percent: int) -> Optional[int]:
+    """Nearest rank percentile."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
 
-def release_claim_after_timeout(proxy: Dict[str, Any]):
-    # Release all proxies that have been claimed a few hours before. As a scan of 25 addresss takes about 45 minutes.
-    # And in bad cases only double that. So let's quadruple that time and then just release the proxy automatically
-    # because of a timeout. Last claim at can be empty.
 
-    db_proxy = ScanProxy.objects.all().filter(pk=proxy["id"]).first()
-    if not db_proxy:
-        return
+def proxy_score(latency_p95_in_ms: Optional[int], error_rate: float) -> float:
+    """
+    Lower is better. A qualys scan consists of many requests over a long time, so the slow requests matter more than
+    the typical one, and a failed request costs a network timeout. A proxy that never worked gets the worst score.
+    """
+    if latency_p95_in_ms is None:
+        return ERROR_PENALTY_IN_MS
+    return latency_p95_in_ms + error_rate * ERROR_PENALTY_IN_MS
 
-    if db_proxy.last_claim_at:
-        if all(
-            [
-                db_proxy.last_claim_at < datetime.now(pytz.utc) - timedelta(hours=3),
-                db_proxy.currently_used_in_tls_qualys_scan,
-            ]
-        ):
-            log.warning(f"Force released proxy {db_proxy.pk} because of a claim timeout period of 3 hours.")
-            db_proxy.currently_used_in_tls_qualys_scan = False
-            db_proxy.save(update_fields=["currently_used_in_tls_qualys_scan"])
+
+def timeout_claims():
+    """
+    Release all proxies of which the claim expired. A scan of 25 addresses takes about 45 minutes, and in bad cases only
+    double that. So the claim lease is about quadruple that time. Last claim at can be empty.
+    """
+    released = (
+        ScanProxy.objects.all()
+        .filter(currently_used_in_tls_qualys_scan=True, last_claim_at__lt=datetime.now(pytz.utc) - PROXY_CLAIM_LEASE)
+        .update(currently_used_in_tls_qualys_scan=False)
+    )
+    if released:
+        log.warning(f"Force released {released} proxies because of a claim timeout period of {PROXY_CLAIM_LEASE}.")
 
 
 @app.task(queue="internet")
@@ -393,7 +501,7 @@ def service_provider_status(proxy: Dict[str, Any]):
         response.headers.get("X-Max-Assessments", 25),
         response.headers.get("X-Current-Assessments", 0),
         response.headers.get("X-ClientMaxAssessments", 25),
-        proxy.id,
+        proxy["id"],
     )
 
     return {
@@ -0,0 +1,297 @@
+"""
+Shared DNS resolver for scanners.
+
+Several scanners resolve the same hostnames within minutes of each other: endpoint discovery, dns endpoints, subdomain
+verification and adding urls all ask for A and AAAA records. This resolver caches answers for the TTL of the record,
+in process (a small LRU) and optionally in redis so all workers share the cache.
+
+Results are lists of record values as text. None means the name could not be resolved: it does not exist, or the
+nameservers failed or timed out. Failures are not cached. An empty list means the name exists, but has no records of the
+requested type.
+
+There is a synchronous resolve and an asynchronous resolve_async. The async version resolves many names in parallel
+over all configured nameservers and deduplicates lookups that are in flight. Use resolve_all to resolve many names from
+synchronous code.
+
+Note that nameservers are stored in the database (constance), which cannot be queried inside an event loop. So the
+async functions require the nameservers to be passed. The redis cache is used from a thread, so it does not block the
+event loop. When redis cannot be reached, it is not used for a while.
+
+When resolving a lot of names at once, use a NameserverRateLimit to not flood the nameservers with queries. When most of
+these names are guesses that do not exist, disable cache_negative so the cache is not filled with those.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import dns.asyncresolver
+import dns.resolver
+import redis
+from django.conf import settings
+from dns.exception import DNSException
+from dns.resolver import NXDOMAIN, NoAnswer
+
+from websecmap.scanners.scanner.utils import get_nameservers
+
+log = logging.getLogger(__package__)
+
+# amount of answers kept in memory per process.
+CACHE_SIZE = 10000
+
+# Names that do not exist, or names without the requested record, are cached briefly.
+NEGATIVE_TTL = 60
+
+# Some records have a TTL of days, changes should still be visible in the next scan.
+MAXIMUM_TTL = 3600
+
+# The time for a single query, the default of dnspython is 5 seconds per nameserver and retries for 30 seconds.
+QUERY_LIFETIME = 10
+
+Records = Optional[List[str]]
+
+# (hostname, record_type) -> (expires at, records)
+cache: "OrderedDict[Tuple[str, str], Tuple[float, Records]]" = OrderedDict()
+
+# lookups that are being performed, per event loop, so the same name is only asked once at the same time.
+in_flight: Dict[Tuple[asyncio.AbstractEventLoop, str, str], asyncio.Task] = {}
+
+# After an error, redis is not used for this amount of seconds, so lookups don't wait for a cache that is down.
+REDIS_RETRY_INTERVAL = 60
+
+redis_connection = None
+redis_unavailable_until = 0.0
+
+
+def resolve(hostname: str, record_type: str = "A", nameservers: List[str] = None) -> Records:
+    key = cache_key(hostname, record_type)
+    found, records = get_cached(key)
+    if found:
+        return records
+
+    resolver = dns.resolver.Resolver(configure=False)
+    resolver.nameservers = nameservers if nameservers else get_nameservers()
+    resolver.lifetime = QUERY_LIFETIME
+
+    try:
+        answer = resolver.resolve(hostname, record_type, search=False)
+    except DNSException as exception:
+        return store(key, *handle_exception(hostname, record_type, exception))
+
+    return store(key, *handle_answer(answer))
+
+
+class NameserverRateLimit:
+    """Spreads queries over all nameservers, and sends at most queries_per_second queries to every nameserver."""
+
+    def __init__(self, nameservers: List[str], queries_per_second: float):
+        self.interval = 1 / queries_per_second
+        # the moment, in event loop time, the next query can be sent to a nameserver.
+        self.next_query = {nameserver: 0.0 for nameserver in nameservers}
+
+    async def nameservers(self) -> List[str]:
+        """Waits for the nameserver that is available first. Returns all nameservers, starting with that one."""
+        now = asyncio.get_running_loop().time()
+        nameserver = min(self.next_query, key=self.next_query.get)
+        turn = max(now, self.next_query[nameserver])
+        self.next_query[nameserver] = turn + self.interval
+
+        await asyncio.sleep(turn - now)
+        return [nameserver] + [other for other in self.next_query if other != nameserver]
+
+
+async def resolve_async(
+    hostname: str,
+    record_type: str,
+    nameservers: List[str],
+    rate_limit: NameserverRateLimit = None,
+    cache_negative: bool = True,
+) -> Records:
+    key = cache_key(hostname, record_type)
+    found, records = await get_cached_async(key)
+    if found:
+        return records
+
+    loop = asyncio.get_running_loop()
+    in_flight_key = (loop, *key)
+    if in_flight_key not in in_flight:
+        lookup = loop.create_task(query_async(key, nameservers, rate_limit, cache_negative))
+        in_flight[in_flight_key] = lookup
+        lookup.add_done_callback(lambda _: in_flight.pop(in_flight_key, None))
+
+    # shielded: a cancelled caller does not cancel the lookup for the others that wait for it.
+    return await asyncio.shield(in_flight[in_flight_key])
+
+
+async def query_async(
+    key: Tuple[str, str], nameservers: List[str], rate_limit: NameserverRateLimit = None, cache_negative: bool = True
+) -> Records:
+    hostname, record_type = key
+
+    resolver = dns.asyncresolver.Resolver(configure=False)
+    resolver.lifetime = QUERY_LIFETIME
+    if rate_limit:
+        # the other nameservers are only asked when the first one fails.
+        resolver.nameservers = await rate_limit.nameservers()
+    else:
+        # the nameservers are rotated, so parallel lookups are spread over all nameservers.
+        resolver.nameservers = nameservers
+        resolver.rotate = True
+
+    try:
+        records, ttl = handle_answer(await resolver.resolve(hostname, record_type, search=False))
+    except DNSException as exception:
+        records, ttl = handle_exception(hostname, record_type, exception)
+
+    if not records and not cache_negative:
+        return records
+
+    return await store_async(key, records, ttl)
+
+
+async def resolve_many_async(
+    hostnames: List[str], record_type: str, nameservers: List[str], rate_limit: NameserverRateLimit = None
+) -> Dict[str, Records]:
+    records = await asyncio.gather(
+        *[resolve_async(hostname, record_type, nameservers, rate_limit) for hostname in hostnames]
+    )
+    return dict(zip(hostnames, records))
+
+
+def resolve_all(hostnames: List[str], record_type: str = "A") -> Dict[str, Records]:
+    """Resolves all hostnames in parallel, from synchronous code. Do not call this from within an event loop."""
+    return asyncio.run(resolve_many_async(hostnames, record_type, get_nameservers()))
+
+
+def handle_answer(answer) -> Tuple[Records, int]:
+    return [record.to_text() for record in answer], answer.rrset.ttl
+
+
+def handle_exception(hostname: str, record_type: str, exception: DNSException) -> Tuple[Records, int]:
+    if isinstance(exception, NXDOMAIN):
+        log.debug(f"dns query name does not exist. {hostname} {record_type}")
+        return None, NEGATIVE_TTL
+
+    if isinstance(exception, NoAnswer):
+        log.debug(f"The DNS response does not contain an answer to the question. {hostname} {record_type}")
+        return [], NEGATIVE_TTL
+
+    # timeouts, no nameservers that give an answer and invalid names.
+    log.debug(f"Could not resolve {hostname} {record_type}: {exception!r}")
+    return None, 0
+
+
+def cache_key(hostname: str, record_type: str) -> Tuple[str, str]:
+    return hostname.lower().rstrip("."), record_type.upper()
+
+
+def get_cached(key: Tuple[str, str]) -> Tuple[bool, Records]:
+    found, records = get_local(key)
+    if found:
+        return found, records
+
+    return get_shared(key)
+
+
+async def get_cached_async(key: Tuple[str, str]) -> Tuple[bool, Records]:
+    found, records = get_local(key)
+    if found or not get_redis():
+        return found, records
+
+    return await asyncio.get_running_loop().run_in_executor(None, get_shared, key)
+
+
+def get_local(key: Tuple[str, str]) -> Tuple[bool, Records]:
+    if key in cache:
+        expires, records = cache[key]
+        if expires > time.time():
+            cache.move_to_end(key)
+            return True, records
+        del cache[key]
+
+    return False, None
+
+
+def get_shared(key: Tuple[str, str]) -> Tuple[bool, Records]:
+    shared = get_redis()
+    if not shared:
+        return False, None
+
+    try:
+        value, ttl = shared.pipeline().get(redis_key(key)).ttl(redis_key(key)).execute()
+    except redis.RedisError as exception:
+        redis_failed(f"Could not read from the dns cache: {exception}")
+        return False, None
+
+    if value is not None and ttl > 0:
+        records = json.loads(value)
+        store_locally(key, records, ttl)
+        return True, records
+
+    return False, None
+
+
+def store(key: Tuple[str, str], records: Records, ttl: int) -> Records:
+    ttl = min(ttl, MAXIMUM_TTL)
+    if ttl > 0:
+        store_locally(key, records, ttl)
+        store_shared(key, records, ttl)
+
+    return records
+
+
+async def store_async(key: Tuple[str, str], records: Records, ttl: int) -> Records:
+    ttl = min(ttl, MAXIMUM_TTL)
+    if ttl > 0:
+        store_locally(key, records, ttl)
+        if get_redis():
+            await asyncio.get_running_loop().run_in_executor(None, store_shared, key, records, ttl)
+
+    return records
+
+
+def store_locally(key: Tuple[str, str], records: Records, ttl: int):
+    cache[key] = (time.time() + ttl, records)
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def store_shared(key: Tuple[str, str], records: Records, ttl: int):
+    shared = get_redis()
+    if not shared:
+        return
+
+    try:
+        shared.setex(redis_key(key), ttl, json.dumps(records))
+    except redis.RedisError as exception:
+        redis_failed(f"Could not write to the dns cache: {exception}")
+
+
+def clear_cache():
+    cache.clear()
+
+
+def redis_key(key: Tuple[str, str]) -> str:
+    return "dns:%s:%s" % key
+
+
+def get_redis() -> Optional[redis.Redis]:
+    global redis_connection
+
+    if not settings.DNS_CACHE_REDIS_URL or time.monotonic() < redis_unavailable_until:
+        return None
+
+    if redis_connection is None:
+        redis_connection = redis.Redis.from_url(settings.DNS_CACHE_REDIS_URL, socket_timeout=1)
+
+    return redis_connection
+
+
+def redis_failed(message: str):
+    global redis_unavailable_until
+
+    log.debug(f"{message}. Not using the dns cache for {REDIS_RETRY_INTERVAL} seconds.")
+    redis_unavailable_until = time.monotonic() + REDIS_RETRY_INTERVAL
@@ -1,95 +1,131 @@
 import logging
+from collections import defaultdict
 from datetime import datetime
+from typing import List, Tuple, Type, Union
 
 import pytz
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.dispatch import Signal
 
-from websecmap.scanners.models import Endpoint, EndpointGenericScan, Url, UrlGenericScan
+from websecmap.scanners.models import EndpointGenericScan, UrlGenericScan
+from websecmap.scanners.scanner.__init__ import chunks2
 
 log = logging.getLogger(__package__)
 
 
-def store_endpoint_scan_result(scan_type: str, endpoint_id: int, rating: str, message: str, evidence: str = ""):
+# A scan result: scan_type, endpoint or url id, rating, message and optionally evidence.
+ScanResult = Union[Tuple[str, int, str, str], Tuple[str, int, str, str, str]]
 
-    # Check if the latest scan has the same rating or not:
-    try:
-        gs = EndpointGenericScan.objects.all().filter(type=scan_type, endpoint=endpoint_id).latest("last_scan_moment")
-        exists = True
-    except ObjectDoesNotExist:
-        exists = False
-        gs = EndpointGenericScan()
-
-    # To deduplicate data, only store changes to scans. We'll update just the scan moment, and the rest stays the same.
-    # The amount of data saved runs in the gigabytes. So it's worth the while doing it like this :)
-    if gs.explanation == str(message) and gs.rating == str(rating):
-        log.debug("Scan had the same rating and message, updating last_scan_moment only.")
-        gs.last_scan_moment = datetime.now(pytz.utc)
-        gs.save(update_fields=["last_scan_moment"])
-        return
-
-    # message and rating changed for this scan_type, so it's worth while to save the scan.
-    if not exists:
-        log.debug("No prior scan result found, creating a new one.")
-    else:
-        log.debug("Message or rating changed compared to previous scan. Saving the new scan result.")
-
-    gs = EndpointGenericScan()
-    gs.explanation = message
-    gs.rating = rating
-    gs.endpoint = Endpoint.objects.all().filter(id=endpoint_id).first()
-    gs.type = scan_type
-    gs.evidence = evidence
-    gs.last_scan_moment = datetime.now(pytz.utc)
-    gs.rating_determined_on = datetime.now(pytz.utc)
-    gs.is_the_latest_scan = True
-    gs.save()
-
-    # Set all the previous endpoint scans of this endpoint + type to NOT be the latest scan.
-    EndpointGenericScan.objects.all().filter(endpoint=gs.endpoint, type=gs.type).exclude(pk=gs.pk).update(
-        is_the_latest_scan=False
-    )
+# The max number of scan results stored at once, well below the max number of variables in a query on SQLite.
+SCAN_RESULT_BATCH_SIZE = 500
+
+# Sent after scan results are stored, with the scans that were added because their rating or message changed.
+# The sender is the model of these scans: EndpointGenericScan or UrlGenericScan.
+scans_created = Signal()
+
+
+def store_endpoint_scan_result(scan_type: str, endpoint_id: int, rating: str, message: str, evidence: str = ""):
+    store_endpoint_scan_results([(scan_type, endpoint_id, rating, message, evidence)])
 
 
 def store_url_scan_result(scan_type: str, url_id: int, rating: str, message: str, evidence: str = ""):
+    store_url_scan_results([(scan_type, url_id, rating, message, evidence)])
 
-    # Check if the latest scan has the same rating or not:
-    try:
-        gs = (
-            UrlGenericScan.objects.all()
+
+def store_endpoint_scan_results(results: List[ScanResult]):
+    store_scan_results(EndpointGenericScan, "endpoint_id", results)
+
+
+def store_url_scan_results(results: List[ScanResult]):
+    store_scan_results(UrlGenericScan, "url_id", results)
+
+
+def store_scan_results(
+    model: Type[Union[EndpointGenericScan, UrlGenericScan]], subject: str, results: List[ScanResult]
+):
+    """
+    Stores many scan results at once. The latest scans are retrieved with one query per batch, after which the
+    unchanged scans get a new last_scan_moment and changed scans are added, both in a single query.
+
+    Results are handled in order: a result for the same scan type and endpoint / url is compared to the result before
+    it, also in the same batch.
+    """
+
+    for batch in chunks2(results, SCAN_RESULT_BATCH_SIZE):
+        now = datetime.now(pytz.utc)
+
+        # scan type, endpoint / url: the rating and message of the latest scan, with its id or the new scan.
+        latest_scans = {}
+        # scan type, endpoint / url: ids of the scans that are flagged as being the latest scan.
+        flagged_scans = defaultdict(list)
+        for scan in (
+            model.objects.all()
             .filter(
+                **{f"{subject}__in": {result[1] for result in batch}},
+                type__in={result[0] for result in batch},
+                is_the_latest_scan=True,
+            )
+            .only("id", "type", subject, "rating", "explanation", "last_scan_moment")
+            .order_by("last_scan_moment")
+        ):
+            key = (scan.type, getattr(scan, subject))
+            flagged_scans[key].append(scan.pk)
+            latest_scans[key] = {"rating": scan.rating, "explanation": scan.explanation, "id": scan.pk, "scan": None}
+
+        touched_scans = set()
+        replaced = set()
+        new_scans = []
+        for scan_type, subject_id, rating, message, *evidence in batch:
+            key = (scan_type, subject_id)
+            latest_scan = latest_scans.get(key, None)
+
+            # To deduplicate data, only store changes to scans. We'll update just the scan moment, and the rest stays
+            # the same. The amount of data saved runs in the gigabytes. So it's worth the while doing it like this :)
+            # While we have type hinting, it's still possible to pass in a boolean, so compare as strings.
+            if latest_scan and latest_scan["explanation"] == str(message) and latest_scan["rating"] == str(rating):
+                log.debug("Scan had the same rating and message, updating last_scan_moment only.")
+                if latest_scan["id"]:
+                    touched_scans.add(latest_scan["id"])
+                continue
+
+            # message and rating changed for this scan_type, so it's worth while to save the scan.
+            if not latest_scan:
+                log.debug("No prior scan result found, creating a new one.")
+            else:
+                log.debug("Message or rating changed compared to previous scan. Saving the new scan result.")
+                if latest_scan["scan"]:
+                    # added earlier in this batch
+                    latest_scan["scan"].is_the_latest_scan = False
+
+            gs = model(
                 type=scan_type,
-                url=url_id,
+                rating=rating,
+                explanation=message,
+                evidence=evidence[0] if evidence else "",
+                last_scan_moment=now,
+                rating_determined_on=now,
+                is_the_latest_scan=True,
+                **{subject: subject_id},
             )
-            .latest("last_scan_moment")
-        )
-    except ObjectDoesNotExist:
-        gs = UrlGenericScan()
-
-    # here we figured out that you can still pass a bool while type hinting.
-    # log.debug("Explanation new: '%s', old: '%s' eq: %s, Rating new: '%s', old: '%s', eq: %s" %
-    #           (message, gs.explanation, message == gs.explanation, rating, gs.rating, str(rating) == gs.rating))
-
-    # last scan had exactly the same result, so don't create a new scan and just update the last scan date.
-    # while we have type hinting, it's still possible to pass in a boolean and then you compare a str to a bool...
-    if gs.explanation == str(message) and gs.rating == str(rating):
-        log.debug("Scan had the same rating and message, updating last_scan_moment only.")
-        gs.last_scan_moment = datetime.now(pytz.utc)
-        gs.save(update_fields=["last_scan_moment"])
-    else:
-        # message and rating changed for this scan_type, so it's worth while to save the scan.
-        log.debug("Message or rating changed: making a new generic scan.")
-        gs = UrlGenericScan()
-        gs.explanation = message
-        gs.rating = rating
-        gs.url = Url.objects.all().filter(id=url_id).first()
-        gs.evidence = evidence
-        gs.type = scan_type
-        gs.last_scan_moment = datetime.now(pytz.utc)
-        gs.rating_determined_on = datetime.now(pytz.utc)
-        gs.is_the_latest_scan = True
-        gs.save()
-
-        UrlGenericScan.objects.all().filter(url=gs.url, type=gs.type).exclude(pk=gs.pk).update(is_the_latest_scan=False)
+            new_scans.append(gs)
+            latest_scans[key] = {"rating": str(rating), "explanation": str(message), "id": None, "scan": gs}
+            replaced.add(key)
+
+        with transaction.atomic():
+            model.objects.all().filter(pk__in=touched_scans).update(last_scan_moment=now)
+
+            # Set all the previous scans of these endpoints / urls and types to NOT be the latest scan.
+            model.objects.all().filter(pk__in=[pk for key in replaced for pk in flagged_scans[key]]).update(
+                is_the_latest_scan=False
+            )
+
+            model.objects.bulk_create(new_scans)
+
+        if new_scans:
+            scans_created.send(sender=model, scans=new_scans)
+
+        log.debug(f"Stored {len(batch)} scan results: {len(touched_scans)} updated, {len(new_scans)} new.")
 
 
 def endpoint_has_scans(scan_type: str, endpoint_id: int):
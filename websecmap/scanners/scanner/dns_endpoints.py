@@ -9,31 +9,37 @@ the same. So to save a lot of pain and trouble, we'll just fill the port and ip_
 # todo: can we check if the mail is routed outside of the country somehow? Due to privacy concerns / GDPR?
 """
 
+import asyncio
 import logging
-from time import sleep
-from typing import List
+from typing import Any, Dict, List, Tuple
 
 from celery import Task, group
-from dns.resolver import NXDOMAIN, NoAnswer, NoNameservers, Resolver, Timeout
-from tenacity import before_log, retry, stop_after_attempt, wait_exponential
 
 from websecmap.celery import app
 from websecmap.organizations.models import Url
 from websecmap.scanners import plannedscan
 from websecmap.scanners.models import Endpoint
 from websecmap.scanners.plannedscan import retrieve_endpoints_from_urls
+from websecmap.scanners.resolver import NameserverRateLimit, resolve, resolve_many_async
 from websecmap.scanners.scanner.__init__ import (
     add_model_filter,
+    chunks2,
     endpoint_filters,
     q_configurations_to_scan,
     unique_and_random,
     url_filters,
 )
-from websecmap.scanners.scanner.http import connect_result
+from websecmap.scanners.scanner.http import store_discovered_endpoints
 from websecmap.scanners.scanner.utils import get_nameservers
 
 log = logging.getLogger(__name__)
 
+# amount of urls of which the records are resolved in one task.
+DNS_BATCH_SIZE = 500
+
+# Be friendly to the public nameservers, this is about 250 queries per second with five nameservers.
+QUERIES_PER_SECOND_PER_NAMESERVER = 50
+
 
 def filter_discover(
     organizations_filter: dict = dict(), urls_filter: dict = dict(), endpoints_filter: dict = dict(), **kwargs
@@ -63,39 +69,26 @@ def filter_verify(
 
 
 def compose_new_discover_task(urls: List[Url]):
-    tasks = []
-
     # Endpoint life cycle helps with keeping track of scan results over time. For internet.nl scans we create a few
     # 'fake' endpoints that are used to store scan results. The fake endpoints have a default port of 25, and ipv4
     # but these could be alternative ports and ipv6 as well. That is because the internet.nl scanner summarizes things
     # mostly on the url level.
-    for url in urls:
-        tasks.append(
-            has_mx_without_cname.si(url.url)
-            | connect_result.s(protocol="dns_mx_no_cname", url_id=url.pk, port=0, ip_version=0)
-            | has_soa.si(url.url)
-            | connect_result.s(protocol="dns_soa", url_id=url.pk, port=0, ip_version=0)
-            | has_a_or_aaaa.si(url.url)
-            | connect_result.s(protocol="dns_a_aaaa", url_id=url.pk, port=0, ip_version=0)
-            | plannedscan.finish.si("discover", "dns_endpoints", url.pk)
-        )
-
-    return group(tasks)
+    return compose_probe_task(urls, "discover")
 
 
 def compose_new_verify_task(urls):
     endpoints = retrieve_endpoints_from_urls(urls, protocols=["dns_mx_no_cname", "dns_soa", "dns_a_aaaa"])
+    return compose_probe_task(list({endpoint.url for endpoint in endpoints}), "verify")
+
 
+def compose_probe_task(urls: List[Url], activity: str):
+    # All records of a batch of urls are resolved in one task, and stored in one go.
     tasks = []
-    for endpoint in endpoints:
+    for batch in chunks2(urls, DNS_BATCH_SIZE):
         tasks.append(
-            has_mx_without_cname.si(endpoint.url.url)
-            | connect_result.s(protocol="dns_mx_no_cname", url_id=endpoint.url.pk, port=0, ip_version=0)
-            | has_soa.si(endpoint.url.url)
-            | connect_result.s(protocol="dns_soa", url_id=endpoint.url.pk, port=0, ip_version=0)
-            | has_a_or_aaaa.si(endpoint.url.url)
-            | connect_result.s(protocol="dns_a_aaaa", url_id=endpoint.url.pk, port=0, ip_version=0)
-            | plannedscan.finish.si("verify", "dns_endpoints", endpoint.url.pk)
+            probe_dns_endpoints.si([(url.pk, url.url) for url in batch])
+            | store_dns_endpoints.s()
+            | plannedscan.finish_multiple.si(activity, "dns_endpoints", [url.pk for url in batch])
         )
     return group(tasks)
 
@@ -162,6 +155,55 @@ def compose_verify_task(
     return compose_new_verify_task(urls)
 
 
+@app.task(queue="internet")
+def probe_dns_endpoints(
+    urls: List[Tuple[int, str]], queries_per_second: float = QUERIES_PER_SECOND_PER_NAMESERVER
+) -> List[Dict[str, Any]]:
+    """
+    Resolves the records needed for has_soa, has_mx_without_cname and has_a_or_aaaa of a batch of urls at the same
+    time. Queries are spread over the configured nameservers, with a maximum amount of queries per nameserver.
+
+    :param urls: list of (url_id, url)
+    :return: per url: {"url_id": 1, "url": "example.com", "dns_soa": True, "dns_mx_no_cname": False, "dns_a_aaaa": True}
+    """
+    return asyncio.run(probe_dns_endpoints_async(urls, get_nameservers(), queries_per_second))
+
+
+async def probe_dns_endpoints_async(
+    urls: List[Tuple[int, str]], nameservers: List[str], queries_per_second: float
+) -> List[Dict[str, Any]]:
+    rate_limit = NameserverRateLimit(nameservers, queries_per_second)
+    hostnames = [url for url_id, url in urls]
+
+    records = {}
+    for record_type in ["SOA", "CNAME", "MX", "A", "AAAA"]:
+        records[record_type] = resolve_many_async(hostnames, record_type, nameservers, rate_limit)
+    records = dict(zip(records.keys(), await asyncio.gather(*records.values())))
+
+    return [
+        {
+            "url_id": url_id,
+            "url": url,
+            # see has_soa, has_mx_without_cname and has_a_or_aaaa
+            "dns_soa": records["SOA"][url] is not None,
+            "dns_mx_no_cname": not records["CNAME"][url] and bool(records["MX"][url]),
+            "dns_a_aaaa": bool(records["A"][url]) or bool(records["AAAA"][url]),
+        }
+        for url_id, url in urls
+    ]
+
+
+@app.task(queue="storage")
+def store_dns_endpoints(results: List[Dict[str, Any]]):
+    store_discovered_endpoints(
+        [
+            (result["url_id"], protocol, 0, 0, result[protocol])
+            for result in results
+            for protocol in ["dns_mx_no_cname", "dns_soa", "dns_a_aaaa"]
+        ]
+    )
+
+
 @app.task(queue="storage")
 def has_soa(url: str):
     """
@@ -260,18 +302,9 @@ def has_soa(url: str):
     :return:
     """
 
-    answer = get_dns_records_accepting_no_answer(url, "SOA")
-    if answer is None:
-        return False
-
-    if answer is False:
-        return False
-
-    if answer.response:
-        return True
-
-    # fail safely for all other edge cases that might exist.
-    return False
+    # Any answer is fine, also an answer without a SOA record. Only names that do not exist (NXDOMAIN) or that cannot
+    # be resolved at all (timeouts) are not accepted.
+    return resolve(url, "SOA") is not None
 
 
 @app.task(queue="storage")
@@ -310,10 +343,10 @@ def has_mx_without_cname(url: str) -> bool:
     ;; MSG SIZE  rcvd: 118
 
     """
-    if get_dns_records(url, "CNAME"):
+    if resolve(url, "CNAME"):
         return False
 
-    if get_dns_records(url, "MX"):
+    if resolve(url, "MX"):
         return True
 
     return False
@@ -329,74 +362,13 @@ def has_a_or_aaaa(url: str) -> bool:
     :param url:
     :return:
     """
-    if get_dns_records(url, "A"):
+    if resolve(url, "A"):
         return True
-    if get_dns_records(url, "AAAA"):
+    if resolve(url, "AAAA"):
         return True
     return False
 
 
-@retry(
-    wait=wait_exponential(multiplier=1, min=0, max=10),
-    stop=stop_after_attempt(3),
-    before=before_log(log, logging.DEBUG),
-)
-def get_dns_records(url: str, record_type):
-    resolver = Resolver()
-    resolver.nameservers = get_nameservers()
-
-    try:
-        # a little delay to be friendly towards the server
-        # this doesn't really help with parallel requests from the same server. Well, a little bit.
-        sleep(0.03)
-        return resolver.query(url, record_type)
-    except NoAnswer:
-        log.debug("The DNS response does not contain an answer to the question. %s %s " % (url, record_type))
-        return None
-    except NXDOMAIN:
-        log.debug("dns query name does not exist. %s %s" % (url, record_type))
-        return None
-    except NoNameservers:
-        log.debug("Pausing, or add more DNS servers...")
-        sleep(20)
-    except Timeout:
-        # some DNS server queries result in a timeout for things that do not exist. This takes 30 seconds.
-        log.debug(f"Timeout received for DNS query to {url}.")
-        return False
-
-
-@retry(
-    wait=wait_exponential(multiplier=1, min=0, max=10),
-    stop=stop_after_attempt(3),
-    before=before_log(log, logging.DEBUG),
-)
-def get_dns_records_accepting_no_answer(url: str, record_type):
-    resolver = Resolver()
-    resolver.nameservers = get_nameservers()
-
-    try:
-        # a little delay to be friendly towards the server
-        # this doesn't really help with parallel requests from the same server. Well, a little bit.
-        sleep(0.03)
-        answer = resolver.query(url, record_type, raise_on_no_answer=False)
-        log.debug("dns query returned an answer %s %s" % (url, record_type))
-        return answer
-    except NoAnswer:
-        # this will never happen, as we explicitly say OK. This means that only domains that really
-        # do not return ANY answer *where NXDOMAIN is returned* will be false.
-        return None
-    except NXDOMAIN:
-        log.debug("dns query name does not exist. %s %s" % (url, record_type))
-        return None
-    except NoNameservers:
-        log.debug("Pausing, or add more DNS servers...")
-        sleep(20)
-    except Timeout:
-        # some DNS server queries result in a timeout for things that do not exist. This takes 30 seconds.
-        log.debug(f"Timeout received for DNS query to {url}.")
-        return False
-
-
 """
 # This has been removed because the approach taken is not feasable or relevant for mail.
 # It is still here to learn from it.
@@ -1,49 +1,78 @@
-"""Scans DNSSEC using the dotSE DNSCHECK tool.
+"""Scans DNSSEC by validating the chain of trust of a domain, using dnspython.
 
 This is also a reference implementation of a standardized scanner. This scanner works on Url level, not on endpoint
 level.
 
-It's a nightmare to get the tool running on your system so use the one in docker:
-docker-build
-docker-failmap-with-db scan dnssec
-
-If you must run the DNSSEC scanner yourself, we wish you good luck. To get you started:
-brew install perl
-
-CPAN install TAP::Harness::Env
-CPAN install File::ShareDir::Install
-
-and then follow the installation instructions here:
-https://github.com/dotse/dnscheck/tree/master/engine
-
-We strongly recomend using the docker approach.
+This scanner used to run the dotSE DNSCHECK tool for every url. The validation is now performed in process, for many
+domains at the same time. The output still looks like the output of DNSCHECK, so the results can be classified with
+analyze_result and earlier evidence remains comparable.
 """
 
+import asyncio
 import logging
-import subprocess
-from typing import List
-
+import random
+import string
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dns.asyncquery
+import dns.dnssec
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
 from celery import Task, group
-from django.conf import settings
 from django.db.models import Q
 
 from websecmap.celery import ParentFailed, app
 from websecmap.organizations.models import Organization, Url
 from websecmap.scanners import plannedscan
 from websecmap.scanners.models import Endpoint
-from websecmap.scanners.scanmanager import store_url_scan_result
-from websecmap.scanners.scanner.__init__ import allowed_to_scan, q_configurations_to_scan, unique_and_random
+from websecmap.scanners.scanmanager import store_url_scan_result, store_url_scan_results
+from websecmap.scanners.scanner.__init__ import allowed_to_scan, chunks2, q_configurations_to_scan, unique_and_random
+from websecmap.scanners.scanner.utils import get_nameservers
 
 log = logging.getLogger(__name__)
 
-# how often a task should be retried when encountering an expectable exception
-MAX_RETRIES = 3
-RETRY_DELAY = 10
-
 # after which time (seconds) a pending task should no longer be accepted by a worker
 # can also be a datetime.
 EXPIRES = 3600  # one hour is more then enough
 
+# amount of domains that are validated in one task, and how many of those are validated at the same time.
+DNSSEC_BATCH_SIZE = 100
+MAX_CONCURRENT_VALIDATIONS = 25
+
+# seconds per query per nameserver, and for the validation of a domain as a whole.
+QUERY_TIMEOUT = 5
+DOMAIN_TIMEOUT = 120
+
+# The DS records of the key signing keys of the root zone: https://data.iana.org/root-anchors/root-anchors.xml
+ROOT_TRUST_ANCHORS = [
+    # KSK-2017
+    "20326 8 2 E06D44B80B8F1D39A95C0B0D7C65D08458E880409BBC683457104237C7F8EC8D",
+    # KSK-2024
+    "38696 8 2 683D2D0ACB8C9B712A1948B27F741219298D0A450D612C483AF444A4C0FB2B16",
+]
+
+# Validated keys of parent zones, such as nl. are kept for their TTL, with a maximum of an hour.
+MAXIMUM_ZONE_KEYS_TTL = 3600
+zone_keys_cache: Dict[dns.name.Name, Tuple[float, Dict]] = {}
+
+# Messages are translated for display. Add the exact messages in: /failmap/map/static/js/script.js
+# Run "failmap translate" to have the messages added to:
+# /failmap/map/locale/*/djangojs.po
+# /failmap/map/locale/*/django.po
+# translate them and then run "failmap translate" again.
+MESSAGES = {
+    "ERROR": "DNSSEC is incorrectly or not configured (errors found).",
+    "WARNING": "DNSSEC is incorrectly configured (warnings found).",
+    "INFO": "DNSSEC seems to be implemented sufficiently.",
+}
+
 
 def filter_scan(
     organizations_filter: dict = dict(), urls_filter: dict = dict(), endpoints_filter: dict = dict(), **kwargs
@@ -116,12 +145,12 @@ def compose_scan_task(urls) -> Task:
     """
     # The number of top level urls is negligible, so randomization is not needed.
 
-    # create tasks for scanning all selected endpoints as a single managable group
-    # Sending entire objects is possible. How signatures (.s and .si) work is documented:
-    # http://docs.celeryproject.org/en/latest/reference/celery.html#celery.signature
+    # Domains are validated concurrently in batches, which shares the lookups of the parent zones, such as nl.
     task = group(
-        scan_dnssec.si(url.url) | store_dnssec.s(url.pk) | plannedscan.finish.si("scan", "dnssec", url.pk)
-        for url in urls
+        scan_dnssec_batch.si([(url.pk, url.url) for url in batch])
+        | store_dnssec_batch.s()
+        | plannedscan.finish_multiple.si("scan", "dnssec", [url.pk for url in batch])
+        for batch in chunks2(urls, DNSSEC_BATCH_SIZE)
     )
 
     return task
@@ -137,74 +166,322 @@ def store_dnssec(result: List[str], url_id: int):
     if isinstance(result, Exception):
         return ParentFailed("skipping result parsing because scan failed.", cause=result)
 
+    if not result:
+        return {"status": "failed", "result": None}
+
     # relevant helps to store the minimum amount of information.
     level, relevant = analyze_result(result)
 
-    # Messages are translated for display. Add the exact messages in: /failmap/map/static/js/script.js
-    # Run "failmap translate" to have the messages added to:
-    # /failmap/map/locale/*/djangojs.po
-    # /failmap/map/locale/*/django.po
-    # translate them and then run "failmap translate" again.
-    messages = {
-        "ERROR": "DNSSEC is incorrectly or not configured (errors found).",
-        "WARNING": "DNSSEC is incorrectly configured (warnings found).",
-        "INFO": "DNSSEC seems to be implemented sufficiently.",
-    }
-
     log.debug("Storing result: %s, for url: %s.", result, url_id)
     # You can save any (string) value and any (string) message.
     # The EndpointScanManager deduplicates the data for you automatically.
-    if result:
-        store_url_scan_result("DNSSEC", url_id, level, messages[level], evidence=",\n".join(result))
+    store_url_scan_result("DNSSEC", url_id, level, MESSAGES[level], evidence=",\n".join(result))
 
     # return something informative
     return {"status": "success", "result": level}
 
 
-# amsterdam.nl hangs on october 12 2018
-# in some cases this hangs, therefore have a time limit on the task.
-# "The worker processing the task will be killed and replaced with a new one when this is exceeded."
-@app.task(
-    queue="internet",
-    bind=True,
-    default_retry_delay=RETRY_DELAY,
-    retry_kwargs={"max_retries": MAX_RETRIES},
-    expires=EXPIRES,
-    task_time_limit=120,
-)
-def scan_dnssec(self, url: str):
+@app.task(queue="storage")
+def store_dnssec_batch(results: List[Tuple[int, Optional[List[str]]]]):
+    scan_results = []
+    for url_id, result in results:
+        # domains that could not be validated, due to timeouts, are scanned again later.
+        if not result:
+            continue
+
+        level, relevant = analyze_result(result)
+        scan_results.append(("DNSSEC", url_id, level, MESSAGES[level], ",\n".join(result)))
+
+    store_url_scan_results(scan_results)
+    return {"status": "success", "stored": len(scan_results)}
+
+
+@app.task(queue="internet", expires=EXPIRES)
+def scan_dnssec(url: str) -> List[str]:
     """
-    Uses the dnssec scanner of dotse, which works pretty well.
+    Validates the DNSSEC configuration of a single domain, see validate_domain.
 
     :param url:
+    """
+    log.info("Start scanning %s", url)
+    content = asyncio.run(validate_domains([url], get_nameservers()))[0]
+    log.info("Done scanning: %s, result: %s", url, content)
+    return content if content else []
 
-    Possible problems as seen on: https://github.com/stjernstedt/Interlan/blob/master/script/functions
-    Timeout of 240 seconds. Nothing more (oh wow).
 
+@app.task(queue="internet", expires=EXPIRES)
+def scan_dnssec_batch(urls: List[Tuple[int, str]]) -> List[Tuple[int, Optional[List[str]]]]:
     """
+    Validates the DNSSEC configuration of a batch of domains concurrently.
+
+    :param urls: list of (url_id, url)
+    :return: list of (url_id, output), where output is None if the domain could not be validated.
+    """
+    results = asyncio.run(validate_domains([url for url_id, url in urls], get_nameservers()))
+    return [(url_id, result) for (url_id, url), result in zip(urls, results)]
+
+
+async def validate_domains(domains: List[str], nameservers: List[str]) -> List[Optional[List[str]]]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_VALIDATIONS)
+    # validation of parent zones that is in progress, shared by all domains in this batch.
+    in_flight = {}
+
+    async def validate(domain):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(validate_domain(domain, nameservers, in_flight), DOMAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.info("Timeout while validating DNSSEC of %s.", domain)
+                return None
+            except Exception:
+                # a single domain should not fail the validation of the entire batch.
+                log.exception("Could not validate DNSSEC of %s.", domain)
+                return None
+
+    return await asyncio.gather(*[validate(domain) for domain in domains])
+
+
+async def validate_domain(domain: str, nameservers: List[str], in_flight: dict) -> Optional[List[str]]:
+    """
+    Validates the DNSSEC chain of trust of a domain, using dnspython. This used to be done with dnscheck by dotSE.
+    The output mimics the output of dnscheck, so analyze_result can classify it:
+
+    0.000: INFO Begin testing DNSSEC for faalkaart.nl.
+    0.031: INFO Found DS record for faalkaart.nl at parent.
+    ...
+    0.250: INFO Done testing DNSSEC for faalkaart.nl.
+
+    The following is checked:
+    - The DS records at the parent, which are signed by the parent. The keys of the parent are validated up to the
+      root trust anchors. Validated keys of parent zones are cached, so .nl is validated only once in a while.
+    - The DNSKEY records at the child, and if one of them is referred to by a DS record at the parent.
+    - Valid signatures over the DNSKEY and SOA records.
+    - Authenticated denial of existence (NSEC or NSEC3).
+
+    Returns None if the domain could not be queried at all, so the result is not stored.
+    """
+    start = time.monotonic()
+    output = []
+
+    def report(level, message):
+        output.append(f"{time.monotonic() - start:.3f}: {level} {message}")
+
     try:
-        log.info("Start scanning %s", url)
+        name = dns.name.from_text(domain)
+    except dns.exception.DNSException as exception:
+        log.info("Not a valid domain name: %s, %s", domain, exception)
+        return None
+
+    domain = name.to_text(omit_final_dot=True)
+    report("INFO", f"Begin testing DNSSEC for {domain}.")
+
+    ds_response = await query(name, dns.rdatatype.DS, nameservers)
+    dnskey_response = await query(name, dns.rdatatype.DNSKEY, nameservers)
+    if ds_response is None or dnskey_response is None:
+        return None
+
+    ds, ds_signatures = find_rrsets(ds_response, name, dns.rdatatype.DS)
+    if ds:
+        report("INFO", f"Found DS record for {domain} at parent.")
+    else:
+        report("INFO", f"Did not find DS record for {domain} at parent.")
 
-        output = subprocess.check_output([settings.TOOLS["dnscheck"]["executable"], url]).decode("UTF-8")
-        content = output.splitlines()
+    dnskey, dnskey_signatures = find_rrsets(dnskey_response, name, dns.rdatatype.DNSKEY)
+    if not dnskey:
+        report("INFO", f"Did not find DNSKEY record for {domain} at child.")
+        report("INFO", "No DNSKEY(s) found at child, other tests skipped.")
+        report("INFO", f"Done testing DNSSEC for {domain}.")
+        return output
 
-        log.info("Done scanning: %s, result: %s", url, content)
-        return content
+    report("INFO", f"Found DNSKEY record for {domain} at child.")
+    keys = {name: dnskey}
+
+    report_signatures(report, domain, dnskey, dnskey_signatures, keys)
+
+    soa, soa_signatures = find_rrsets(await query(name, dns.rdatatype.SOA, nameservers), name, dns.rdatatype.SOA)
+    if soa:
+        report_signatures(report, domain, soa, soa_signatures, keys)
+    else:
+        report("ERROR", f"No SOA record found for {domain}.")
+
+    # a name that does not exist should be answered with proof that it does not exist.
+    nonexisting = dns.name.from_text("".join(random.choice(string.ascii_lowercase) for i in range(16)), name)
+    denial = await query(nonexisting, dns.rdatatype.A, nameservers)
+    denial_types = sorted(
+        {
+            dns.rdatatype.to_text(rrset.rdtype)
+            for rrset in (denial.authority if denial else [])
+            if rrset.rdtype in [dns.rdatatype.NSEC, dns.rdatatype.NSEC3]
+        }
+    )
+    if denial_types:
+        report("INFO", f"Authenticated denial records found for {domain}, of type {', '.join(denial_types)}.")
+    else:
+        report("INFO", f"Authenticated denial records not found for {domain}.")
+
+    if not ds:
+        # Broken chain of trust: DNSKEY found at child, but no DS was found at parent.
+        report("WARNING", f"[DNSSEC:MISSING_DS] {domain}")
+        report("INFO", f"Done testing DNSSEC for {domain}.")
+        return output
+
+    for record, key in secure_entry_points(name, dnskey, ds):
+        report(
+            "INFO",
+            f"Parent DS({domain}/{record.algorithm}/{record.digest_type}/{record.key_tag}) refers to valid key at "
+            f"child: DNSKEY({domain}/{key.algorithm}/{dns.dnssec.key_id(key)})",
+        )
+    if not secure_entry_points(name, dnskey, ds):
+        report("ERROR", f"No DS record at the parent of {domain} refers to a valid key at the child.")
+
+    parent = await find_zone(name.parent(), nameservers)
+    parent_keys = await zone_keys(parent, nameservers, in_flight) if parent else None
+    if not parent_keys:
+        report("WARNING", f"Could not establish a chain of trust to the parent zone of {domain}.")
+    elif valid_signature(ds, ds_signatures, parent_keys):
+        report("INFO", f"DS RRset of {domain} is signed by a trusted key of {parent.to_text(omit_final_dot=True)}.")
+    else:
+        report("ERROR", f"No valid signatures over DS RRset of {domain} found at parent.")
+
+    report("INFO", f"DNSSEC parent checks for {domain} complete.")
+    report("INFO", f"Done testing DNSSEC for {domain}.")
+    return output
+
+
+def report_signatures(report, domain: str, rrset, signatures, keys):
+    rdtype = dns.rdatatype.to_text(rrset.rdtype)
+    valid = 0
+
+    for signature in signatures if signatures else []:
+        description = f"RRSIG({domain}/IN/{rdtype}/{signature.key_tag})"
+        try:
+            dns.dnssec.validate_rrsig(rrset, signature, keys)
+            report("INFO", f"DNSSEC signature valid: {description}")
+            valid += 1
+        except dns.dnssec.ValidationFailure as failure:
+            report("NOTICE", f"DNSSEC signature not valid: {description}: {failure}")
+
+    if valid:
+        report("INFO", f"Enough valid signatures over {rdtype} RRset found for {domain}.")
+    else:
+        report("ERROR", f"No valid signatures over {rdtype} RRset found for {domain}.")
+
+
+async def zone_keys(zone: dns.name.Name, nameservers: List[str], in_flight: dict) -> Optional[Dict]:
+    """The DNSKEY records of a zone, if these can be trusted via the chain of trust to the root of the DNS."""
+    expires, keys = zone_keys_cache.get(zone, (0, None))
+    if expires > time.time():
+        return keys
+
+    if zone not in in_flight:
+        in_flight[zone] = asyncio.ensure_future(validate_zone_keys(zone, nameservers, in_flight))
+    # shielded: a domain that times out does not cancel the validation for the other domains that wait for it.
+    return await asyncio.shield(in_flight[zone])
+
+
+async def validate_zone_keys(zone: dns.name.Name, nameservers: List[str], in_flight: dict) -> Optional[Dict]:
+    dnskey, dnskey_signatures = find_rrsets(
+        await query(zone, dns.rdatatype.DNSKEY, nameservers), zone, dns.rdatatype.DNSKEY
+    )
+    if not dnskey:
+        return None
+
+    if zone == dns.name.root:
+        trusted_ds = [dns.rdata.from_text("IN", "DS", anchor) for anchor in ROOT_TRUST_ANCHORS]
+    else:
+        parent = await find_zone(zone.parent(), nameservers)
+        parent_keys = await zone_keys(parent, nameservers, in_flight) if parent else None
+        ds, ds_signatures = find_rrsets(await query(zone, dns.rdatatype.DS, nameservers), zone, dns.rdatatype.DS)
+        if not parent_keys or not ds or not valid_signature(ds, ds_signatures, parent_keys):
+            log.debug("Could not validate the DS records of %s.", zone)
+            return None
+        trusted_ds = list(ds)
+
+    keys = {zone: dnskey}
+    if not secure_entry_points(zone, dnskey, trusted_ds) or not valid_signature(dnskey, dnskey_signatures, keys):
+        log.debug("Could not validate the DNSKEY records of %s.", zone)
+        return None
+
+    zone_keys_cache[zone] = (time.time() + min(dnskey.ttl, MAXIMUM_ZONE_KEYS_TTL), keys)
+    return keys
+
+
+def secure_entry_points(name: dns.name.Name, dnskey, ds_records) -> List[Tuple]:
+    """The (DS, DNSKEY) pairs where the DS record refers to a key in the DNSKEY RRset."""
+    pairs = []
+    for record in ds_records:
+        for key in dnskey:
+            if dns.dnssec.key_id(key) != record.key_tag or key.algorithm != record.algorithm:
+                continue
+            try:
+                if dns.dnssec.make_ds(name, key, record.digest_type) == record:
+                    pairs.append((record, key))
+            except dns.dnssec.UnsupportedAlgorithm:
+                continue
+    return pairs
+
+
+def valid_signature(rrset, signatures, keys) -> bool:
+    if not signatures:
+        return False
+    try:
+        dns.dnssec.validate(rrset, signatures, keys)
+        return True
+    except dns.dnssec.ValidationFailure:
+        return False
+
+
+async def find_zone(name: dns.name.Name, nameservers: List[str]) -> Optional[dns.name.Name]:
+    """The zone a name is in, which is the owner of the SOA record in the answer or in the authority section."""
+    response = await query(name, dns.rdatatype.SOA, nameservers)
+    if response is None:
+        return None
+
+    for rrset in response.answer + response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return rrset.name
+    return None
+
+
+def find_rrsets(response: Optional[dns.message.Message], name: dns.name.Name, rdtype) -> Tuple:
+    """The rrset of the requested type in the answer, and the rrset of the signatures over it."""
+    if response is None:
+        return None, None
+
+    rrset, signatures = None, None
+    for candidate in response.answer:
+        if candidate.name != name or candidate.rdclass != dns.rdataclass.IN:
+            continue
+        if candidate.rdtype == rdtype:
+            rrset = candidate
+        if candidate.rdtype == dns.rdatatype.RRSIG and candidate.covers == rdtype:
+            signatures = candidate
+
+    if rrset is None:
+        return None, None
+
+    return rrset, signatures
+
+
+async def query(name: dns.name.Name, rdtype, nameservers: List[str]) -> Optional[dns.message.Message]:
+    """
+    Asks the nameservers for the records and their signatures. Checking is disabled, so that the resolver also returns
+    records that do not validate: validating them is what this scanner does.
+    """
+    request = dns.message.make_query(name, rdtype, want_dnssec=True)
+    request.flags |= dns.flags.CD
 
-    # subprocess.CalledProcessError: non zero exit status
-    # OSError: Incorrect permission, file doesn't exist, etc
-    except (subprocess.CalledProcessError, OSError) as e:
-        # If an expected error is encountered put this task back on the queue to be retried.
-        # This will keep the chained logic in place (saving result after successful scan).
-        # Retry delay and total number of attempts is configured in the task decorator.
+    for nameserver in nameservers:
         try:
-            # Since this action raises an exception itself, any code after this won't be executed.
-            raise self.retry(exc=e)
-        except BaseException:
-            # If this task still fails after maximum retries the last
-            # error will be passed as result to the next task.
-            log.exception("Retried %s times and it still failed", MAX_RETRIES)
-            return e
+            response = await dns.asyncquery.udp(request, nameserver, timeout=QUERY_TIMEOUT)
+            if response.flags & dns.flags.TC:
+                response = await dns.asyncquery.tcp(request, nameserver, timeout=QUERY_TIMEOUT)
+            if response.rcode() in [dns.rcode.NOERROR, dns.rcode.NXDOMAIN]:
+                return response
+        except (dns.exception.DNSException, OSError) as exception:
+            log.debug("Query for %s %s on %s failed: %s", name, rdtype, nameserver, exception)
+
+    return None
 
 
 def analyze_result(result: List[str]):
@@ -24,36 +24,42 @@ HTTP: 80, 280, 591, 593, 2480, 4444, 4445, 4567, 5000, 5104, 5800, 5988, 7001, 8
 Likely: 80, 8080, 8008, 8888, 8088
 
 """
+import asyncio
 import ipaddress
 import logging
 import random
 import socket
+import ssl
 from datetime import datetime
 from ipaddress import AddressValueError
-from typing import List
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse
 
 import pytz
-import requests
 
 # suppress InsecureRequestWarning, we do those request on purpose.
 import urllib3
 from celery import Task, group
 from django.conf import settings
-from requests import ConnectTimeout, HTTPError, ReadTimeout, Request, Session, Timeout
+from django.db import transaction
+from requests import ConnectTimeout, HTTPError, ReadTimeout, Request, Timeout
 from requests.exceptions import ConnectionError, SSLError
 
 from websecmap.celery import app
 from websecmap.organizations.models import Organization, Url
 from websecmap.scanners import plannedscan
+from websecmap.scanners.http_pool import pooled_session
 from websecmap.scanners.models import Endpoint, UrlIp
 from websecmap.scanners.plannedscan import retrieve_endpoints_from_urls
+from websecmap.scanners.resolver import resolve, resolve_many_async
 from websecmap.scanners.scanner.__init__ import (
     allowed_to_discover_endpoints,
+    chunks2,
     endpoint_filters,
     q_configurations_to_scan,
     unique_and_random,
 )
-from websecmap.scanners.scanner.utils import CELERY_IP_VERSION_QUEUE_NAMES
+from websecmap.scanners.scanner.utils import CELERY_IP_VERSION_QUEUE_NAMES, get_nameservers
 from websecmap.scanners.timeout import timeout
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -90,6 +96,25 @@ READ_TIMEOUT = 7
 
 RDNS_TIMEOUT = 7
 
+# Discovery probes all ports of a batch of urls concurrently. The amount of urls per discovery task and the maximum
+# amount of connections that are open at the same time in such a task. Most connections end in a timeout, so a lot
+# of connections can be open without causing any load on the worker.
+DISCOVERY_BATCH_SIZE = 50
+DISCOVERY_MAX_CONNECTIONS = 100
+
+# a discovery result: url_id, protocol, port, ip_version and if there was something to connect to.
+DiscoveryResult = Tuple[int, str, int, int, bool]
+
+# Errors that indicate there is a server, but we're not able to communicate with it correctly. See can_connect.
+SERVER_ERRORS = [
+    "BadStatusLine",
+    "CertificateError",
+    "certificate verify failed",
+    "bad handshake",
+    # Handshake failure: so there is an option to create a handshake, but perhaps the server wont respond.
+    "SSLV3_ALERT_HANDSHAKE_FAILURE",
+]
+
 
 def filter_discover(organizations_filter: dict = dict(), urls_filter: dict = dict(), **kwargs):
     # ignore administratively dead domains by default.
@@ -150,15 +175,14 @@ def compose_discover_task(urls: List[Url]):
     tasks = []
 
     for ip_version in [4, 6]:
-        for port in PREFERRED_PORT_ORDER:
-            for url in urls:
-                tasks.append(
-                    can_connect.si(protocol=PORT_TO_PROTOCOL[port], url=url.url, port=port, ip_version=ip_version).set(
-                        queue=CELERY_IP_VERSION_QUEUE_NAMES[ip_version]
-                    )
-                    | connect_result.s(protocol=PORT_TO_PROTOCOL[port], url_id=url.pk, port=port, ip_version=ip_version)
-                    | plannedscan.finish.si("discover", "http", url.pk)
+        for batch in chunks2(urls, DISCOVERY_BATCH_SIZE):
+            tasks.append(
+                discover_endpoints.si(urls=[(url.pk, url.url) for url in batch], ip_version=ip_version).set(
+                    queue=CELERY_IP_VERSION_QUEUE_NAMES[ip_version]
                 )
+                | store_discovered_endpoints.s()
+                | plannedscan.finish_multiple.si("discover", "http", [url.pk for url in batch])
+            )
 
     return group(tasks)
 
@@ -249,15 +273,18 @@ def get_ips(url: str):
 
 # It's possible you don't get an address back, it could not be configured on our or their side.
 def get_ipv4(url: str):
+    return ipv4_from_records(url, resolve(url, "A"))
+
+
+def ipv4_from_records(url: str, records: Optional[List[str]]):
     # https://www.iana.org/assignments/iana-ipv4-special-registry/iana-ipv4-special-registry.xhtml
     ipv4 = ""
 
-    try:
-        ipv4 = socket.gethostbyname(url)
+    if records:
+        ipv4 = records[0]
         log.debug("%s has IPv4 address: %s" % (url, ipv4))
-    except Exception as ex:
-        # when not known: [Errno 8] nodename nor servname provided, or not known
-        log.debug("Get IPv4 error on %s: %s" % (url, ex))
+    else:
+        log.debug("Could not get an IPv4 address on %s" % url)
 
     # the contents of the DNS record can be utter garbage, there is absolutely no guarantee that this is an IP
     # it could be an entire novel, or images
@@ -275,13 +302,16 @@ def get_ipv4(url: str):
 
 # It's possible you don't get an address back, it could not be configured on our or their side.
 def get_ipv6(url: str):
+    # dig AAAA faalkaart.nl +short (might be used for debugging)
+    return ipv6_from_records(url, resolve(url, "AAAA"))
+
+
+def ipv6_from_records(url: str, records: Optional[List[str]]):
     # https://www.iana.org/assignments/iana-ipv6-special-registry/iana-ipv6-special-registry.xhtml
     ipv6 = ""
 
-    try:
-        # dig AAAA faalkaart.nl +short (might be used for debugging)
-        x = socket.getaddrinfo(url, None, socket.AF_INET6)
-        ipv6 = x[0][4][0]
+    if records:
+        ipv6 = records[0]
 
         # six to four addresses make no sense
         if str(ipv6).startswith("::ffff:"):
@@ -294,9 +324,8 @@ def get_ipv6(url: str):
             ipv6 = ""
         else:
             log.debug("%s has IPv6 address: %s" % (url, ipv6))
-    except Exception as ex:
-        # when not known: [Errno 8nodename nor servname provided, or not known
-        log.debug("Get IPv6 error on %s: %s" % (url, ex))
+    else:
+        log.debug("Could not get an IPv6 address on %s" % url)
 
     try:
         if ipv6:
@@ -403,13 +432,14 @@ def can_connect(self, protocol: str, url: str, port: int, ip_version: int) -> bo
         # Certificate did not match expected hostname: 85.119.104.84.
         Certificate: {'subject': ((('commonName', 'webdiensten.drechtsteden.nl'),),)
         """
-        r = requests.get(
-            uri,
-            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
-            allow_redirects=False,  # redirect = connection
-            verify=False,  # nosec any tls = connection
-            headers={"Host": url, "User-Agent": get_random_user_agent()},
-        )
+        with pooled_session(url, ip_version) as session:
+            r = session.get(
+                uri,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                allow_redirects=False,  # redirect = connection
+                verify=False,  # nosec any tls = connection
+                headers={"Host": url, "User-Agent": get_random_user_agent()},
+            )
         if r.status_code:
             log.debug("%s: Host: %s Status: %s" % (uri, url, r.status_code))
             return True
@@ -467,21 +497,20 @@ def can_connect(self, protocol: str, url: str, port: int, ip_version: int) -> bo
             try:
                 log.debug("Trying again with a matching url and host header -> No connection to IP with a host header.")
 
-                s = Session()
-
                 uri = "%s://%s:%s" % (protocol, url, port)
 
-                req = Request("GET", uri, headers={"Host": url, "User-Agent": get_random_user_agent()})
-                prepped = s.prepare_request(req)
+                with pooled_session(url, ip_version) as s:
+                    req = Request("GET", uri, headers={"Host": url, "User-Agent": get_random_user_agent()})
+                    prepped = s.prepare_request(req)
 
-                # pretty_print_request(prepped)
+                    # pretty_print_request(prepped)
 
-                s.send(
-                    prepped,
-                    verify=False,
-                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
-                    allow_redirects=False,
-                )
+                    s.send(
+                        prepped,
+                        verify=False,
+                        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                        allow_redirects=False,
+                    )
 
                 return True
             except (ConnectionRefusedError, ConnectionError, HTTPError) as Ex:
@@ -508,6 +537,154 @@ def can_connect(self, protocol: str, url: str, port: int, ip_version: int) -> bo
             return False
 
 
+@app.task(queue="4and6")
+def discover_endpoints(
+    urls: List[Tuple[int, str]],
+    ip_version: int,
+    ports: List[int] = None,
+    max_connections: int = DISCOVERY_MAX_CONNECTIONS,
+) -> List[DiscoveryResult]:
+    """
+    Tries to connect to all ports of a batch of urls at the same time, instead of one can_connect task per port.
+
+    The same assumption as in can_connect is made: if there is "a response" there is a website. For https a failing
+    handshake is also a response. The result is a list of (url_id, protocol, port, ip_version, connected), which is
+    stored with store_discovered_endpoints. Urls that do not resolve are not probed and result in not connected.
+
+    :param urls: list of (url_id, url)
+    :param ip_version: 4 or 6, the worker should be able to connect over this network.
+    :param ports: defaults to all ports in PREFERRED_PORT_ORDER.
+    :param max_connections: maximum amount of connections that are open at the same time.
+    """
+    ports = ports if ports else PREFERRED_PORT_ORDER
+    return asyncio.run(discover_endpoints_async(urls, ip_version, ports, max_connections, get_nameservers()))
+
+
+async def discover_endpoints_async(
+    urls: List[Tuple[int, str]], ip_version: int, ports: List[int], max_connections: int, nameservers: List[str]
+) -> List[DiscoveryResult]:
+    hostnames = [url for url_id, url in urls]
+    if ip_version == 4:
+        records = await resolve_many_async(hostnames, "A", nameservers)
+        ips = [ipv4_from_records(hostname, records[hostname]) for hostname in hostnames]
+    else:
+        records = await resolve_many_async(hostnames, "AAAA", nameservers)
+        ips = [ipv6_from_records(hostname, records[hostname]) for hostname in hostnames]
+
+    semaphore = asyncio.Semaphore(max_connections)
+    probes = []
+    targets = []
+    for (url_id, url), ip in zip(urls, ips):
+        for port in ports:
+            targets.append((url_id, PORT_TO_PROTOCOL[port], port, ip_version))
+            if ip:
+                probes.append(probe(semaphore, PORT_TO_PROTOCOL[port], url, ip, port))
+            else:
+                probes.append(asyncio.sleep(0, result=False))
+
+    connected = await asyncio.gather(*probes)
+    log.debug(f"Discovered {sum(connected)} endpoints on {len(targets)} ports of {len(urls)} urls.")
+    return [(*target, bool(is_connected)) for target, is_connected in zip(targets, connected)]
+
+
+async def probe(semaphore: asyncio.Semaphore, protocol: str, url: str, ip: str, port: int) -> bool:
+    """
+    Async equivalent of can_connect: connect to the ip, with the url as host, and wait for any response. When that
+    fails, because a firewall might block requests to the ip with a different host, the url is contacted directly.
+    """
+    async with semaphore:
+        connected = await probe_host(protocol, url, ip, port)
+        if connected is None:
+            log.debug(f"{url}:{port}: trying again with a matching url and host header.")
+            # the url is resolved over the same network as the ip.
+            family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+            connected = await probe_host(protocol, url, url, port, family)
+        return bool(connected)
+
+
+async def probe_host(protocol: str, url: str, host: str, port: int, family: int = 0) -> Optional[bool]:
+    """True when there is a server, False on timeouts and None when the connection failed otherwise."""
+    tls = None
+    if protocol == "https":
+        # any tls = connection, certificates are checked by other scanners.
+        tls = ssl.create_default_context()
+        tls.check_hostname = False
+        tls.verify_mode = ssl.CERT_NONE  # nosec
+
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=tls, server_hostname=url if tls else None, family=family),
+            CONNECT_TIMEOUT,
+        )
+        writer.write(
+            f"GET / HTTP/1.1\r\nHost: {url}\r\nUser-Agent: {get_random_user_agent()}\r\n"
+            f"Connection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        # any status line, or any other garbage, means there is a server. A closed connection does not.
+        if await asyncio.wait_for(reader.readline(), READ_TIMEOUT):
+            return True
+        log.debug(f"{host}:{port}: connection closed without a response.")
+        return None
+    except asyncio.TimeoutError:
+        log.debug(f"{host}:{port}: timeout.")
+        return False
+    except OSError as Ex:
+        # ssl errors are also OSErrors. A plain http server on a https port results in a wrong version number.
+        if any(error in str(Ex.args) for error in SERVER_ERRORS):
+            log.debug(f"{host}:{port}: there is a server, but we're not able to communicate with it. Error: {Ex}")
+            return True
+        log.debug(f"{host}:{port}: could not connect. Error: {Ex}")
+        return None
+    finally:
+        if writer:
+            writer.close()
+
+
+@app.task(queue="storage")
+def store_discovered_endpoints(results: List[DiscoveryResult]):
+    """
+    Stores the results of discover_endpoints in one go: new endpoints are added, endpoints that cannot be reached
+    anymore are killed. This has the same effect as connect_result on every result. Dns endpoints are stored the same
+    way, with port and ip_version 0.
+    """
+    url_ids = list({result[0] for result in results})
+    protocols = list({result[1] for result in results})
+    existing = {}
+    for batch in chunks2(url_ids, 500):
+        endpoints = Endpoint.objects.all().filter(url__in=batch, protocol__in=protocols, is_dead=False)
+        for endpoint in endpoints.values("id", "url_id", "protocol", "port", "ip_version"):
+            key = (endpoint["url_id"], endpoint["protocol"], endpoint["port"], endpoint["ip_version"])
+            existing.setdefault(key, []).append(endpoint["id"])
+
+    new_endpoints = {}
+    dead_endpoint_ids = []
+    for url_id, protocol, port, ip_version, connected in results:
+        key = (url_id, protocol, port, ip_version)
+        if connected and key not in existing:
+            new_endpoints[key] = Endpoint(
+                url_id=url_id,
+                protocol=protocol,
+                port=port,
+                ip_version=ip_version,
+                is_dead=False,
+                discovered_on=datetime.now(pytz.utc),
+            )
+        if not connected and key in existing:
+            dead_endpoint_ids += existing[key]
+
+    with transaction.atomic():
+        Endpoint.objects.bulk_create(new_endpoints.values())
+        for batch in chunks2(dead_endpoint_ids, 500):
+            Endpoint.objects.all().filter(id__in=batch).update(
+                is_dead=True, is_dead_since=datetime.now(pytz.utc), is_dead_reason="Not found in HTTP Scanner anymore."
+            )
+
+    log.info(f"Discovery added {len(new_endpoints)} and killed {len(dead_endpoint_ids)} endpoints.")
+    return True
+
+
 # thank you https://stackoverflow.com/questions/20658572/python-requests-print-entire-http-request-raw
 def pretty_print_request(req):
     """
@@ -735,14 +912,15 @@ def check_network(code_location=""):
         log.info("IPv6 could be reached via %s" % code_location)
 
 
-def redirects_to_safety(url: str):
+def redirects_to_safety(url: str, ip_version: int = 0):
     """
     Also includes the ip-version of the endpoint. Implies that the endpoint resolves.
     Any safety over any network is accepted now, both A and AAAA records.
 
     To enable debugging: logging.basicConfig(level=logging.DEBUG)
 
-    :param endpoint:
+    :param url: for example http://example.com:80
+    :param ip_version: the network the request is made over, connections are shared per host and network.
     :return:
     """
     import requests
@@ -752,24 +930,24 @@ def redirects_to_safety(url: str):
     # This becomes problematic when you set the Host header. This prevents
 
     try:
-        session = requests.Session()
-        response = session.get(
-            url,
-            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),  # allow for insane network lag
-            allow_redirects=True,  # point is: redirects to safety
-            verify=False,  # certificate validity is checked elsewhere, having some https > none
-            # redirects do NOT overwrite the host headers. Meaning that following a redirect, the
-            # host header is set, which is incorrect. The Host header should only be set in the first
-            # request, and should be overwritten by all subsequent requests.
-            # The reason we set the host header explicitly, is because we want to contact the webserver
-            # via the IP address, so we can explicitly contect IPv4 and IPv6 addresses of this domain.
-            # issue was logged here: https://github.com/psf/requests/issues/5196
-            headers={
-                "User-Agent": get_random_user_agent(),
-                # Give some instructions that we want a secure address...
-                "Upgrade-Insecure-Requests": "1",
-            },
-        )
+        with pooled_session(urlparse(url).hostname, ip_version) as session:
+            response = session.get(
+                url,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),  # allow for insane network lag
+                allow_redirects=True,  # point is: redirects to safety
+                verify=False,  # certificate validity is checked elsewhere, having some https > none
+                # redirects do NOT overwrite the host headers. Meaning that following a redirect, the
+                # host header is set, which is incorrect. The Host header should only be set in the first
+                # request, and should be overwritten by all subsequent requests.
+                # The reason we set the host header explicitly, is because we want to contact the webserver
+                # via the IP address, so we can explicitly contect IPv4 and IPv6 addresses of this domain.
+                # issue was logged here: https://github.com/psf/requests/issues/5196
+                headers={
+                    "User-Agent": get_random_user_agent(),
+                    # Give some instructions that we want a secure address...
+                    "Upgrade-Insecure-Requests": "1",
+                },
+            )
 
         if response.history:
             log.debug("Request was redirected, there is hope. Redirect path:")
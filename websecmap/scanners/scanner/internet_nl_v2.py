@@ -10,7 +10,7 @@ to log network errors. These errors can be retried.
 """
 
 import logging
-from typing import List, Any, Dict
+from typing import Any, BinaryIO, Dict, List, Tuple
 
 import requests
 from requests.auth import HTTPBasicAuth
@@ -19,6 +19,9 @@ from websecmap.celery import app
 
 log = logging.getLogger(__name__)
 
+# Results of large scans are tens of megabytes, they are downloaded in parts of this size.
+RESULT_CHUNK_SIZE = 1024 * 1024
+
 
 class InternetNLApiSettings:
     url: str = ""
@@ -75,6 +78,29 @@ def result(scan_id: int, settings: Dict[str, Any]):
     return generic_internet_nl_api_request("get", f"{settings['url']}/requests/{scan_id}/results", settings)
 
 
+def stream_result(scan_id: int, settings: Dict[str, Any], destination: BinaryIO) -> Tuple[int, dict]:
+    """
+    Writes the results of a scan to destination, without loading them in memory. The json content is only returned
+    when the request failed. Use this instead of result for large scans.
+    """
+    try:
+        with requests.get(
+            f"{settings['url']}/requests/{scan_id}/results",
+            auth=HTTPBasicAuth(settings["username"], settings["password"]),
+            timeout=(300, 300),
+            stream=True,
+        ) as response:
+            if response.status_code != 200:
+                return return_safe_response(response)
+
+            for chunk in response.iter_content(chunk_size=RESULT_CHUNK_SIZE):
+                destination.write(chunk)
+    except requests.RequestException as e:
+        return 599, {"network_error": e.strerror}
+
+    return 200, {}
+
+
 def generic_internet_nl_api_request(operation, url: str, settings: Dict[str, Any]):
     # We're dealing with all kinds of network issues by returning a network issue as a status code.
     # Network issues can be recovered and the next step can be retried. Network issues can take a long time and
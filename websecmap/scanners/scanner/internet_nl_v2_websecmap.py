@@ -3,27 +3,45 @@ Web Security Map implementation of internet.nl scans.
 """
 
 import hashlib
+import io
 import ipaddress
 import json
 import logging
+import tempfile
 from copy import copy
 from datetime import datetime, timedelta
-from typing import List, Tuple, Dict, Any
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import ijson
 import pytz
 import tldextract
-from celery import Task, group
+from celery import Task, chain, group
 from constance import config
 from django.db import transaction
+from django.db.models import TextField, Value
+from django.db.models.functions import Cast, Substr
 
 from websecmap.celery import app
 from websecmap.organizations.models import Url
 from websecmap.scanners.models import Endpoint, InternetNLV2Scan, InternetNLV2StateLog, EndpointGenericScan
-from websecmap.scanners.scanmanager import store_endpoint_scan_result
-from websecmap.scanners.scanner.internet_nl_v2 import InternetNLApiSettings, register, result, status
+from websecmap.scanners.scanmanager import ScanResult, store_endpoint_scan_results
+from websecmap.scanners.scanner.internet_nl_v2 import InternetNLApiSettings, register, status, stream_result
 
 log = logging.getLogger(__name__)
 
+# The amount of domains that are processed per task. A domain has over a hundred results.
+PROCESSING_BATCH_SIZE = 250
+
+# To what endpoint of a domain the results of a scan type are connected.
+SCAN_TYPE_TO_PROTOCOL = {
+    # mail is used for web security map, it is a subset of mail servers that dedupes servers on cnames.
+    "mail": "dns_mx_no_cname",
+    # dns soa are internet.nl dashboard scans that have a different requirement set for the mailserver endpoint
+    "mail_dashboard": "dns_soa",
+    # web scans are only used by the internet.nl dashboard...
+    "web": "dns_a_aaaa",
+}
+
 
 def valid_api_settings(scan: InternetNLV2Scan):
     if not config.INTERNET_NL_API_USERNAME:
@@ -310,23 +328,30 @@ def storing_scan_results(scan_id: int):
     if not valid_api_settings(scan):
         return group([])
 
-    return result.si(scan.scan_id, create_api_settings(scan.pk)) | result_administration.s(scan.pk)
+    return store_scan_results.si(scan.pk)
 
 
 def processing_scan_results(scan_id: int):
-    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).first()
+    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).defer("retrieved_scan_report").first()
     if not scan:
         log.debug(f"Could not retrieve scan {scan_id}.")
         return []
 
     update_state(scan.pk, "processing scan results", "")
 
-    return process_scan_results.s(scan.pk)
+    # Reports that are stored without batches are processed in a single task.
+    if scan.retrieved_scan_report_batches is None:
+        return chain(process_scan_results.si(scan.pk))
+
+    # Large scans are processed in several tasks, so a single task does not run into the time limit of the worker.
+    tasks = [process_scan_results_batch.si(scan.pk, start, end) for start, end in scan.retrieved_scan_report_batches]
+    return chain(*tasks, finish_processing_scan_results.si(scan.pk))
 
 
 def update_state(scan_id: int, new_state: str, new_state_message: str):
 
-    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).first()
+    # the scan report is not needed and can be huge, also when saving the scan.
+    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).defer("retrieved_scan_report").first()
     if not scan:
         log.debug(f"Could not retrieve scan {scan_id}.")
         return
@@ -371,7 +396,7 @@ def api_has_usable_response(response, scan_id):
 
     if status_code == 599:
         # using the log the previous actionable state can be retrieved as a recovery strategy.
-        update_state(scan_id, "network_error", response_content["error"]["label"])
+        update_state(scan_id, "network_error", str(response_content.get("network_error", "")))
         return False
 
     if status_code == 500:
@@ -546,34 +571,147 @@ def result_administration(response: Tuple[int, dict], scan_id: int):
 
 
 @app.task(queue="storage")
-def process_scan_results(scan_id: int):
-    scan_type_to_protocol = {
-        # mail is used for web security map, it is a subset of mail servers that dedupes servers on cnames.
-        "mail": "dns_mx_no_cname",
-        # dns soa are internet.nl dashboard scans that have a different requirement set for the mailserver endpoint
-        "mail_dashboard": "dns_soa",
-        # web scans are only used by the internet.nl dashboard...
-        "web": "dns_a_aaaa",
-    }
+def store_scan_results(scan_id: int):
+    """
+    Downloads the results of a scan and stores the metadata and domains, see result_administration.
 
-    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).first()
+    The results of large scans are tens of megabytes. They are downloaded to a temporary file and parsed one domain
+    at a time, so the parsed results are never loaded in memory. The report is split into batches of domains while
+    doing so, each batch is processed by a separate task that only reads its own part of the report.
+    """
+    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).defer("retrieved_scan_report").first()
+    if not scan:
+        log.debug(f"Could not retrieve scan {scan_id}.")
+        return
+
+    with tempfile.TemporaryFile() as download:
+        response = stream_result(scan.scan_id, create_api_settings(scan.pk), download)
+        if not api_has_usable_response(response, scan.pk):
+            return
+
+        download.seek(0)
+        metadata = next(ijson.items(download, "request", use_float=True), None)
+
+        download.seek(0)
+        report, batches = serialize_scan_report(ijson.kvitems(download, "domains", use_float=True))
+
+    # The report is stored as is: the json field would parse it again to store it.
+    InternetNLV2Scan.objects.all().filter(pk=scan.pk).update(
+        metadata=metadata,
+        retrieved_scan_report=Value(report, output_field=TextField()),
+        retrieved_scan_report_batches=batches,
+    )
+
+    update_state(scan.pk, "scan results stored", "")
+
+
+def serialize_scan_report(
+    domains: Iterable[Tuple[str, dict]], batch_size: int = None
+) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    Returns the report as json and the start and end of every batch of domains in it. A batch is a part of the json
+    object with the report: the domains and their scan data, separated by commas.
+    """
+    batch_size = batch_size if batch_size else PROCESSING_BATCH_SIZE
+    report = io.StringIO()
+    report.write("{")
+    batches = []
+    for index, (domain, scan_data) in enumerate(domains):
+        if index:
+            report.write(", ")
+        if index % batch_size == 0:
+            batches.append((report.tell(), report.tell()))
+        report.write(f"{json.dumps(domain)}: {json.dumps(scan_data)}")
+        batches[-1] = (batches[-1][0], report.tell())
+    report.write("}")
+    return report.getvalue(), batches
+
+
+class ScanReportReader:
+    """
+    Reads the stored report as utf-8, one chunk at a time. ijson reads bytes, this prevents encoding a copy of the
+    entire report.
+    """
+
+    def __init__(self, report: str):
+        self.report = report
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.report) if size < 0 else self.position + size
+        chunk = self.report[self.position : end]
+        self.position += len(chunk)
+        return chunk.encode()
+
+
+def scan_report_reader(scan_id: int) -> Optional[ScanReportReader]:
+    # The report is retrieved as text, otherwise the json field parses the entire report at once.
+    report = (
+        InternetNLV2Scan.objects.all()
+        .filter(pk=scan_id)
+        .annotate(report_text=Cast("retrieved_scan_report", TextField()))
+        .values_list("report_text", flat=True)
+        .first()
+    )
+    return ScanReportReader(report) if report else None
+
+
+def iterate_scan_report(scan_id: int) -> Iterator[Tuple[str, dict]]:
+    """Yields the domains and their scan data from the stored report, parsing one domain at a time."""
+    report = scan_report_reader(scan_id)
+    if not report:
+        return iter([])
+
+    return ijson.kvitems(report, "", use_float=True)
+
+
+def scan_report_batch(scan_id: int, start: int, end: int) -> Dict[str, dict]:
+    """The domains and scan data of a batch, only this part of the report is read from the database."""
+    part = (
+        InternetNLV2Scan.objects.all()
+        .filter(pk=scan_id)
+        .annotate(part=Substr(Cast("retrieved_scan_report", TextField()), start + 1, end - start))
+        .values_list("part", flat=True)
+        .first()
+    )
+    return json.loads(f"{{{part}}}") if part else {}
+
+
+@app.task(queue="storage")
+def process_scan_results(scan_id: int):
+    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).defer("retrieved_scan_report").first()
     if not scan:
         log.debug(f"Could not retrieve scan {scan_id}.")
         return []
 
-    domains = scan.retrieved_scan_report.keys()
+    # domains are stored as soon as a batch has been parsed.
+    batch = {}
+    for domain, scan_data in iterate_scan_report(scan.pk):
+        batch[domain] = scan_data
+        if len(batch) == PROCESSING_BATCH_SIZE:
+            store_domains_scan_results(batch, scan.type)
+            batch = {}
 
-    for domain in domains:
+    if batch:
+        store_domains_scan_results(batch, scan.type)
+
+    finish_processing_scan_results(scan.pk)
 
-        store_domain_scan_results(
-            domain=domain,
-            scan_data=scan.retrieved_scan_report[domain],
-            scan_type=scan.type,
-            endpoint_protocol=scan_type_to_protocol[scan.type],
-        )
 
-    update_state(scan.pk, "scan results processed", "")
-    update_state(scan.pk, "finished", "")
+@app.task(queue="storage")
+def process_scan_results_batch(scan_id: int, start: int, end: int):
+    scan = InternetNLV2Scan.objects.all().filter(pk=scan_id).only("type").first()
+    if not scan:
+        log.debug(f"Could not retrieve scan {scan_id}.")
+        return
+
+    store_domains_scan_results(scan_report_batch(scan.pk, start, end), scan.type)
+
+
+@app.task(queue="storage")
+def finish_processing_scan_results(scan_id: int):
+    update_state(scan_id, "scan results processed", "")
+    update_state(scan_id, "finished", "")
 
 
 def reuse_last_fields_and_set_them_to_error(endpoint_id):
@@ -581,21 +719,81 @@ def reuse_last_fields_and_set_them_to_error(endpoint_id):
     if not endpoint_id:
         return
 
-    # get all latest fields from this endpoint.
+    store_endpoint_scan_results(error_scan_results([endpoint_id]))
+
+
+def error_scan_results(endpoint_ids: List[int]) -> List[ScanResult]:
+    # get all latest fields from these endpoints.
     # This does not interfere with other scans, as they happen on different endpoints.
-    fields = EndpointGenericScan.objects.all().filter(endpoint=endpoint_id).values_list("type", flat=True).distinct()
-    for field in fields:
-        store_endpoint_scan_result(
-            scan_type=field,
-            endpoint_id=endpoint_id,
-            rating="error",
-            message=json.dumps({"translation": "error", "technical_details_hash": ""}),
-            evidence="Error retrieving scan result data, something went wrong during the scan.",
+    fields = (
+        EndpointGenericScan.objects.all()
+        .filter(endpoint__in=endpoint_ids)
+        .values_list("endpoint", "type")
+        .order_by("endpoint", "type")
+        .distinct()
+    )
+    return [
+        (
+            field,
+            endpoint_id,
+            "error",
+            json.dumps({"translation": "error", "technical_details_hash": ""}),
+            "Error retrieving scan result data, something went wrong during the scan.",
         )
+        for endpoint_id, field in fields
+    ]
 
 
 @app.task(queue="storage")
 def store_domain_scan_results(domain: str, scan_data: dict, scan_type: str, endpoint_protocol: str):
+    # endpoint_protocol is kept for tasks that are already queued, the protocol follows from the scan type.
+    store_domains_scan_results({domain: scan_data}, scan_type)
+
+
+def store_domains_scan_results(scan_report: Dict[str, dict], scan_type: str):
+    """
+    Stores the results of many domains at once. The endpoints of all domains are retrieved in one query and all
+    results are compared to the latest scans in bulk, see store_endpoint_scan_results.
+
+    :param scan_report: domain name -> the scan data of that domain, see domain_scan_results.
+    :param scan_type: web, mail, mail_dashboard
+    """
+
+    # Match the endpoints. We're not implicitly adding endpoints.
+    endpoints = {}
+    for domain, endpoint_id in (
+        Endpoint.objects.all()
+        .filter(protocol=SCAN_TYPE_TO_PROTOCOL[scan_type], url__url__in=list(scan_report.keys()), is_dead=False)
+        .order_by("id")
+        .values_list("url__url", "id")
+    ):
+        endpoints.setdefault(domain, endpoint_id)
+
+    results = []
+    erroneous_endpoints = []
+    for domain, scan_data in scan_report.items():
+        if domain not in endpoints:
+            log.debug(f"No matching endpoint found for {domain}, perhaps this was deleted / resolvable meanwhile.")
+            continue
+
+        if scan_data["status"] == "error":
+            log.error(
+                f"Domain {domain} received an error from internet.nl. "
+                f"There is probably a bug in the internet.nl scanner. All previous scan results from this"
+                f"endpoint are set to error."
+            )
+            erroneous_endpoints.append(endpoints[domain])
+            continue
+
+        results += domain_scan_results(endpoints[domain], scan_data, scan_type)
+
+    if erroneous_endpoints:
+        results += error_scan_results(erroneous_endpoints)
+
+    store_endpoint_scan_results(results)
+
+
+def domain_scan_results(endpoint_id: int, scan_data: dict, scan_type: str) -> List[ScanResult]:
     """
         The error status only occurs when there was a crash during the scanning of a domain. This is usually
         a bug in the internet.nl scanner, which has to be fixed over time. An error will be emitted when
@@ -631,29 +829,12 @@ def store_domain_scan_results(domain: str, scan_data: dict, scan_type: str, endp
         }
 
     :return:
-    :param domain: a domain name, such as "internet.nl"
+    :param endpoint_id: the endpoint of the domain the results are connected to.
     :param scan_data: the scan data for a specific domain
     :param scan_type: web, mail, mail_dashboard
-    :param endpoint_protocol: to what endpoint of this domain the result data has to be connected.
-    :return:
+    :return: the scan results of this domain, to be stored with store_endpoint_scan_results.
     """
 
-    # Match the endpoint. We're not implicitly adding endpoints.
-    endpoint = Endpoint.objects.all().filter(protocol=endpoint_protocol, url__url=domain, is_dead=False).first()
-
-    if not endpoint:
-        log.debug("No matching endpoint found, perhaps this was deleted / resolvable meanwhile. Skipping")
-        return
-
-    if scan_data["status"] == "error":
-        log.error(
-            f"Domain {domain} received an error from internet.nl. "
-            f"There is probably a bug in the internet.nl scanner. All previous scan results from this"
-            f"endpoint are set to error."
-        )
-        reuse_last_fields_and_set_them_to_error(endpoint)
-        return
-
     # link changes every time, so can't save that as message. -> _wrong_
     # The link changes every time and thus does the link to the report that will be referred in our own reports
     # and the latest link is always the one that people are interested in. Even more so: the installations of
@@ -662,13 +843,15 @@ def store_domain_scan_results(domain: str, scan_data: dict, scan_type: str, endp
     # which was from another user. But that will take all updates from that scan, so it's up to date. These are
     # edge cases that are in here by design: we always want to get data from a certain point in time, regardless
     # who started the scan.
-    store_endpoint_scan_result(
-        scan_type=f"internet_nl_{scan_type}_overall_score",
-        endpoint_id=endpoint.pk,
-        rating=scan_data["scoring"]["percentage"],
-        message=scan_data["report"]["url"],
-        evidence=scan_data["report"]["url"],
-    )
+    results = [
+        (
+            f"internet_nl_{scan_type}_overall_score",
+            endpoint_id,
+            scan_data["scoring"]["percentage"],
+            scan_data["report"]["url"],
+            scan_data["report"]["url"],
+        )
+    ]
 
     api_v2_categories_to_v1_categories = {
         "mail": {
@@ -699,18 +882,23 @@ def store_domain_scan_results(domain: str, scan_data: dict, scan_type: str, endp
         # to keep APIv2 field names in line with APIv1, so we don't have to rename fields and all reports stay valid.
         scan_type_field = f"internet_nl_{scan_type}_{api_v2_categories_to_v1_categories[scan_type][category]}"
 
-        store_endpoint_scan_result(
-            scan_type=scan_type_field,
-            endpoint_id=endpoint.pk,
-            rating=scan_data["results"]["categories"][category]["status"],
-            message=json.dumps(
-                {"translation": scan_data["results"]["categories"][category]["verdict"], "technical_details_hash": ""}
-            ),
-            evidence=scan_data["report"]["url"],
+        results.append(
+            (
+                scan_type_field,
+                endpoint_id,
+                scan_data["results"]["categories"][category]["status"],
+                json.dumps(
+                    {
+                        "translation": scan_data["results"]["categories"][category]["verdict"],
+                        "technical_details_hash": "",
+                    }
+                ),
+                scan_data["report"]["url"],
+            )
         )
 
     # standard tests:
-    store_test_results(endpoint.pk, scan_data["results"]["tests"])
+    results += results_of_tests(endpoint_id, scan_data["results"]["tests"])
 
     # prepare for calculated results
     scan_data["results"]["calculated_results"] = {}
@@ -719,37 +907,40 @@ def store_domain_scan_results(domain: str, scan_data: dict, scan_type: str, endp
     elif scan_type == "mail_dashboard":
         scan_data = calculate_forum_standaardisatie_views_mail(scan_data)
 
-    store_test_results(endpoint.pk, scan_data["results"]["calculated_results"])
+    results += results_of_tests(endpoint_id, scan_data["results"]["calculated_results"])
+
+    return results
 
 
-def store_test_results(endpoint_id, test_results):
+def results_of_tests(endpoint_id, test_results) -> List[ScanResult]:
     # this way new fields are automatically added
     test_results_keys = test_results.keys()
 
+    # technical_details can change, and these changes should always be reflected in the data. In our model
+    # only rating and message are treated as unique. The technical data is often very long and will not fit
+    # in either rating and message, and will cause delays in working with these fields. What we do instead is
+    # create a hash and append it to the message. Technical details are an array of array of string
+    # may 2020: technical details moved to their own endpoint. Will be relevant in a later
+    # version, so all the rest of the stuff is kept.
+    dumped_technical_details = ""
+    technical_details_hash = hashlib.md5(dumped_technical_details.encode("utf-8")).hexdigest()
+
+    results = []
     for test_result_key in test_results_keys:
         test_result = test_results[test_result_key]
 
-        scan_type = f"internet_nl_{test_result_key}"
-
-        # technical_details can change, and these changes should always be reflected in the data. In our model
-        # only rating and message are treated as unique. The technical data is often very long and will not fit
-        # in either rating and message, and will cause delays in working with these fields. What we do instead is
-        # create a hash and append it to the message. Technical details are an array of array of string
-        # log.debug(f"{scan_type}  = {test_result}")
-        # may 2020: technical details moved to their own endpoint. Will be relevant in a later
-        # version, so all the rest of the stuff is kept.
-        dumped_technical_details = ""
-        technical_details_hash = hashlib.md5(dumped_technical_details.encode("utf-8")).hexdigest()
-        store_endpoint_scan_result(
-            scan_type=scan_type,
-            endpoint_id=endpoint_id,
-            rating=test_result["status"],
-            message=json.dumps(
-                {"translation": test_result["verdict"], "technical_details_hash": technical_details_hash}
-            ),
-            evidence="",
+        results.append(
+            (
+                f"internet_nl_{test_result_key}",
+                endpoint_id,
+                test_result["status"],
+                json.dumps({"translation": test_result["verdict"], "technical_details_hash": technical_details_hash}),
+                "",
+            )
         )
 
+    return results
+
 
 def add_calculation(scan_data, new_key: str, required_values: List[str]):
     lowest_value = lowest_value_in_results(scan_data, required_values)
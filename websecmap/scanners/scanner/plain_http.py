@@ -216,7 +216,7 @@ def scan(ip_version: int, url: str):
         # The worker (should) only resolve domain names only over ipv4 or ipv6. (A / AAAA).
         # Currenlty docker does not support that. Which means a lot of network rewriting for dealing with
         # all edge cases of HTTP.
-        redirects_to_safety_result = redirects_to_safety(f"http://{url}:80")
+        redirects_to_safety_result = redirects_to_safety(f"http://{url}:80", ip_version)
 
     return resolves, can_connect_result, redirects_to_safety_result
 
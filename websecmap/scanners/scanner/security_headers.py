@@ -3,7 +3,11 @@ Check if the https site uses HSTS to tell the browser the site should only be re
 (useful until browsers do https by default, instead of by choice)
 """
 import logging
-from typing import Dict, Any, Union
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from time import sleep
+from typing import Dict, Any, List, Optional, Tuple, Union
+from urllib.parse import urlparse
 
 import requests
 import urllib3
@@ -13,10 +17,16 @@ from requests import ConnectionError, ConnectTimeout, HTTPError, ReadTimeout, Ti
 from websecmap.celery import app
 from websecmap.organizations.models import Organization, Url
 from websecmap.scanners import plannedscan
+from websecmap.scanners.http_pool import pooled_session
 from websecmap.scanners.models import Endpoint, EndpointGenericScan
 from websecmap.scanners.plannedscan import retrieve_endpoints_from_urls
-from websecmap.scanners.scanmanager import store_endpoint_scan_result
-from websecmap.scanners.scanner.__init__ import allowed_to_scan, q_configurations_to_scan, unique_and_random
+from websecmap.scanners.scanmanager import ScanResult, store_endpoint_scan_results
+from websecmap.scanners.scanner.__init__ import (
+    allowed_to_scan,
+    chunks2,
+    q_configurations_to_scan,
+    unique_and_random,
+)
 from websecmap.scanners.scanner.http import get_random_user_agent
 from websecmap.scanners.scanner.utils import CELERY_IP_VERSION_QUEUE_NAMES
 
@@ -30,6 +40,19 @@ SECURITY_HEADER_SCAN_TYPES = [
     "http_security_header_x_xss_protection",
 ]
 
+# Endpoints of which the headers are retrieved in one task, and evaluated and stored in one task.
+HEADER_SCAN_BATCH_SIZE = 50
+
+# The amount of endpoints of which the headers are retrieved at the same time.
+MAX_CONCURRENT_REQUESTS = 10
+
+# Retries when the headers could not be retrieved, with some seconds in between.
+MAX_RETRIES = 3
+RETRY_DELAY = 1
+
+# endpoint id, headers or False when the headers could not be retrieved.
+HeaderResult = Tuple[int, Union[Dict[str, str], bool]]
+
 
 def filter_scan(
     organizations_filter: dict = dict(), urls_filter: dict = dict(), endpoints_filter: dict = dict(), **kwargs
@@ -96,12 +119,18 @@ def compose_scan_task(urls):
     log.debug(f"Scanning security headers on {len(endpoints)} endpoints, {len(urls)} urls")
 
     tasks = []
-    for endpoint in endpoints:
-        tasks.append(
-            get_headers.si(endpoint.uri_url()).set(queue=CELERY_IP_VERSION_QUEUE_NAMES[endpoint.ip_version])
-            | analyze_headers.s(endpoint.pk)
-            | plannedscan.finish.si("scan", "security_headers", endpoint.url.pk)
-        )
+    for ip_version in sorted({endpoint.ip_version for endpoint in endpoints}):
+        same_network = [endpoint for endpoint in endpoints if endpoint.ip_version == ip_version]
+        for batch in chunks2(same_network, HEADER_SCAN_BATCH_SIZE):
+            tasks.append(
+                get_headers_batch.si([(endpoint.pk, endpoint.uri_url()) for endpoint in batch], ip_version).set(
+                    queue=CELERY_IP_VERSION_QUEUE_NAMES[ip_version]
+                )
+                | analyze_headers_batch.s()
+                | plannedscan.finish_multiple.si(
+                    "scan", "security_headers", list({endpoint.url.pk for endpoint in batch})
+                )
+            )
 
     return group(tasks)
 
@@ -161,7 +190,53 @@ def discover_service_type(headers: Dict = None):
 
 
 @app.task(queue="storage")
-def analyze_headers(headers: Dict[str, str], endpoint_id):
+def analyze_headers_batch(results: List[HeaderResult]):
+    """
+    Evaluates all security header scan types of a batch of endpoints, and stores them in one go. Everything that is
+    needed to evaluate the headers is retrieved upfront, with a query per batch instead of per endpoint.
+    """
+    endpoint_ids = [endpoint_id for endpoint_id, headers in results]
+
+    endpoints = {
+        endpoint.pk: endpoint
+        for endpoint in Endpoint.objects.all().filter(pk__in=endpoint_ids).only("id", "protocol", "url_id")
+    }
+
+    existing_scan_types = defaultdict(list)
+    for endpoint_id, scan_type in (
+        EndpointGenericScan.objects.all()
+        .filter(endpoint__in=endpoint_ids, type__in=SECURITY_HEADER_SCAN_TYPES, is_the_latest_scan=True)
+        .values_list("endpoint_id", "type")
+    ):
+        existing_scan_types[endpoint_id].append(scan_type)
+
+    # urls that run any unsecured http service (on ANY port), used in the HSTS check.
+    https_urls = {endpoint.url_id for endpoint in endpoints.values() if endpoint.protocol == "https"}
+    insecure_urls = set(
+        Endpoint.objects.all()
+        .filter(url__in=https_urls, protocol="http", is_dead=False)
+        .values_list("url_id", flat=True)
+    )
+
+    scan_results = []
+    for endpoint_id, headers in results:
+        endpoint = endpoints.get(endpoint_id, None)
+        offers_insecure_http = endpoint is not None and endpoint.url_id in insecure_urls
+        scan_results += analyze_headers(
+            headers, endpoint_id, endpoint, existing_scan_types[endpoint_id], offers_insecure_http
+        )
+
+    store_endpoint_scan_results(scan_results)
+    return {"status": "success"}
+
+
+def analyze_headers(
+    headers: Union[Dict[str, str], bool],
+    endpoint_id: int,
+    endpoint: Optional[Endpoint],
+    existing_scan_types: List[str],
+    offers_insecure_http: bool,
+) -> List[ScanResult]:
     # todo: remove code paths, and make a more clear case per header type. That's easier to understand edge cases.
     # todo: Content-Security-Policy, Referrer-Policy
 
@@ -181,46 +256,38 @@ def analyze_headers(headers: Dict[str, str], endpoint_id):
 
         """
 
-        existing_header_scans = EndpointGenericScan.objects.all().filter(
-            endpoint=endpoint_id, type__in=SECURITY_HEADER_SCAN_TYPES, is_the_latest_scan=True
-        )
-
         # Do not store 'corrections' when there are no scans already.
-        if not existing_header_scans:
-            # kombu.exceptions.EncodeError: Object of type ParentFailed is not JSON serializable
-            # return ParentFailed("Skipping http header result parsing because scan failed.", cause=headers)
-            return {"status": "success"}
-
         # There used to be stringent filtering here: for oserror and ECONNRESET in the exception, but the fact is
         # that there are so many possible network errors, that it's always a struggle to keep up to date.
         # Instead of handling every edge case, make sure that the existing headers are set to unreachable,
         # and that the evidence shows what went wrong for later debugging reasons.
-
-        for scan in existing_header_scans:
-            store_endpoint_scan_result(
-                scan.type, endpoint_id, "Unreachable", "Address became unreachable.", str(headers)
-            )
-
-        return {"status": "success"}
+        return [
+            (scan_type, endpoint_id, "Unreachable", "Address became unreachable.", str(headers))
+            for scan_type in existing_scan_types
+        ]
 
     # determine what kind of service we're dealing with.
     service_type = discover_service_type(headers)
 
-    endpoint = Endpoint.objects.all().filter(pk=endpoint_id).only("pk", "url__id", "protocol").first()
     if not endpoint:
-        return {"status": "success"}
+        return []
 
     if service_type == "HTTP":
-        return analyze_website_headers(endpoint_id, endpoint.url.id, endpoint.protocol, headers)
+        return analyze_website_headers(endpoint_id, endpoint.protocol, headers, offers_insecure_http)
     if service_type == "SOAP":
-        return analyze_soap_headers(endpoint_id)
+        return analyze_soap_headers(endpoint_id, existing_scan_types)
     if service_type == "UNKNOWN":
-        return clean_up_existing_headers(endpoint_id, service_type=service_type, reason="unknown_content_type")
+        return clean_up_existing_headers(
+            endpoint_id, existing_scan_types, service_type=service_type, reason="unknown_content_type"
+        )
     if service_type == "RESTRICTED":
-        return clean_up_existing_headers(endpoint_id, service_type=service_type, reason="authentication_required")
+        return clean_up_existing_headers(
+            endpoint_id, existing_scan_types, service_type=service_type, reason="authentication_required"
+        )
+    return []
 
 
-def analyze_soap_headers(endpoint_id):
+def analyze_soap_headers(endpoint_id: int, existing_scan_types: List[str]) -> List[ScanResult]:
     """
     We currently have no implementation for SOAP headers, but we do know that previously discovered non-soap headers
     can be overwritten as being SOAP headers and not being relevant anymore.
@@ -231,44 +298,38 @@ def analyze_soap_headers(endpoint_id):
     A next iteration of websecmap could/should contain this validation that certain headers are mandated for SOAP.
 
     :param endpoint_id:
+    :param existing_scan_types: the header scan types that have been stored for this endpoint.
     :return:
     """
 
     # clean up existing web headers and set them to being not relevant for soap:
-    existing_header_scans = EndpointGenericScan.objects.all().filter(
-        endpoint=endpoint_id, type__in=SECURITY_HEADER_SCAN_TYPES, is_the_latest_scan=True
-    )
-
-    for scan in existing_header_scans:
-        store_endpoint_scan_result(scan.type, endpoint_id, "SOAP", "Header not relevant for SOAP service.")
-
-    return {"status": "success"}
+    return [
+        (scan_type, endpoint_id, "SOAP", "Header not relevant for SOAP service.") for scan_type in existing_scan_types
+    ]
 
 
-def clean_up_existing_headers(endpoint_id: int, service_type: str, reason: str):
+def clean_up_existing_headers(
+    endpoint_id: int, existing_scan_types: List[str], service_type: str, reason: str
+) -> List[ScanResult]:
     """
     Unknown headers for a content type we can't handle.
 
     We do NOT create new headers, meaning that if no relevant data was found, no records are added to the database.
 
     :param endpoint_id:
+    :param existing_scan_types: the header scan types that have been stored for this endpoint.
     :param service_type: What type of service has been discovered that prevents further processing: RESTRICTED, UNKNOWN
     :param reason: More verbose explanation of the service type.
     :return:
     """
 
     # clean up existing web headers and set them to being not relevant for soap:
-    existing_header_scans = EndpointGenericScan.objects.all().filter(
-        endpoint=endpoint_id, type__in=SECURITY_HEADER_SCAN_TYPES, is_the_latest_scan=True
-    )
-
-    for scan in existing_header_scans:
-        store_endpoint_scan_result(scan.type, endpoint_id, service_type, reason)
-
-    return {"status": "success"}
+    return [(scan_type, endpoint_id, service_type, reason) for scan_type in existing_scan_types]
 
 
-def analyze_website_headers(endpoint_id: int, url: int, protocol: str, headers: Dict[str, str]):
+def analyze_website_headers(
+    endpoint_id: int, protocol: str, headers: Dict[str, str], offers_insecure_http: bool
+) -> List[ScanResult]:
     """
     #125: CSP can replace X-XSS-Protection and X-Frame-Options. Thus if a (more modern) CSP header is present, assume
     that decisions have been made about what's in it and ignore the previously mentioned headers.
@@ -287,9 +348,11 @@ def analyze_website_headers(endpoint_id: int, url: int, protocol: str, headers:
     # We've removed conditional scans in scannerss, as more scan data is better.
     # you can cohose not to display or report it. Below used to be conditional scans.
 
-    generic_check_using_csp_fallback(endpoint_id, headers, "X-XSS-Protection")
-    generic_check_using_csp_fallback(endpoint_id, headers, "X-Frame-Options")
-    generic_check(endpoint_id, headers, "X-Content-Type-Options")
+    results = [
+        generic_check_using_csp_fallback(endpoint_id, headers, "X-XSS-Protection"),
+        generic_check_using_csp_fallback(endpoint_id, headers, "X-Frame-Options"),
+        generic_check(endpoint_id, headers, "X-Content-Type-Options"),
+    ]
 
     """
     https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Strict-Transport-Security
@@ -318,120 +381,138 @@ def analyze_website_headers(endpoint_id: int, url: int, protocol: str, headers:
     if protocol == "https":
 
         # runs any unsecured http service? (on ANY port).
-        unsecure_services = Endpoint.objects.all().filter(url=url, protocol="http", is_dead=False).exists()
-        if unsecure_services:
-            generic_check(endpoint_id, headers, "Strict-Transport-Security")
+        if offers_insecure_http:
+            results.append(generic_check(endpoint_id, headers, "Strict-Transport-Security"))
         else:
             if "Strict-Transport-Security" in headers:
                 log.debug("Has Strict-Transport-Security")
-                store_endpoint_scan_result(
-                    "http_security_header_strict_transport_security",
-                    endpoint_id,
-                    "True",
-                    headers["Strict-Transport-Security"],
+                results.append(
+                    (
+                        "http_security_header_strict_transport_security",
+                        endpoint_id,
+                        "True",
+                        headers["Strict-Transport-Security"],
+                    )
                 )
             else:
                 log.debug("Has no Strict-Transport-Security, yet offers no insecure http service.")
-                store_endpoint_scan_result(
-                    "http_security_header_strict_transport_security",
-                    endpoint_id,
-                    "False",
-                    "Security Header not present: Strict-Transport-Security, " "yet offers no insecure http service.",
+                results.append(
+                    (
+                        "http_security_header_strict_transport_security",
+                        endpoint_id,
+                        "False",
+                        "Security Header not present: Strict-Transport-Security, yet offers no insecure http service.",
+                    )
                 )
 
-    return {"status": "success"}
+    return results
 
 
-def generic_check(endpoint_id: int, headers, header):
+def generic_check(endpoint_id: int, headers, header) -> ScanResult:
     # this is case insensitive
 
     scan_type = "http_security_header_%s" % header.lower().replace("-", "_")
 
     if header in headers.keys():
         log.debug("Has %s" % header)
-        store_endpoint_scan_result(scan_type, endpoint_id, "True", headers[header])
-    else:
-        log.debug("Has no %s" % header)
-        store_endpoint_scan_result(scan_type, endpoint_id, "False", "Security Header not present: %s" % header)
+        return scan_type, endpoint_id, "True", headers[header]
 
+    log.debug("Has no %s" % header)
+    return scan_type, endpoint_id, "False", "Security Header not present: %s" % header
 
-def generic_check_using_csp_fallback(endpoint_id: int, headers, header):
+
+def generic_check_using_csp_fallback(endpoint_id: int, headers, header) -> ScanResult:
     scan_type = "http_security_header_%s" % header.lower().replace("-", "_")
 
     # this is case insensitive
     if header in headers.keys():
         log.debug("Has %s" % header)
-        store_endpoint_scan_result(scan_type, endpoint_id, "True", headers[header])
-    else:
-        # CSP fallback:
-        log.debug("CSP fallback used for %s" % header)
-        if "Content-Security-Policy" in headers.keys():
-            store_endpoint_scan_result(
-                scan_type=scan_type,
-                endpoint_id=endpoint_id,
-                rating="Using CSP",
-                message="Content-Security-Policy header found, which can handle the security from %s."
-                "Value (possibly truncated): %s..." % (header, headers["Content-Security-Policy"][0:80]),
-                evidence=headers["Content-Security-Policy"],
-            )
+        return scan_type, endpoint_id, "True", headers[header]
+
+    # CSP fallback:
+    log.debug("CSP fallback used for %s" % header)
+    if "Content-Security-Policy" in headers.keys():
+        return (
+            scan_type,
+            endpoint_id,
+            "Using CSP",
+            "Content-Security-Policy header found, which can handle the security from %s."
+            "Value (possibly truncated): %s..." % (header, headers["Content-Security-Policy"][0:80]),
+            headers["Content-Security-Policy"],
+        )
 
-        else:
-            log.debug("Has no %s" % header)
-            store_endpoint_scan_result(
-                scan_type=scan_type,
-                endpoint_id=endpoint_id,
-                rating="False",
-                message="Security Header not present: %s, alternative header Content-Security-Policy not present."
-                % header,
-            )
+    log.debug("Has no %s" % header)
+    return (
+        scan_type,
+        endpoint_id,
+        "False",
+        "Security Header not present: %s, alternative header Content-Security-Policy not present." % header,
+    )
 
 
-@app.task(bind=True, default_retry_delay=1, retry_kwargs={"max_retries": 3})
-def get_headers(self, uri_uri: str) -> Union[Dict[str, Any], bool]:
+@app.task
+def get_headers_batch(endpoints: List[Tuple[int, str]], ip_version: int) -> List[HeaderResult]:
+    """
+    Retrieves the headers of a batch of endpoints at the same time. Requests to the same host share their
+    connections, see http_pool.
+
+    :param endpoints: endpoint id and uri_url of every endpoint.
+    :param ip_version: the network the endpoints are on.
+    :return: endpoint id and headers, or False if the headers could not be retrieved.
+    """
+    # celery doesn't work with asyncio. But it does work with threadpools.
+    pool = ThreadPool(MAX_CONCURRENT_REQUESTS)
     try:
-        response = get_headers_request(uri_uri)
-        # Object of type CaseInsensitiveDict is not JSON serializable.
-        return dict(response.headers)
-
-    # The amount of possible return states is overwhelming :)
-
-    # Solving https://sentry.io/internet-cleanup-foundation/faalkaart/issues/460895712/
-    #         https://sentry.io/internet-cleanup-foundation/faalkaart/issues/460895699/
-    # ValueError, really don't know how to further handle it.
-    #
-    # Solving https://sentry.io/internet-cleanup-foundation/faalkaart/issues/425503689/
-    # requests.TooManyRedirects
-    #
-    # Solving https://sentry.io/internet-cleanup-foundation/faalkaart/issues/425507209/
-    # LocationValueError - No host specified.
-    # it redirects to something like https:/// (with three slashes) and then somewhere it crashes
-    # possibly an error in requests.
-    #
-    # Possibly tooManyRedirects could be plotted on the map, given this is a configuration error
-    except (
-        ConnectTimeout,
-        HTTPError,
-        ReadTimeout,
-        Timeout,
-        ConnectionError,
-        ValueError,
-        requests.TooManyRedirects,
-        urllib3.exceptions.LocationValueError,
-    ) as e:
-        # If an expected error is encountered put this task back on the queue to be retried.
-        # This will keep the chained logic in place (saving result after successful scan).
-        # Retry delay and total number of attempts is configured in the task decorator.
-        try:
-            # Since this action raises an exception itself, any code after this won't be executed.
-            raise self.retry(exc=e)
-        except BaseException:
-            # If this task still fails after maximum retries the last
-            # error will be passed as result to the next task.
-            # Exceptions do not serialize.
-            return False
+        headers = pool.map(lambda endpoint: get_headers(endpoint[1], ip_version), endpoints)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [(endpoint_id, endpoint_headers) for (endpoint_id, uri_url), endpoint_headers in zip(endpoints, headers)]
 
 
-def get_headers_request(uri_url: str) -> Response:
+def get_headers(uri_uri: str, ip_version: int = 0) -> Union[Dict[str, Any], bool]:
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = get_headers_request(uri_uri, ip_version)
+            # Object of type CaseInsensitiveDict is not JSON serializable.
+            return dict(response.headers)
+
+        # The amount of possible return states is overwhelming :)
+
+        # Solving https://sentry.io/internet-cleanup-foundation/faalkaart/issues/460895712/
+        #         https://sentry.io/internet-cleanup-foundation/faalkaart/issues/460895699/
+        # ValueError, really don't know how to further handle it.
+        #
+        # Solving https://sentry.io/internet-cleanup-foundation/faalkaart/issues/425503689/
+        # requests.TooManyRedirects
+        #
+        # Solving https://sentry.io/internet-cleanup-foundation/faalkaart/issues/425507209/
+        # LocationValueError - No host specified.
+        # it redirects to something like https:/// (with three slashes) and then somewhere it crashes
+        # possibly an error in requests.
+        #
+        # Possibly tooManyRedirects could be plotted on the map, given this is a configuration error
+        except (
+            ConnectTimeout,
+            HTTPError,
+            ReadTimeout,
+            Timeout,
+            ConnectionError,
+            ValueError,
+            requests.TooManyRedirects,
+            urllib3.exceptions.LocationValueError,
+        ) as e:
+            # Network errors are often temporary, so try again a few times with a small delay. If it still fails,
+            # False is returned and the headers are handled as unreachable. Exceptions do not serialize.
+            log.debug(f"Could not retrieve headers of {uri_uri} (attempt {attempt + 1}): {e}")
+            if attempt < MAX_RETRIES:
+                sleep(RETRY_DELAY)
+
+    return False
+
+
+def get_headers_request(uri_url: str, ip_version: int = 0) -> Response:
     """
     Issue #94:
     TL;DR: The fix is to follow all redirects.
@@ -459,6 +540,9 @@ def get_headers_request(uri_url: str) -> Response:
     Update 17 dec 2018: some web servers require a user agent to be sent in order to give a "more correct" response.
     Given that 'humans with browsers' access these pages, it's normal to also send a user agent.
 
+    Connections are kept open in a pooled session per host and ip version, as both the http and https endpoint of a
+    host are scanned, and redirects often go to the same host.
+
     :return: requests.response
     """
 
@@ -466,13 +550,14 @@ def get_headers_request(uri_url: str) -> Response:
 
     # ignore wrong certificates, those are handled in a different scan.
     # 10 seconds for network delay, 10 seconds for the site to respond.
-    response = requests.get(
-        uri_url,
-        timeout=(10, 10),
-        allow_redirects=True,
-        verify=False,  # nosec TLS does not have to be valid in this test, only headers do.
-        headers={"User-Agent": get_random_user_agent()},
-    )
+    with pooled_session(urlparse(uri_url).hostname, ip_version) as session:
+        response = session.get(
+            uri_url,
+            timeout=(10, 10),
+            allow_redirects=True,
+            verify=False,  # nosec TLS does not have to be valid in this test, only headers do.
+            headers={"User-Agent": get_random_user_agent()},
+        )
 
     # redirects are followed, this gives an indication on how many redirects are followed, and what url the
     # headers are taken from:
@@ -1,12 +1,12 @@
-import builtins
+import asyncio
 import itertools
 import logging
 import random
 import string
 import sys
-import tempfile
+from collections import Counter
 from datetime import datetime
-from typing import List, Any, Dict
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import pytz
 from celery import Task, group
@@ -19,11 +19,12 @@ from websecmap.celery import app
 from websecmap.map.logic.map_defaults import get_country
 from websecmap.organizations.models import Organization, Url
 from websecmap.scanners import plannedscan
-from websecmap.scanners.scanner.__init__ import q_configurations_to_scan, unique_and_random, url_filters
+from websecmap.scanners.resolver import NameserverRateLimit, resolve_async
+from websecmap.scanners.scanner.__init__ import chunks2, q_configurations_to_scan, unique_and_random, url_filters
 from websecmap.scanners.scanner.http import get_ips
 
 # Include DNSRecon code from an external dependency. This is cloned recursively and placed outside the django app.
-from websecmap.scanners.scanner.utils import get_random_nameserver
+from websecmap.scanners.scanner.utils import get_nameservers, get_random_nameserver
 
 sys.path.append(settings.VENDOR_DIR + "/dnsrecon/")
 
@@ -309,137 +310,163 @@ def dnsrecon_parse_report_contents(url: Dict[str, Any], contents: List):
     return addedlist
 
 
-# place it on the IPv4 queue, so it can scale using cloud workers :)
-# It seems that a rate limited task blocks an entire worker for any other tasks.
-@app.task(ignore_result=True, queue="known_subdomains", rate_limit="60/h")
+# Wordlist scans resolve a lot of names that do not exist. The lookups are spread over the configured nameservers,
+# and limited per nameserver.
+MAX_CONCURRENT_LOOKUPS = 200
+QUERIES_PER_SECOND_PER_NAMESERVER = 50
+
+# Found subdomains are stored per batch while the scan continues.
+FOUND_SUBDOMAINS_BATCH_SIZE = 50
+
+# The amount of random, non existing, subdomains that are resolved to find the addresses of a wildcard record.
+WILDCARD_PROBES = 3
+
+# Some hosts rotate a set of addresses for their wildcard record. When a domain uses wildcards, addresses that are
+# used by more than this amount of found subdomains are seen as wildcard addresses.
+WILDCARD_THRESHOLD = 10
+
+
+@app.task(ignore_result=True, queue="known_subdomains")
 def wordlist_scan(urls: List[Dict[str, Any]], wordlist: List[str]):
     """
-    60/h = 10.000 scans / week.
+    Tries every word in the wordlist as a subdomain of the urls. Found subdomains are added in batches, on the storage
+    queue.
 
     :param urls:
     :param wordlist:
     :return:
     """
-    # import DNSRecon using evil methods
-    sys.path.append(settings.VENDOR_DIR + "/dnsrecon/")
-    from dnsrecon import ThreadPool, brute_domain
-    from lib.dnshelper import DnsHelper
+    log.debug("Performing wordlist scan on %s urls, with the wordlist of %s words" % (len(urls), len(wordlist)))
 
-    # dnsrecon needs it's own threadpool. And you can only override it via builtins.
-    global pool
-    pool = ThreadPool(10)
-    # globals()['pool'] = pool
-    builtins.pool = pool
+    # Nameservers are stored in the database, which cannot be queried within the event loop.
+    nameservers = get_nameservers()
 
-    log.debug("Performing wordlist scan on %s urls, with the wordlist of %s words" % (len(urls), len(wordlist)))
+    for url in urls:
+        log.info("Wordlist scan on: %s" % url["url"])
+
+        found = 0
+        for subdomains in iterate_batches(brute_force_subdomains(url["url"], wordlist, nameservers)):
+            found += len(subdomains)
+            # You cant' know how many where added, since you don't have access to storage.
+            add_subdomains.apply_async([url, subdomains], queue="storage")
+
+        log.debug("Found %s subdomains on %s" % (found, url["url"]))
+
+    log.debug("Wordlist scan(s) finished.")
 
-    # any organization can determine at any points that there are now wildcards in effect
-    # would we not check this, all urls below the current url will be seen as valid, which
-    # results in database polution and a lot of extra useless scans.
-    # You can't run remove_and_save_wildcards here as it needs access to storage.
-    # urls_without_wildcards = remove_wildcards(urls)
+    return []
 
-    # Not checking for wildcards anymore, we're using a feature in dnsrecon to discern between the wildcard IP
-    # and the rest of the IPs'. That works pretty well (not found a deviating case yet).
-    urls_without_wildcards = urls
 
-    if not urls_without_wildcards:
-        log.debug("No urls found without wildcards.")
+@app.task(queue="storage")
+def add_subdomains(url: Dict[str, Any], subdomains: List[str]) -> List[str]:
+    db_url = Url.objects.all().filter(pk=url["id"]).first()
+    if not db_url:
         return []
 
-    # We still create the temporary file to have dnsrecon handle the meat and bugs with it's threadpool and other stuff
-    log.debug("Creating temporary file from wordlist")
-    with tempfile.NamedTemporaryFile(mode="wt") as tmp_wordlist:
-        for word in wordlist:
-            tmp_wordlist.write("%s\n" % word)
-        tmp_wordlist.flush()  # make sure it's actually written.
-
-        log.debug("The wordlist file is written as %s" % tmp_wordlist.name)
-
-        imported_urls = []
-        for url in urls_without_wildcards:
-            log.info("Wordlist scan on: %s" % url["url"])
-
-            resolver_ip = get_random_nameserver()
-            log.debug("Using the DNS service from %s" % resolver_ip)
-            resolver = DnsHelper(url["url"], resolver_ip, 3)
-            # Using the filter option, only adds the addresses that don't go to the wildcard record.
-            # In the logfile all dns responses are shown, but in the list of really resolving urls only the ones
-            # that deviate from the wildcard IP are stored.
-            found_hosts = brute_domain(
-                resolver, tmp_wordlist.name, url["url"], filter=True, verbose=False, ignore_wildcard=True
-            )
-
-            # some hosts rotate a set of IP's when providing wildcards. This is an annoying practice.
-            # We can filter those out with some statistics. We cut off everything that resolve to the top IP's.
-            log.debug("Found %s hosts" % len(found_hosts))
-            found_hosts = remove_wildcards_using_statistics(found_hosts, url["url"])
+    added = [db_url.add_subdomain(subdomain) for subdomain in subdomains]
+    return [added_url.url for added_url in added if added_url]
 
-            # You cant' know how many where added, since you don't have access to storage.
-            dnsrecon_parse_report_contents.apply_async([url, found_hosts], queue="storage")
 
-    log.debug("Wordlist scan(s) finished.")
+def iterate_batches(batches: AsyncIterator[List[str]]) -> Iterator[List[str]]:
+    """
+    Iterates over the batches of an async generator from synchronous code. The event loop is only running while the
+    next batch is retrieved, so the batches can be handled with blocking code.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(batches.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(batches.aclose())
+        loop.close()
+
+
+async def brute_force_subdomains(
+    domain: str, words: Iterable[str], nameservers: List[str], batch_size: int = FOUND_SUBDOMAINS_BATCH_SIZE
+) -> AsyncIterator[List[str]]:
+    """
+    Resolves every word as a subdomain of the domain, and yields the subdomains that exist in batches. The words are
+    read while resolving, so a wordlist can also be a generator.
 
-    return imported_urls
+    Subdomains that only resolve to the addresses of a wildcard record are skipped. When a domain uses wildcards, the
+    subdomains are yielded at the end of the scan, as addresses of a rotating wildcard record are only known then.
+    """
+    rate_limit = NameserverRateLimit(nameservers, QUERIES_PER_SECOND_PER_NAMESERVER)
 
+    wildcard_addresses = await discover_wildcard_addresses(domain, nameservers, rate_limit)
+    if wildcard_addresses:
+        log.debug("%s has wildcards enabled, pointing to: %s" % (domain, wildcard_addresses))
 
-def remove_wildcards_using_statistics(found_hosts, url: str):
-    # some hosts rotate a set of IP's when providing wildcards. This is an annoying practice.
-    # We can filter those out with some statistics. We cut off everything that resolve to the top IP's.
-    ip_stats = {}
+    address_counts = Counter()
+    found = []
 
-    # if no wildcards are used, then well... just return everything as being fine
-    if not discover_wildcard(url):
-        return found_hosts
+    async def lookup(word: str) -> Tuple[str, Optional[List[str]]]:
+        return word, await resolve_host(f"{word}.{domain}", nameservers, rate_limit)
 
-    # Create a list of how many IP's are used
-    # dnsrecon filters out the first IP, so if there is only one wildcard IP, then that's that.
-    for host in found_hosts:
+    def handle(lookups: Set[asyncio.Task]):
+        for task in lookups:
+            subdomain, addresses = task.result()
+            if not addresses or set(addresses) <= wildcard_addresses:
+                continue
+
+            if wildcard_addresses:
+                address_counts.update(set(addresses))
+            found.append((subdomain, addresses))
 
-        # Points to a A / AAAA record
-        if "address" in host:
-            if host["address"] not in ip_stats:
-                ip_stats[host["address"]] = 1
-            else:
-                ip_stats[host["address"]] += 1
+    pending = set()
+    for word in words:
+        word = word.strip().lower()
+        if not word:
+            continue
 
-        # points to a certain CNAME
-        if "target" in host:
-            if host["target"] not in ip_stats:
-                ip_stats[host["target"]] = 1
-            else:
-                ip_stats[host["target"]] += 1
+        if len(pending) >= MAX_CONCURRENT_LOOKUPS:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            handle(done)
 
-    log.debug("Ip Stats")
-    log.debug(ip_stats)
-    # block IP's that are being used more than 10 times. 10, because i like the number. More than 10 sites on
-    # the same server? perfectly possible. With a firewall it might be infinite.
+        pending.add(asyncio.ensure_future(lookup(word)))
 
-    # does this work with amsterdam?
-    banned_ips = []
-    for key in ip_stats.keys():
-        if ip_stats[key] > 10:
-            banned_ips.append(key)
+        if not wildcard_addresses and len(found) >= batch_size:
+            yield [subdomain for subdomain, addresses in found]
+            found = []
 
-    log.debug("Banned IPS")
-    log.debug(banned_ips)
+    if pending:
+        done, pending = await asyncio.wait(pending)
+        handle(done)
 
-    interesting_found_hosts = []
-    # remove all found hosts that are on the banned IP list:
-    for host in found_hosts:
+    if wildcard_addresses:
+        wildcard_addresses |= {address for address, count in address_counts.items() if count > WILDCARD_THRESHOLD}
+        found = [(subdomain, addresses) for subdomain, addresses in found if not set(addresses) <= wildcard_addresses]
 
-        if "address" in host:
-            if host["address"] not in banned_ips:
-                interesting_found_hosts.append(host)
+    for batch in chunks2(found, batch_size):
+        yield [subdomain for subdomain, addresses in batch]
 
-        if "target" in host:
-            if host["target"] not in banned_ips:
-                interesting_found_hosts.append(host)
 
-    log.debug("Interesting hosts")
-    log.debug(interesting_found_hosts)
+async def discover_wildcard_addresses(
+    domain: str, nameservers: List[str], rate_limit: NameserverRateLimit = None
+) -> Set[str]:
+    """Returns the addresses random subdomains resolve to. An empty set when the domain does not use wildcards."""
+    random_hosts = [
+        "%s.%s" % ("".join(random.choice(string.ascii_lowercase) for i in range(16)), domain)
+        for probe in range(WILDCARD_PROBES)
+    ]
+    addresses = await asyncio.gather(*[resolve_host(host, nameservers, rate_limit) for host in random_hosts])
+    return {address for host_addresses in addresses for address in host_addresses or []}
 
-    return interesting_found_hosts
+
+async def resolve_host(
+    hostname: str, nameservers: List[str], rate_limit: NameserverRateLimit = None
+) -> Optional[List[str]]:
+    """
+    The A records of a host, or the AAAA records when the host has no A records. These are mostly guesses that do not
+    exist, so only hosts that exist are cached.
+    """
+    addresses = await resolve_async(hostname, "A", nameservers, rate_limit, cache_negative=False)
+    if addresses == []:
+        addresses = await resolve_async(hostname, "AAAA", nameservers, rate_limit, cache_negative=False)
+    return addresses
 
 
 def remove_wildcards(urls: List[Url]):
@@ -19,11 +19,12 @@ This scanner will be replaced with the O-Saft scanner when ready.
 API Documentation:
 https://github.com/ssllabs/ssllabs-scan/blob/stable/ssllabs-api-docs.md
 """
+import heapq
 import json
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
-from multiprocessing.pool import ThreadPool
-from time import sleep
+from time import monotonic, sleep
 from typing import List, Any, Dict
 
 import pytz
@@ -37,6 +38,7 @@ from websecmap.organizations.models import Organization, Url
 from websecmap.scanners import plannedscan
 from websecmap.scanners.models import Endpoint, ScanProxy, TlsQualysScratchpad
 from websecmap.scanners.proxy import (
+    MAX_ERROR_RATE,
     claim_proxy,
     release_proxy,
     service_provider_status,
@@ -56,8 +58,8 @@ log = logging.getLogger(__name__)
 
 """
 New architecture:
-- A worker gets a set of 25 objects to scan. Will do so multithreaded,
- - - starting one every minute (or backing off if needed)
+- A worker gets a set of 25 objects to scan over a single proxy. A scheduler starts new scans as soon as Qualys
+  has capacity, and polls all running scans in one loop.
 - A finished scan results in a new task (just like a scrathpad). Whenever the worker is ready all 25 scans are
   completed and the worker is ready to receive more. This is the _FASTEST_ you can ever accomplish without messy
   queue management.
@@ -253,6 +255,7 @@ def compose_planned_scan_task(**kwargs) -> Task:
             currently_used_in_tls_qualys_scan=False,
             manually_disabled=False,
             request_speed_in_ms__gte=1,
+            error_rate__lte=MAX_ERROR_RATE,
             # the upper speed should be configurable. When running N proxy checks at a time theywill be slower.
             # more checks at the same time = slower > 3000ms.
             # request_speed_in_ms__lte=2000,
@@ -301,17 +304,35 @@ def compose_scan_task(urls: List[Url]) -> Task:
     return group(tasks)
 
 
-# It's possible a lot of scans start at the same time. In that case the API does not have a notion of how many scans
-# are running (this takes a while). This results in too many requests and still a lot of errors. To avoid that this
-# method has been rate limited to one per minute per worker. This gives a bit of slack.
+# The scans of a bulk task are started and followed by one scheduler per proxy. A scan (assessment) takes a few minutes.
+# Domains wait in a priority queue until Qualys has capacity to start them, running assessments are polled when they
+# are due. There is no thread per domain and no fixed delay between starting domains: new assessments are started
+# as soon as running ones are finished.
+#
+# Qualys lowers the concurrency limit of clients that start too many assessments, or start them too fast. Therefore
+# a few assessments of the concurrency limit are kept in reserve, some time is kept between starting assessments
+# and errors about capacity slow down the starting of new assessments.
+
+# Seconds between polls of a running assessment.
+POLL_INTERVAL = 30
+
+# Seconds until new assessments are started after an error, increased while errors about capacity keep coming.
+ERROR_INTERVAL = 60
+MAX_ERROR_INTERVAL = 360
+
+# Seconds between starting new assessments.
+NEW_ASSESSMENT_COOL_OFF = 5
+
+# Capacity information is refreshed at least this often when waiting for capacity.
+CAPACITY_INTERVAL = 70
+
+# The amount of assessments below the concurrency limit that is not used.
+CAPACITY_RESERVE = 5
+
+# After this many unexpected errors on a domain, the domain is not scanned anymore in this task.
+MAX_ERRORS_PER_DOMAIN = 10
 
-# Note that this is a per worker instance rate limit, and not a global rate limit.
-# http://docs.celeryproject.org/en/latest/userguide/tasks.html
 
-# scan takes about 30 minutes.
-# 12 / hour = 1 every 5 minutes. In 30 minutes 6 scans will run at the same time. We used to have 10.
-# 20 / hour = 1 every 3 minutes. In 30 minutes 10 scans will run at the same time.
-# 30 / hours = 1 every 2 minutes. In 30 minutes 15 scans will run at the same time.
 @app.task(queue="qualys", acks_late=True)
 def qualys_scan_bulk(proxy: Dict[str, Any], urls: List[str]):
 
@@ -321,35 +342,9 @@ def qualys_scan_bulk(proxy: Dict[str, Any], urls: List[str]):
 
     # Using this all scans stay on the same server (so no ip-hopping between scans, which limits the available
     # capacity severely.
-    # Using this solution still uses parallel scans, while not having to rely on the black-box of redis and celery
-    # that have caused priority shifts. This is much faster and easier to understand.
 
     try:
-        # start one every 60 seconds, a thread can manage itself if too many are running.
-        pool = ThreadPool(25)
-
-        # Even if qualys is down, it will just wait until it knows you can add more... And the retry is infinite
-        # every 30 seconds. So they may be even down for a day and it will continue.
-        for url in urls:
-
-            try:
-                api_results = service_provider_status(proxy)
-                while api_results["max"] < 20 or api_results["this-client-max"] < 20 or api_results["current"] > 19:
-                    log.debug("Running out of capacity, waiting to start new scan.")
-                    sleep(70)
-                    api_results = service_provider_status(proxy)
-
-                pool.apply_async(qualys_scan_thread, [proxy, url])
-                sleep(70)
-
-            except RetryError:
-                log.debug("Retry error. Could not connect to proxy anymore.")
-                store_check_result.apply_async(
-                    [proxy, "Retry error. Proxy died while scanning.", True, datetime.now(pytz.utc)]
-                )
-
-        pool.close()
-        pool.join()
+        QualysScheduler(proxy, urls).run()
 
     except Exception as e:
         # catch _anything_ that goes wrong, log it to the sentry/logfile
@@ -357,91 +352,167 @@ def qualys_scan_bulk(proxy: Dict[str, Any], urls: List[str]):
         log.exception(f"Unexpected crash in qualys bulk scan: {e}")
 
     # return the proxy so it can be closed.
-    # The scan results are created as separate tasks in the scan thread.
+    # The scan results are created as separate tasks in the scheduler.
     return proxy
 
 
-# keeps scanning in a loop until it has the data to fire a
-def qualys_scan_thread(proxy: Dict[str, Any], url: str):
+class QualysScheduler:
+    """
+    Scans domains over a single proxy. Domains that wait to be started are in a priority queue: the order in which
+    they were received. Domains that could not be started because of an error keep their place in front of the queue.
+    Running assessments are in a timer queue, ordered by the moment they should be polled again.
+
+    All waiting is done in one place, until the next assessment should be polled or a new one can be started.
+    """
+
+    def __init__(self, proxy: Dict[str, Any], urls: List[str]):
+        self.proxy = proxy
+
+        # (place in line, url)
+        self.pending = [(place, url) for place, url in enumerate(urls)]
+        heapq.heapify(self.pending)
+        self.places = {url: place for place, url in self.pending}
+
+        # (moment of next poll, url)
+        self.running = []
+
+        self.errors = defaultdict(int)
+        self.error_interval = ERROR_INTERVAL
+        self.next_start = 0.0
+
+        self.max_assessments = 0
+        self.current_assessments = 0
+        self.capacity_checked = None
+
+    def run(self):
+        while self.pending or self.running:
+            now = monotonic()
+
+            while self.running and self.running[0][0] <= now:
+                due, url = heapq.heappop(self.running)
+                self.poll(url)
+
+            if self.pending and monotonic() >= self.next_start:
+                if self.capacity_is_outdated():
+                    try:
+                        self.update_capacity(service_provider_status(self.proxy))
+                    except RetryError:
+                        log.debug("Retry error. Could not connect to proxy anymore.")
+                        store_check_result.apply_async(
+                            [self.proxy, "Retry error. Proxy died while scanning.", True, datetime.now(pytz.utc)]
+                        )
+                        return
+
+                if self.has_capacity():
+                    place, url = heapq.heappop(self.pending)
+                    log.debug(f"Starting qualys scan on {url}.")
+                    self.next_start = monotonic() + NEW_ASSESSMENT_COOL_OFF
+                    self.poll(url)
+                else:
+                    log.debug("Running out of capacity, waiting to start new scan.")
+
+            sleep(max(0.0, self.next_moment() - monotonic()))
 
-    normal_waiting_time = 30
-    error_waiting_time = 60  # seconds until retry, can be increased when queues are full. Max = 180
-    max_waiting_time = 360
+    def next_moment(self) -> float:
+        moments = []
+        if self.running:
+            moments.append(self.running[0][0])
+        if self.pending:
+            if self.capacity_checked is None or self.has_capacity():
+                moments.append(self.next_start)
+            else:
+                moments.append(max(self.next_start, self.capacity_checked + CAPACITY_INTERVAL))
+        return min(moments, default=monotonic())
+
+    def capacity_is_outdated(self) -> bool:
+        return self.capacity_checked is None or monotonic() - self.capacity_checked >= CAPACITY_INTERVAL
+
+    def update_capacity(self, api_result: Dict[str, Any]):
+        self.max_assessments = min(api_result["max"], api_result["this-client-max"])
+        self.current_assessments = api_result["current"]
+        self.capacity_checked = monotonic()
 
-    data = {}
+    def has_capacity(self) -> bool:
+        # The capacity headers have been removed from the API responses, then defaults are returned. So the assessments
+        # that are started by this scheduler are also counted.
+        running = max(self.current_assessments, len(self.running))
+        return running < self.max_assessments - CAPACITY_RESERVE
 
-    while True:
+    def poll(self, url: str):
         try:
-            api_result = service_provider_scan_via_api_with_limits(proxy, url)
-            data = api_result["data"]
-        except requests.RequestException:
+            api_result = service_provider_scan_via_api_with_limits(self.proxy, url)
+        except (requests.RequestException, ValueError):
             # ex: ('Connection aborted.', ConnectionResetError(54, 'Connection reset by peer'))
             # ex: EOF occurred in violation of protocol (_ssl.c:749)
+            # ex: a proxy returns an html error page, which is not json.
             log.exception(f"(Network or Server) Error when contacting Qualys for scan on {url}.")
-            sleep(60)
-            # continue
+            self.retry(url)
+            return
+
+        self.update_capacity(api_result)
+        data = api_result["data"]
 
         # Store debug data in database (this task has no direct DB access due to scanners queue).
         scratch.apply_async([url, data])
         # Always log to console. Don't ask the database (constance) if this should happen.
         report_to_console(url, data)
 
-        # Qualys is already running a scan on this url
-        if "status" in data:
-            # Qualys has completed the scan of the url and has a result.
-            if data["status"] in ["READY", "ERROR"]:
-                # scan completed
-                # store the result on the storage queue.
-                log.debug(f"Qualys scan finished on {url}.")
-                process_qualys_result.apply_async([data, url])
-                return True
-            else:
-                log.debug(
-                    f"Scan on {url} has not yet finished. " f"Waiting {normal_waiting_time} seconds before next update."
-                )
-                sleep(normal_waiting_time)
-                # Don't break out of the loop...
-                # continue
-
         # The API is in error state, let's see if we can be nice and recover.
         if "errors" in data:
-            error_message = data["errors"][0]["message"]
-            # {'errors': [{'message': 'Running at full capacity. Please try again later.'}], 'status': 'FAILURE'}
-            # Don't increase the amount of waiting time yet... try again in a minute.
-            if error_message == "Running at full capacity. Please try again later.":
-                # this happens all the time, so don't raise an exception but just make a log message.
-                log.info(f"Error occurred while scanning {url}: qualys is at full capacity, trying later.")
-                sleep(error_waiting_time)
-                # Don't break out of the loop...
-                # continue
-
-            # We're going too fast with new assessments. Back off.
-            if error_message.startswith("Concurrent assessment limit reached"):
-                log.error(
-                    f"Too many concurrent assessments: Are you running multiple scans from the same IP? "
-                    f"Concurrent scans slowly lower the concurrency limit of 25 concurrent scans to zero. "
-                    f"Slow down. {data['errors'][0]['message']}"
-                )
-                if error_waiting_time < max_waiting_time:
-                    error_waiting_time += 60
-                    sleep(error_waiting_time)
-                    # continue
-
-            if error_message.startswith("Too many concurrent assessments"):
-                log.info(f"Error occurred while scanning {url}: Too many concurrent assessments.")
-                if error_waiting_time < max_waiting_time:
-                    error_waiting_time += 60
-                    sleep(error_waiting_time)
-                    # continue
-
-            # All other situations that we did not foresee...
-            log.error("Unexpected error from API on %s: %s", url, str(data))
-
-        # This is an undefined state.
-        # scan started without errors. It's probably pending. Reset the waiting time to 60 seconds again as we
-        # we want to get the result asap.
-        log.debug(f"Got to an undefined state on qualys scan on {url}. Scan has not finished, and we're retrying.")
-        sleep(error_waiting_time)
+            self.handle_errors(url, data)
+            return
+
+        if "status" not in data:
+            log.error("Undefined state from API on %s: %s", url, str(data))
+            self.retry(url)
+            return
+
+        self.error_interval = ERROR_INTERVAL
+
+        # Qualys has completed the scan of the url and has a result.
+        if data["status"] in ["READY", "ERROR"]:
+            # store the result on the storage queue.
+            log.debug(f"Qualys scan finished on {url}.")
+            process_qualys_result.apply_async([data, url])
+            return
+
+        log.debug(f"Scan on {url} has not yet finished. Waiting {POLL_INTERVAL} seconds before next update.")
+        heapq.heappush(self.running, (monotonic() + POLL_INTERVAL, url))
+
+    def handle_errors(self, url: str, data: Dict[str, Any]):
+        error_message = data["errors"][0]["message"]
+
+        # {'errors': [{'message': 'Running at full capacity. Please try again later.'}], 'status': 'FAILURE'}
+        # Don't increase the amount of waiting time yet... try again in a minute.
+        if error_message == "Running at full capacity. Please try again later.":
+            # this happens all the time, so don't raise an exception but just make a log message.
+            log.info(f"Error occurred while scanning {url}: qualys is at full capacity, trying later.")
+            self.retry(url, count_error=False)
+            return
+
+        # We're going too fast with new assessments. Back off.
+        if error_message.startswith("Concurrent assessment limit reached") or error_message.startswith(
+            "Too many concurrent assessments"
+        ):
+            log.info(f"Error occurred while scanning {url}: {error_message}. Slowing down.")
+            self.error_interval = min(self.error_interval + 60, MAX_ERROR_INTERVAL)
+            self.retry(url, count_error=False)
+            return
+
+        # All other situations that we did not foresee...
+        log.error("Unexpected error from API on %s: %s", url, str(data))
+        self.retry(url)
+
+    def retry(self, url: str, count_error: bool = True):
+        """The assessment was not started, or its state is unknown: wait a while and start it again."""
+        if count_error:
+            self.errors[url] += 1
+            if self.errors[url] >= MAX_ERRORS_PER_DOMAIN:
+                log.error(f"Giving up qualys scan on {url} after {self.errors[url]} errors.")
+                return
+
+        heapq.heappush(self.pending, (self.places[url], url))
+        self.next_start = max(self.next_start, monotonic() + self.error_interval)
 
 
 @app.task(queue="storage")
@@ -494,7 +565,7 @@ def report_to_console(domain: str, data: Dict[str, Any]):
     if status in ["DNS", "ERROR"]:
         log.debug("%s %s: Got message: %s", domain, data["status"], data.get("statusMessage", "unknown"))
 
-    if data["status"] == "IN_PROGRESS":
+    if status == "IN_PROGRESS":
         for endpoint in data["endpoints"]:
             log.debug("%s, ep: %s. status: %s" % (domain, endpoint["ipAddress"], endpoint.get("statusMessage", "0")))
 
@@ -3,6 +3,7 @@ import pytest
 
 from websecmap.organizations.models import Organization, Url
 from websecmap.scanners.models import Endpoint
+from websecmap.scanners.scanmanager import scans_created
 
 
 @pytest.fixture
@@ -24,3 +25,9 @@ def faaloniae():
         "url": url,
         "endpoint": endpoint,
     }
+
+
+@pytest.fixture
+def without_scan_receivers(monkeypatch):
+    """Stores scans without informing other apps, such as the scores of contests, so only storing is measured."""
+    monkeypatch.setattr(scans_created, "receivers", [])
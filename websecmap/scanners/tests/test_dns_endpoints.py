@@ -0,0 +1,60 @@
+import asyncio
+
+from dns.resolver import NoAnswer
+
+from websecmap.scanners.models import Endpoint
+from websecmap.scanners.scanner.dns_endpoints import probe_dns_endpoints_async, store_dns_endpoints
+from websecmap.scanners.tests.test_plannedscan import create_endpoint, create_url
+from websecmap.scanners.tests.test_resolver import fake_dns
+
+
+def test_probe_dns_endpoints(monkeypatch):
+    queries = fake_dns(
+        monkeypatch,
+        {
+            ("example.com", "SOA"): ["ns.example.com. hostmaster.example.com. 1 2 3 4 5"],
+            ("example.com", "CNAME"): NoAnswer(),
+            ("example.com", "MX"): ["10 mx.example.com."],
+            ("example.com", "A"): ["93.184.216.34"],
+            ("example.com", "AAAA"): NoAnswer(),
+            ("www.example.com", "SOA"): NoAnswer(),
+            ("www.example.com", "CNAME"): ["example.com."],
+            ("www.example.com", "MX"): ["10 mx.example.com."],
+            ("www.example.com", "A"): ["93.184.216.34"],
+            ("www.example.com", "AAAA"): NoAnswer(),
+        },
+    )
+
+    results = asyncio.run(
+        probe_dns_endpoints_async(
+            [(1, "example.com"), (2, "www.example.com"), (3, "nonexisting.example.com")],
+            ["127.0.0.1", "127.0.0.2"],
+            1000,
+        )
+    )
+
+    assert results == [
+        {"url_id": 1, "url": "example.com", "dns_soa": True, "dns_mx_no_cname": True, "dns_a_aaaa": True},
+        # a www cname has the mx records of the domain it points to.
+        {"url_id": 2, "url": "www.example.com", "dns_soa": True, "dns_mx_no_cname": False, "dns_a_aaaa": True},
+        {
+            "url_id": 3,
+            "url": "nonexisting.example.com",
+            "dns_soa": False,
+            "dns_mx_no_cname": False,
+            "dns_a_aaaa": False,
+        },
+    ]
+    assert len(queries) == 15
+
+
+def test_store_dns_endpoints(db):
+    url = create_url("example.com")
+    create_endpoint(url, 0, "dns_mx_no_cname", 0)
+
+    store_dns_endpoints([{"url_id": url.id, "dns_soa": True, "dns_mx_no_cname": False, "dns_a_aaaa": True}])
+
+    assert sorted(Endpoint.objects.all().filter(is_dead=False).values_list("protocol", flat=True)) == [
+        "dns_a_aaaa",
+        "dns_soa",
+    ]
@@ -1,6 +1,20 @@
 """Testing parsing of dnssec scanner output."""
+import asyncio
+import base64
+import struct
 
-from websecmap.scanners.scanner.dnssec import analyze_result
+import dns.dnssec
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdata
+import dns.rdatatype
+import dns.rrset
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+from websecmap.scanners.scanner import dnssec
+from websecmap.scanners.scanner.dnssec import analyze_result, validate_domains
 
 
 def test_analyze_result():
@@ -133,3 +147,117 @@ def test_analyze_result():
     level, relevant = analyze_result(result)
 
     assert level == "WARNING"
+
+
+class SignedZones:
+    """A root zone, nl. and a number of domains in nl. that are signed with Ed25519 keys."""
+
+    def __init__(self):
+        self.records = {}
+        self.keys = {}
+
+    def add_zone(self, zone: str, parent: str = None, publish_ds: bool = True):
+        private_key = Ed25519PrivateKey.generate()
+        public_key = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        dnskey = dns.rrset.from_text(zone, 3600, "IN", "DNSKEY", f"257 3 15 {base64.b64encode(public_key).decode()}")
+        self.keys[zone] = (private_key, dnskey)
+
+        self.add(zone, dnskey, zone)
+        soa = f"ns.{zone} hostmaster.{zone} 1 2 3 4 5".replace("..", ".")
+        self.add(zone, dns.rrset.from_text(zone, 3600, "IN", "SOA", soa), zone)
+        if parent and publish_ds:
+            ds = dns.rrset.from_text(zone, 3600, "IN", "DS", dns.dnssec.make_ds(zone, dnskey[0], "SHA256").to_text())
+            self.add(zone, ds, parent)
+        return dnskey
+
+    def add(self, name: str, rrset, signer: str):
+        private_key, dnskey = self.keys[signer]
+        signer_name = dns.name.from_text(signer)
+        rrsig = dns.rdata.from_text(
+            "IN",
+            "RRSIG",
+            f"{dns.rdatatype.to_text(rrset.rdtype)} 15 {len(rrset.name) - 1} {rrset.ttl} 20300101000000 "
+            f"20200101000000 {dns.dnssec.key_id(dnskey[0])} {signer} AAAA",
+        )
+        data = rrsig.to_wire()[:18] + signer_name.to_digestable()
+        for record in sorted(rrset):
+            record_data = record.to_digestable()
+            data += rrset.name.to_digestable() + struct.pack("!HHI", rrset.rdtype, rrset.rdclass, rrset.ttl)
+            data += struct.pack("!H", len(record_data)) + record_data
+        rrsig = rrsig.replace(signature=private_key.sign(data))
+
+        self.records[(dns.name.from_text(name), rrset.rdtype)] = (
+            rrset,
+            dns.rrset.from_rdata_list(rrset.name, rrset.ttl, [rrsig]),
+        )
+
+    async def query(self, name: dns.name.Name, rdtype, nameservers):
+        response = dns.message.make_response(dns.message.make_query(name, rdtype))
+        if (name, rdtype) in self.records:
+            response.answer += list(self.records[(name, rdtype)])
+            return response
+
+        # the SOA of the zone this name is in, in the authority section.
+        zone = name
+        while (zone, dns.rdatatype.SOA) not in self.records:
+            zone = zone.parent()
+        response.authority += list(self.records[(zone, dns.rdatatype.SOA)])
+        if not any(record_name == name for record_name, record_type in self.records):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(dns.rrset.from_text(zone, 3600, "IN", "NSEC", f"{zone} SOA RRSIG NSEC DNSKEY"))
+        return response
+
+
+def test_validate_domains(monkeypatch):
+    zones = SignedZones()
+    root_key = zones.add_zone(".")
+    zones.add_zone("nl.", ".")
+    zones.add_zone("secure.nl.", "nl.")
+    zones.add_zone("missingds.nl.", "nl.", publish_ds=False)
+    # the DS at the parent refers to a key that has been replaced.
+    zones.add_zone("wrongds.nl.", "nl.")
+    zones.add_zone("wrongds.nl.", "nl.", publish_ds=False)
+    zones.records[(dns.name.from_text("unsigned.nl."), dns.rdatatype.SOA)] = (
+        dns.rrset.from_text("unsigned.nl.", 3600, "IN", "SOA", "ns.unsigned.nl. hostmaster.unsigned.nl. 1 2 3 4 5"),
+    )
+
+    monkeypatch.setattr(dnssec, "query", zones.query)
+    monkeypatch.setattr(dnssec, "ROOT_TRUST_ANCHORS", [dns.dnssec.make_ds(".", root_key[0], "SHA256").to_text()])
+    dnssec.zone_keys_cache.clear()
+
+    results = asyncio.run(validate_domains(["secure.nl", "missingds.nl", "wrongds.nl", "unsigned.nl"], ["127.0.0.1"]))
+    levels = [analyze_result(result)[0] for result in results]
+    assert levels == ["INFO", "INFO", "ERROR", "ERROR"]
+
+    secure = [line.split(": ", 1)[1] for line in results[0]]
+    assert "INFO Enough valid signatures over SOA RRset found for secure.nl." in secure
+    assert "INFO Authenticated denial records found for secure.nl, of type NSEC." in secure
+    assert "INFO DS RRset of secure.nl is signed by a trusted key of nl." in secure
+    assert "WARNING [DNSSEC:MISSING_DS] missingds.nl" in [line.split(": ", 1)[1] for line in results[1]]
+
+    # the keys of nl. and the root are validated once and cached.
+    assert sorted(zone.to_text() for zone in dnssec.zone_keys_cache) == [".", "nl."]
+
+
+def test_validate_domains_timeout(monkeypatch):
+    zones = SignedZones()
+    root_key = zones.add_zone(".")
+    zones.add_zone("nl.", ".")
+    zones.add_zone("first.nl.", "nl.")
+    zones.add_zone("second.nl.", "nl.")
+
+    async def slow_query(name, rdtype, nameservers):
+        if name == dns.name.from_text("nl.") and rdtype == dns.rdatatype.DNSKEY:
+            await asyncio.sleep(0.5)
+        return await zones.query(name, rdtype, nameservers)
+
+    monkeypatch.setattr(dnssec, "query", slow_query)
+    monkeypatch.setattr(dnssec, "ROOT_TRUST_ANCHORS", [dns.dnssec.make_ds(".", root_key[0], "SHA256").to_text()])
+    monkeypatch.setattr(dnssec, "DOMAIN_TIMEOUT", 0.3)
+    # the second domain starts when the first times out, and then waits for the validation of nl. that is running.
+    monkeypatch.setattr(dnssec, "MAX_CONCURRENT_VALIDATIONS", 1)
+    dnssec.zone_keys_cache.clear()
+
+    first, second = asyncio.run(validate_domains(["first.nl", "second.nl"], ["127.0.0.1"]))
+    assert first is None
+    assert "INFO DS RRset of second.nl is signed by a trusted key of nl." in [line.split(": ", 1)[1] for line in second]
@@ -0,0 +1,78 @@
+import asyncio
+
+from websecmap.scanners.models import Endpoint
+from websecmap.scanners.scanner import http
+from websecmap.scanners.scanner.http import probe, store_discovered_endpoints
+from websecmap.scanners.tests.test_plannedscan import create_endpoint, create_url
+
+
+def test_probe():
+    async def probe_local_server():
+        async def respond(reader, writer):
+            await reader.readline()
+            writer.write(b"HTTP/1.1 200 OK\r\n\r\n")
+            await writer.drain()
+            writer.close()
+
+        async def hang_up(reader, writer):
+            writer.close()
+
+        server = await asyncio.start_server(respond, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        silent_server = await asyncio.start_server(hang_up, "127.0.0.1", 0)
+        silent_port = silent_server.sockets[0].getsockname()[1]
+        semaphore = asyncio.Semaphore(2)
+        # the url is also tried directly, localhost is the same server.
+        async with server, silent_server:
+            return await asyncio.gather(
+                probe(semaphore, "http", "localhost", "127.0.0.1", port),
+                # a plain http server answers the tls handshake, which is a wrong version number: not https.
+                probe(semaphore, "https", "localhost", "127.0.0.1", port),
+                # the connection is closed without any response.
+                probe(semaphore, "http", "localhost", "127.0.0.1", silent_port),
+            )
+
+    assert asyncio.run(probe_local_server()) == [True, False, False]
+
+    async def probe_closed_port():
+        # nothing is listening on port 1.
+        return await probe(asyncio.Semaphore(1), "http", "localhost", "127.0.0.1", 1)
+
+    assert asyncio.run(probe_closed_port()) is False
+
+
+def test_probe_host_fallback(monkeypatch):
+    attempts = []
+
+    async def probe_host(protocol, url, host, port, family=0):
+        attempts.append(host)
+        # the ip refuses connections with another host, the url itself responds.
+        return True if host == url else None
+
+    async def probe_firewalled_server():
+        return await http.probe(asyncio.Semaphore(1), "https", "example.com", "192.0.2.1", 443)
+
+    monkeypatch.setattr(http, "probe_host", probe_host)
+    assert asyncio.run(probe_firewalled_server()) is True
+    assert attempts == ["192.0.2.1", "example.com"]
+
+
+def test_store_discovered_endpoints(db, django_assert_num_queries):
+    url = create_url("example.com")
+    alive = create_endpoint(url, 4, "https", 443)
+    gone = create_endpoint(url, 4, "http", 80)
+
+    with django_assert_num_queries(5):
+        store_discovered_endpoints(
+            [
+                (url.id, "https", 443, 4, True),
+                (url.id, "http", 80, 4, False),
+                (url.id, "https", 8443, 4, True),
+                (url.id, "http", 8080, 4, False),
+            ]
+        )
+
+    endpoints = Endpoint.objects.all().filter(is_dead=False)
+    assert sorted((endpoint.protocol, endpoint.port) for endpoint in endpoints) == [("https", 443), ("https", 8443)]
+    assert Endpoint.objects.all().get(id=alive.id).is_dead is False
+    assert Endpoint.objects.all().get(id=gone.id).is_dead is True
@@ -0,0 +1,32 @@
+from websecmap.scanners import http_pool
+from websecmap.scanners.http_pool import clear_sessions, pooled_session
+
+
+def test_pooled_session(monkeypatch):
+    clear_sessions()
+    monkeypatch.setattr(http_pool, "MAX_SESSIONS", 2)
+
+    with pooled_session("example.com", 4) as first:
+        pass
+
+    # the same host and network reuses the session, hostnames are case insensitive.
+    with pooled_session("EXAMPLE.com", 4) as session:
+        assert session is first
+
+    # other networks have their own connections.
+    with pooled_session("example.com", 6) as session:
+        assert session is not first
+
+    # the least recently used session is dropped.
+    with pooled_session("example.nl", 4):
+        pass
+    assert list(http_pool.sessions) == [("example.com", 6), ("example.nl", 4)]
+
+    with pooled_session("example.com", 4) as session:
+        assert session is not first
+
+    # cookies are never stored.
+    assert session.cookies.get_policy().is_not_allowed("example.com")
+
+    clear_sessions()
+    assert not http_pool.sessions
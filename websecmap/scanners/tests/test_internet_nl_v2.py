@@ -1,3 +1,4 @@
+import json
 import logging
 from copy import copy
 from datetime import datetime, timedelta
@@ -6,6 +7,7 @@ from websecmap.organizations.models import Url
 from websecmap.reporting.report import create_timeline, create_url_report
 from websecmap.scanners.models import Endpoint, EndpointGenericScan, InternetNLV2Scan, InternetNLV2StateLog
 from websecmap.scanners.scanmanager import store_endpoint_scan_result
+from websecmap.scanners.scanner import internet_nl_v2_websecmap
 from websecmap.scanners.scanner.internet_nl_v2_websecmap import (
     add_calculation,
     calculate_forum_standaardisatie_views_mail,
@@ -13,6 +15,11 @@ from websecmap.scanners.scanner.internet_nl_v2_websecmap import (
     initialize_scan,
     lowest_value_in_results,
     process_scan_results,
+    process_scan_results_batch,
+    processing_scan_results,
+    scan_report_batch,
+    serialize_scan_report,
+    store_scan_results,
     progress_running_scan,
     update_state,
     reuse_last_fields_and_set_them_to_error,
@@ -950,3 +957,105 @@ def test_legacy_calculations():
     assert lowest_value_in_results(data, ["web_https_http_available"]) == "error"
 
     assert data["results"]["calculated_results"]["web_legacy_tls_available"]["status"] == "error"
+
+
+def test_process_scan_results_in_batches(db, monkeypatch):
+    def domain_result(percentage):
+        return {
+            "status": "ok",
+            "report": {"url": "https://batch.internet.nl/mail/example.nl/1/"},
+            "scoring": {"percentage": percentage},
+            "results": {
+                "categories": {"mail_ipv6": {"verdict": "passed", "status": "passed"}},
+                "tests": {"mail_ipv6_ns_address": {"status": "passed", "verdict": "good"}},
+                "custom": {},
+            },
+        }
+
+    endpoints = {}
+    for domain in ["example.nl", "example.com", "broken.example.nl"]:
+        url = Url.objects.create(url=domain)
+        endpoints[domain] = Endpoint.objects.create(url=url, protocol="dns_mx_no_cname", port=0, ip_version=4)
+
+    store_endpoint_scan_result("internet_nl_mail_ipv6", endpoints["broken.example.nl"].pk, "passed", "")
+
+    domains = {
+        "example.nl": domain_result(100),
+        "example.com": domain_result(80),
+        "broken.example.nl": {"status": "error"},
+        # there is no endpoint for this domain, it is skipped.
+        "unknown.example.nl": domain_result(100),
+    }
+    report, batches = serialize_scan_report(domains.items(), batch_size=3)
+    assert json.loads(report) == domains
+    scan = InternetNLV2Scan.objects.create(
+        type="mail", retrieved_scan_report=domains, retrieved_scan_report_batches=batches
+    )
+
+    tasks = processing_scan_results(scan.pk)
+    assert [task.args for task in tasks.tasks] == [(scan.pk, *batches[0]), (scan.pk, *batches[1]), (scan.pk,)]
+
+    # a batch only reads the scan data of its own domains.
+    assert scan_report_batch(scan.pk, *batches[1]) == {"unknown.example.nl": domain_result(100)}
+
+    process_scan_results_batch(scan.pk, *batches[0])
+    process_scan_results_batch(scan.pk, *batches[1])
+
+    # score, category and test per domain.
+    assert EndpointGenericScan.objects.filter(endpoint=endpoints["example.nl"]).count() == 3
+    assert (
+        EndpointGenericScan.objects.get(type="internet_nl_mail_overall_score", endpoint=endpoints["example.com"]).rating
+        == "80"
+    )
+    # the existing result of the domain with an error is replaced with an error.
+    assert (
+        EndpointGenericScan.objects.get(endpoint=endpoints["broken.example.nl"], is_the_latest_scan=True).rating
+        == "error"
+    )
+
+    # storing the same results again only updates the scan moment.
+    process_scan_results(scan.pk)
+    assert EndpointGenericScan.objects.count() == 3 + 3 + 2
+    assert InternetNLV2Scan.objects.get(pk=scan.pk).state == "finished"
+
+    # reports that are stored without batches are processed in a single task.
+    InternetNLV2Scan.objects.filter(pk=scan.pk).update(retrieved_scan_report_batches=None)
+    assert [task.args for task in processing_scan_results(scan.pk).tasks] == [(scan.pk,)]
+
+
+def test_store_scan_results(db, monkeypatch):
+    domains = {
+        "example.nl": {"status": "ok", "scoring": {"percentage": 99.5}},
+        "example.com": {"status": "error"},
+        "ëxample.nl": {"status": "ok", "scoring": {"percentage": 50}},
+    }
+
+    def stream_result(scan_id, settings, destination):
+        assert scan_id == "1"
+        for part in json.dumps({"request": {"api_version": "2.0"}, "domains": domains}).encode():
+            destination.write(bytes([part]))
+        return 200, {}
+
+    monkeypatch.setattr(internet_nl_v2_websecmap, "stream_result", stream_result)
+
+    scan = InternetNLV2Scan.objects.create(type="mail", scan_id="1", state="storing scan results")
+    store_scan_results(scan.pk)
+
+    scan = InternetNLV2Scan.objects.get(pk=scan.pk)
+    assert scan.state == "scan results stored"
+    assert scan.metadata == {"api_version": "2.0"}
+    assert scan.retrieved_scan_report == domains
+    # the batches are read separately.
+    monkeypatch.setattr(internet_nl_v2_websecmap, "PROCESSING_BATCH_SIZE", 2)
+    store_scan_results(scan.pk)
+    batches = InternetNLV2Scan.objects.get(pk=scan.pk).retrieved_scan_report_batches
+    assert [scan_report_batch(scan.pk, *batch) for batch in batches] == [
+        {"example.nl": domains["example.nl"], "example.com": domains["example.com"]},
+        {"ëxample.nl": domains["ëxample.nl"]},
+    ]
+
+    # network errors can be retried.
+    monkeypatch.setattr(internet_nl_v2_websecmap, "stream_result", lambda *args: (599, {"network_error": "timeout"}))
+    store_scan_results(scan.pk)
+    assert InternetNLV2Scan.objects.get(pk=scan.pk).state == "network_error"
+    assert InternetNLV2Scan.objects.get(pk=scan.pk).retrieved_scan_report == domains
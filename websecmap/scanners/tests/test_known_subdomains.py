@@ -1,7 +1,18 @@
 from websecmap.organizations.models import Url, Organization
+from websecmap.scanners import resolver
+from websecmap.scanners.scanner import subdomains
 from websecmap.scanners.scanner.dns_known_subdomains import compose_discover_task
-from websecmap.scanners.scanner.subdomains import get_subdomains, get_popular_subdomains
+from websecmap.scanners.scanner.subdomains import (
+    brute_force_subdomains,
+    get_subdomains,
+    get_popular_subdomains,
+    wordlist_scan,
+)
+from websecmap.scanners.tests.test_resolver import fake_dns
 from celery import group
+from dns.resolver import NoAnswer
+import asyncio
+import itertools
 import logging
 
 log = logging.getLogger(__package__)
@@ -69,3 +80,70 @@ def test_get_subdomains(db):
     #     f"{wasssw}([{{'id': 8, 'url': 'second.mydomain.com'}}], ['example', 'first', 'second', 'test']) "
     #     f"| {wspf}('discover', 'dns_known_subdomains', 8)])"
     # )
+
+
+class WildcardZone(dict):
+    """Answers for every subdomain of wildcard.example, next to the records in the zone."""
+
+    def __init__(self, records, wildcard_addresses):
+        super().__init__(records)
+        self.wildcard_addresses = itertools.cycle(wildcard_addresses)
+
+    def __contains__(self, key):
+        return super().__contains__(key) or (key[0].endswith(".wildcard.example") and key[1] == "A")
+
+    def __getitem__(self, key):
+        if super().__contains__(key):
+            return super().__getitem__(key)
+        # a rotating wildcard record.
+        return [next(self.wildcard_addresses)]
+
+
+def brute_force(domain, words, batch_size=2):
+    async def all_batches():
+        return [batch async for batch in brute_force_subdomains(domain, words, ["127.0.0.1"], batch_size)]
+
+    return asyncio.run(all_batches())
+
+
+def test_brute_force_subdomains(monkeypatch):
+    rotating = ["192.0.2.%s" % number for number in range(5)]
+    records = {
+        ("www.example.com", "A"): ["93.184.216.34"],
+        ("mail.example.com", "A"): ["93.184.216.35"],
+        ("vpn.example.com", "A"): NoAnswer(),
+        ("vpn.example.com", "AAAA"): ["2001:db8::1"],
+        ("www.wildcard.example", "A"): ["93.184.216.34"],
+    }
+    fake_dns(monkeypatch, WildcardZone(records, rotating))
+
+    words = ["www", "mail", "", "vpn", "nonexisting"]
+    batches = brute_force("example.com", (word for word in words))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert sorted(sum(batches, [])) == ["mail", "vpn", "www"]
+
+    # only subdomains that exist are cached, not the guesses.
+    assert sorted(resolver.cache) == [("mail.example.com", "A"), ("vpn.example.com", "AAAA"), ("www.example.com", "A")]
+
+    # subdomains that only resolve to the (rotating) wildcard addresses are not found.
+    words = ["www"] + ["word%s" % number for number in range(100)]
+    assert brute_force("wildcard.example", words, batch_size=50) == [["www"]]
+
+
+def test_wordlist_scan(db, monkeypatch):
+    fake_dns(monkeypatch, {("www.example.com", "A"): ["93.184.216.34"]})
+    monkeypatch.setattr(subdomains, "get_nameservers", lambda: ["127.0.0.1"])
+    monkeypatch.setattr(
+        subdomains.add_subdomains, "apply_async", lambda args, **kwargs: subdomains.add_subdomains(*args)
+    )
+
+    organization = Organization.objects.all().create(name="1", country="NL")
+    url = Url.objects.all().create(url="example.com")
+    url.organization.add(organization)
+
+    wordlist_scan([url.as_dict()], ["www", "mail"])
+
+    assert list(Url.objects.all().filter(organization=organization).values_list("url", flat=True).order_by("url")) == [
+        "example.com",
+        "www.example.com",
+    ]
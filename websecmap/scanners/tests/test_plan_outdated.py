@@ -2,14 +2,20 @@ from datetime import datetime, timedelta
 
 import pytz
 
-from websecmap.map.models import Configuration, OrganizationReport
+from websecmap.map.models import Configuration
 from websecmap.organizations.models import OrganizationType
 from websecmap.scanners.models import PlannedScan
-from websecmap.scanners.plannedscan import plan_outdated_scans
-from websecmap.scanners.tests.test_plannedscan import create_organization, create_url, link_url_to_organization
+from websecmap.scanners.plannedscan import list_outdated, plan_outdated_scans
+from websecmap.scanners.tests.test_plannedscan import (
+    create_endpoint,
+    create_endpoint_scan,
+    create_organization,
+    create_url,
+    link_url_to_organization,
+)
 
 
-def test_plan_outdated_scans(db):
+def test_plan_outdated_scans(db, capsys):
     o = create_organization("Test")
     u1 = create_url("example.com")
     link_url_to_organization(u1, o)
@@ -34,53 +40,19 @@ def test_plan_outdated_scans(db):
     m.is_reported = True
     m.save()
 
-    example_report = {
-        "organization": {
-            "urls": [
-                {
-                    "url": "example.com",
-                    "ratings": [],
-                    "endpoints": [
-                        {
-                            "ratings": [
-                                {
-                                    "type": "http_security_header_strict_transport_security",
-                                    "since": "2010-08-05T18:57:53.873815+00:00",
-                                    "last_scan": "2010-08-07T14:34:56.917953+00:00",
-                                    "scan_type": "http_security_header_strict_transport_security",
-                                },
-                                {
-                                    "type": "http_security_header_x_frame_options",
-                                    "since": "2010-08-05T18:57:53.856580+00:00",
-                                    "last_scan": "2010-08-07T14:34:56.898717+00:00",
-                                    "scan_type": "http_security_header_x_frame_options",
-                                },
-                                {
-                                    "type": "http_security_header_x_content_type_options",
-                                    "since": "2010-08-05T18:57:53.864561+00:00",
-                                    "last_scan": "2010-08-07T14:34:56.907224+00:00",
-                                    "scan_type": "http_security_header_x_content_type_options",
-                                },
-                                {
-                                    "type": "http_security_header_x_xss_protection",
-                                    "since": "2020-08-05T18:57:53.845210+00:00",
-                                    "last_scan": "2020-08-07T14:34:56.881692+00:00",
-                                    "scan_type": "http_security_header_x_xss_protection",
-                                },
-                            ],
-                        }
-                    ],
-                }
-            ],
-        }
-    }
-    r = OrganizationReport()
-    r.calculation = example_report
-    r.organization = o
-    r.at_when = datetime.now(pytz.utc) - timedelta(days=100)
-    r.save()
-
-    assert len(r.calculation["organization"]) == 1
+    # The latest scans on the endpoint of example.com, some of these are outdated. The second url only has an
+    # outdated scan on a dead endpoint, which is not planned.
+    long_ago = datetime.now(pytz.utc) - timedelta(days=100)
+    recently = datetime.now(pytz.utc) - timedelta(hours=1)
+    e1 = create_endpoint(u1, 4, "https", 443)
+    create_endpoint_scan(e1, "http_security_header_strict_transport_security", "False", long_ago)
+    create_endpoint_scan(e1, "http_security_header_x_frame_options", "False", long_ago)
+    create_endpoint_scan(e1, "http_security_header_x_content_type_options", "False", long_ago)
+    create_endpoint_scan(e1, "http_security_header_x_xss_protection", "False", recently)
+    e2 = create_endpoint(u2, 4, "https", 443)
+    e2.is_dead = True
+    e2.save()
+    create_endpoint_scan(e2, "http_security_header_strict_transport_security", "False", long_ago)
 
     assert PlannedScan.objects.all().count() == 0
 
@@ -100,3 +72,12 @@ def test_plan_outdated_scans(db):
     As both scans originate from the same scanner, and have the same underlaying scanner.
     """
     assert PlannedScan.objects.all().count() == 3
+    assert PlannedScan.objects.all().filter(url=u1).count() == 3
+
+    # planning again does not add the same scans again.
+    plan_outdated_scans(published_scan_types)
+    assert PlannedScan.objects.all().count() == 3
+
+    # the overview shows both outdated scans on example.com as a single scan with the security headers scanner.
+    list_outdated(published_scan_types)
+    assert capsys.readouterr().out.count("example.com") == 1
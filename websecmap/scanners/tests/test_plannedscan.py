@@ -16,8 +16,10 @@ from websecmap.scanners.models import (
 )
 from websecmap.scanners.plannedscan import (
     calculate_progress,
+    claim,
     finish_multiple,
     get_latest_progress,
+    mark_picked_up,
     pickup,
     request,
     reset,
@@ -225,3 +227,61 @@ def test_plan_scans(db):
                 "amount": 2,
             }
         ]
+
+
+def test_plannedscan_bulk(db):
+    urls = [create_url(f"example{number}.com") for number in range(0, 600)]
+
+    # urls can be passed as objects or ids, doubles and already requested urls are not requested again.
+    request(scanner="tls_qualys", activity="scan", urls=urls[0:10])
+    request(scanner="tls_qualys", activity="scan", urls=[url.id for url in urls] + urls[0:5])
+    assert PlannedScan.objects.all().filter(state=State["requested"].value).count() == 600
+
+    # a different activity is a different planned scan
+    request(scanner="tls_qualys", activity="discover", urls=urls[0:10])
+    assert PlannedScan.objects.all().count() == 610
+
+    picked_up = pickup(scanner="tls_qualys", activity="scan", amount=550)
+    assert len(picked_up) == 550
+    assert PlannedScan.objects.all().filter(state=State["picked_up"].value).count() == 550
+
+    # picked up urls are not requested again
+    request(scanner="tls_qualys", activity="scan", urls=picked_up)
+    assert PlannedScan.objects.all().count() == 610
+
+    # finishing (via a task) uses url ids, only the picked up scans are finished.
+    finish_multiple(scanner="tls_qualys", activity="scan", urls=[url.id for url in urls])
+    assert PlannedScan.objects.all().filter(state=State["finished"].value).count() == 550
+    assert PlannedScan.objects.all().filter(state=State["requested"].value).count() == 60
+    assert PlannedScan.objects.all().filter(state=State["finished"].value, finished_at_when__isnull=True).count() == 0
+
+
+def test_plannedscan_claim(db, django_assert_num_queries):
+    urls = [create_url(f"example{number}.com") for number in range(0, 10)]
+    request(scanner="tls_qualys", activity="scan", urls=urls)
+
+    first_claim = claim(scanner="tls_qualys", activity="scan", amount=4)
+    second_claim = claim(scanner="tls_qualys", activity="scan", amount=4)
+    assert len(first_claim) == len(second_claim) == 4
+    assert not {scan.id for scan in first_claim} & {scan.id for scan in second_claim}
+
+    # the urls are retrieved with the claimed scans
+    with django_assert_num_queries(0):
+        assert all(scan.url.url.startswith("example") for scan in first_claim + second_claim)
+
+    # when another planner has claimed some of these scans in the meantime, only the rest is claimed.
+    remaining = list(PlannedScan.objects.all().filter(state=State["requested"].value).values_list("id", flat=True))
+    assert len(remaining) == 2
+    assert sorted(mark_picked_up([first_claim[0].id, second_claim[0].id] + remaining)) == sorted(remaining)
+    assert claim(scanner="tls_qualys", activity="scan", amount=4) == []
+
+
+def test_plannedscan_claim_at_the_same_moment(db):
+    urls = [create_url(f"example{number}.com") for number in range(0, 4)]
+    request(scanner="tls_qualys", activity="scan", urls=urls)
+    scan_ids = list(PlannedScan.objects.all().values_list("id", flat=True))
+
+    # planners that pick up scans at the same moment only get the scans they changed themselves.
+    with freeze_time("2020-01-01"):
+        assert sorted(mark_picked_up(scan_ids[0:2])) == sorted(scan_ids[0:2])
+        assert sorted(mark_picked_up(scan_ids)) == sorted(scan_ids[2:4])
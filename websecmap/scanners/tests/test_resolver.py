@@ -0,0 +1,130 @@
+import asyncio
+
+import dns.asyncresolver
+import dns.resolver
+from dns.resolver import NXDOMAIN, NoNameservers
+
+from websecmap.scanners import resolver
+from websecmap.scanners.resolver import NameserverRateLimit, resolve, resolve_all
+
+
+class Record:
+    def __init__(self, text):
+        self.text = text
+
+    def to_text(self):
+        return self.text
+
+
+class Answer(list):
+    def __init__(self, records, ttl):
+        super().__init__(Record(record) for record in records)
+        self.rrset = type("RRset", (), {"ttl": ttl})
+
+
+def fake_dns(monkeypatch, zone=None):
+    queries = []
+    if zone is None:
+        zone = {("example.com", "A"): ["93.184.216.34"], ("broken.example.com", "A"): NoNameservers()}
+
+    def answer(qname, rdtype):
+        queries.append((qname, rdtype))
+        if (qname, rdtype) not in zone:
+            raise NXDOMAIN()
+        if isinstance(zone[(qname, rdtype)], Exception):
+            raise zone[(qname, rdtype)]
+        return Answer(zone[(qname, rdtype)], 300)
+
+    def sync_resolve(self, qname, rdtype, **kwargs):
+        return answer(qname, rdtype)
+
+    async def async_resolve(self, qname, rdtype, **kwargs):
+        await asyncio.sleep(0.01)
+        return answer(qname, rdtype)
+
+    monkeypatch.setattr(dns.resolver.Resolver, "resolve", sync_resolve)
+    monkeypatch.setattr(dns.asyncresolver.Resolver, "resolve", async_resolve)
+    resolver.clear_cache()
+    return queries
+
+
+def test_resolve(monkeypatch):
+    queries = fake_dns(monkeypatch)
+
+    assert resolve("example.com", "A", ["127.0.0.1"]) == ["93.184.216.34"]
+    assert resolve("Example.com.", "A", ["127.0.0.1"]) == ["93.184.216.34"]
+    assert resolve("nonexisting.example.com", "A", ["127.0.0.1"]) is None
+    assert resolve("nonexisting.example.com", "A", ["127.0.0.1"]) is None
+    # failures are not cached
+    assert resolve("broken.example.com", "A", ["127.0.0.1"]) is None
+    assert resolve("broken.example.com", "A", ["127.0.0.1"]) is None
+
+    assert queries == [
+        ("example.com", "A"),
+        ("nonexisting.example.com", "A"),
+        ("broken.example.com", "A"),
+        ("broken.example.com", "A"),
+    ]
+
+    # expired answers are asked again
+    monkeypatch.setattr(resolver, "MAXIMUM_TTL", 0)
+    resolver.clear_cache()
+    resolve("example.com", "A", ["127.0.0.1"])
+    resolve("example.com", "A", ["127.0.0.1"])
+    assert queries[4:] == [("example.com", "A"), ("example.com", "A")]
+
+
+def test_resolve_all(monkeypatch):
+    queries = fake_dns(monkeypatch)
+    monkeypatch.setattr(resolver, "get_nameservers", lambda: ["127.0.0.1"])
+
+    # the same name is only asked once, also when the lookups are performed at the same time.
+    assert resolve_all(["example.com", "example.com", "nonexisting.example.com"], "A") == {
+        "example.com": ["93.184.216.34"],
+        "nonexisting.example.com": None,
+    }
+    assert sorted(queries) == [("example.com", "A"), ("nonexisting.example.com", "A")]
+    assert resolver.in_flight == {}
+
+    # the answers are shared with the synchronous resolver
+    assert resolve("example.com", "A") == ["93.184.216.34"]
+    assert len(queries) == 2
+
+
+def test_nameserver_rate_limit():
+    async def four_queries():
+        rate_limit = NameserverRateLimit(["1.1.1.1", "8.8.8.8"], 20)
+        start = asyncio.get_running_loop().time()
+        nameservers = [await rate_limit.nameservers() for _ in range(4)]
+        return nameservers, asyncio.get_running_loop().time() - start
+
+    nameservers, duration = asyncio.run(four_queries())
+    assert nameservers == [
+        ["1.1.1.1", "8.8.8.8"],
+        ["8.8.8.8", "1.1.1.1"],
+        ["1.1.1.1", "8.8.8.8"],
+        ["8.8.8.8", "1.1.1.1"],
+    ]
+    # the second query to the same nameserver waits for 1/20th of a second.
+    assert duration >= 0.05
+
+
+def test_unavailable_redis_cache(monkeypatch, settings):
+    queries = fake_dns(monkeypatch)
+    monkeypatch.setattr(resolver, "get_nameservers", lambda: ["127.0.0.1"])
+
+    # nothing listens on this port.
+    settings.DNS_CACHE_REDIS_URL = "redis://127.0.0.1:1/0"
+    monkeypatch.setattr(resolver, "redis_connection", None)
+    monkeypatch.setattr(resolver, "redis_unavailable_until", 0.0)
+
+    assert resolve_all(["example.com", "nonexisting.example.com"], "A") == {
+        "example.com": ["93.184.216.34"],
+        "nonexisting.example.com": None,
+    }
+    assert len(queries) == 2
+
+    # redis is not used for a while, answers are still cached in process.
+    assert resolver.get_redis() is None
+    assert resolve("example.com", "A") == ["93.184.216.34"]
+    assert len(queries) == 2
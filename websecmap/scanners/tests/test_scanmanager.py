@@ -0,0 +1,60 @@
+from websecmap.scanners.models import EndpointGenericScan, UrlGenericScan
+from websecmap.scanners.scanmanager import store_endpoint_scan_results, store_url_scan_result
+from websecmap.scanners.tests.test_plannedscan import create_endpoint, create_url
+
+
+def test_store_endpoint_scan_results(db, django_assert_num_queries, without_scan_receivers):
+    url = create_url("example.com")
+    first_endpoint = create_endpoint(url, 4, "https", 443)
+    second_endpoint = create_endpoint(url, 4, "http", 80)
+
+    store_endpoint_scan_results(
+        [
+            ("http_security_header_x_frame_options", first_endpoint.id, "True", "DENY"),
+            ("http_security_header_x_frame_options", second_endpoint.id, "False", "Security Header not present"),
+            ("http_security_header_x_content_type_options", first_endpoint.id, "True", "nosniff", "evidence"),
+        ]
+    )
+    assert EndpointGenericScan.objects.all().count() == 3
+    assert EndpointGenericScan.objects.all().filter(is_the_latest_scan=True).count() == 3
+    assert EndpointGenericScan.objects.all().get(type="http_security_header_x_content_type_options").evidence == (
+        "evidence"
+    )
+
+    # retrieving the latest scans, touching, flagging and inserting, plus a savepoint for the transaction.
+    with django_assert_num_queries(6):
+        store_endpoint_scan_results(
+            [
+                # the same: only last_scan_moment is updated.
+                ("http_security_header_x_frame_options", first_endpoint.id, "True", "DENY"),
+                # changed: a new latest scan.
+                ("http_security_header_x_frame_options", second_endpoint.id, "True", "SAMEORIGIN"),
+                # changed twice in the same batch, the last one is the latest.
+                ("http_security_header_x_content_type_options", first_endpoint.id, "False", "Not present"),
+                ("http_security_header_x_content_type_options", first_endpoint.id, True, "nosniff"),
+                # the same as the result before it in this batch.
+                ("http_security_header_x_content_type_options", first_endpoint.id, "True", "nosniff"),
+            ]
+        )
+
+    assert EndpointGenericScan.objects.all().count() == 6
+    latest = EndpointGenericScan.objects.all().filter(is_the_latest_scan=True)
+    assert sorted((scan.type, scan.endpoint_id, scan.rating, scan.explanation) for scan in latest) == [
+        ("http_security_header_x_content_type_options", first_endpoint.id, "True", "nosniff"),
+        ("http_security_header_x_frame_options", first_endpoint.id, "True", "DENY"),
+        ("http_security_header_x_frame_options", second_endpoint.id, "True", "SAMEORIGIN"),
+    ]
+
+
+def test_store_url_scan_result(db):
+    url = create_url("example.com")
+
+    store_url_scan_result("DNSSEC", url.id, "ERROR", "Something went wrong.")
+    first_scan = UrlGenericScan.objects.all().get()
+
+    store_url_scan_result("DNSSEC", url.id, "ERROR", "Something went wrong.")
+    assert UrlGenericScan.objects.all().get().last_scan_moment > first_scan.last_scan_moment
+
+    store_url_scan_result("DNSSEC", url.id, "OK", "All good.")
+    assert UrlGenericScan.objects.all().count() == 2
+    assert UrlGenericScan.objects.all().get(is_the_latest_scan=True).rating == "OK"
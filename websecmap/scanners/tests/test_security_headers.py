@@ -1,9 +1,15 @@
 """Integration tests of scanner commands."""
 
 import json
+from datetime import datetime
 
+import pytz
 from django.core.management import call_command
 
+from websecmap.scanners.models import EndpointGenericScan
+from websecmap.scanners.scanner.security_headers import analyze_headers_batch
+from websecmap.scanners.tests.test_plannedscan import create_endpoint, create_endpoint_scan, create_url
+
 SECURITY_HEADERS = {
     "X-XSS-Protection": "1",
 }
@@ -50,3 +56,47 @@ def test_security_headers_failure(responses, db, faaloniae):
     result = json.loads(call_command("scan", "headers", "-v3", "-o", TEST_ORGANIZATION))
     print(result)
     assert result[0] is None
+
+
+def test_analyze_headers_batch(db, django_assert_num_queries, without_scan_receivers):
+    url = create_url("example.com")
+    https = create_endpoint(url, 4, "https", 443)
+    http = create_endpoint(url, 4, "http", 80)
+    # this url offers no insecure http service, so a missing HSTS header gets a different explanation.
+    secure_only = create_endpoint(create_url("example.nl"), 4, "https", 443)
+    soap = create_endpoint(create_url("example.org"), 4, "https", 443)
+    create_endpoint_scan(soap, "http_security_header_x_frame_options", "True", datetime(2020, 1, 1, tzinfo=pytz.utc))
+
+    # endpoints, existing scans and insecure urls. Then storing: latest scans, flagging, inserting and a savepoint.
+    with django_assert_num_queries(8):
+        analyze_headers_batch(
+            [
+                (https.pk, {"Content-Type": "text/html", "X-Content-Type-Options": "nosniff", **SECURITY_HEADERS}),
+                (http.pk, {"Content-Type": "text/html", "Content-Security-Policy": "frame-ancestors 'self'"}),
+                (secure_only.pk, {"Content-Type": "text/html", "Strict-Transport-Security": "max-age=31536000"}),
+                (soap.pk, {"X-SOAP-Enabled": "1"}),
+            ]
+        )
+
+    def latest(endpoint):
+        scans = EndpointGenericScan.objects.all().filter(endpoint=endpoint, is_the_latest_scan=True)
+        return {scan.type.replace("http_security_header_", ""): scan.rating for scan in scans}
+
+    assert latest(https) == {
+        "x_xss_protection": "True",
+        "x_frame_options": "False",
+        "x_content_type_options": "True",
+        "strict_transport_security": "False",
+    }
+    assert latest(http) == {
+        "x_xss_protection": "Using CSP",
+        "x_frame_options": "Using CSP",
+        "x_content_type_options": "False",
+    }
+    assert latest(secure_only)["strict_transport_security"] == "True"
+    assert latest(soap) == {"x_frame_options": "SOAP"}
+
+    # headers that could not be retrieved make the existing scans unreachable.
+    analyze_headers_batch([(https.pk, False), (http.pk, False)])
+    assert set(latest(https).values()) == {"Unreachable"}
+    assert set(latest(http).values()) == {"Unreachable"}
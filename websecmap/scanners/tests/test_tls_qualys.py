@@ -1,5 +1,8 @@
+from collections import defaultdict
+
 from websecmap.scanners.models import Endpoint, EndpointGenericScan
-from websecmap.scanners.scanner.tls_qualys import save_scan
+from websecmap.scanners.scanner import tls_qualys
+from websecmap.scanners.scanner.tls_qualys import QualysScheduler, save_scan
 from websecmap.scanners.tests.test_plannedscan import create_url
 
 
@@ -68,3 +71,85 @@ def test_qualys_save_data(db):
         scan_results.append(scan.rating)
 
     assert sorted(scan_results) == sorted(["B", "trusted", "scan_error", "scan_error"])
+
+
+def test_qualys_scheduler(monkeypatch):
+    clock = {"now": 0.0}
+    monkeypatch.setattr(tls_qualys, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(tls_qualys, "sleep", lambda seconds: clock.update(now=clock["now"] + seconds))
+
+    # room for two assessments at the same time.
+    monkeypatch.setattr(tls_qualys, "service_provider_status", lambda proxy: capacity(7))
+
+    def capacity(max_assessments):
+        return {"max": max_assessments, "current": 0, "this-client-max": 25}
+
+    polls = []
+    progress = defaultdict(int)
+    finished = []
+    full_capacity = {"message": "Running at full capacity. Please try again later."}
+
+    def scan(proxy, url):
+        polls.append((clock["now"], url))
+        if url == "busy.example" and len(polls) == 1:
+            return {**capacity(7), "data": {"status": "FAILURE", "errors": [full_capacity]}}
+        # an assessment is ready on the third poll.
+        progress[url] += 1
+        status = "READY" if progress[url] == 3 else "IN_PROGRESS"
+        return {**capacity(7), "data": {"status": status, "endpoints": []}}
+
+    monkeypatch.setattr(tls_qualys, "service_provider_scan_via_api_with_limits", scan)
+    monkeypatch.setattr(tls_qualys.scratch, "apply_async", lambda args: None)
+    monkeypatch.setattr(tls_qualys.process_qualys_result, "apply_async", lambda args: finished.append(args[1]))
+
+    QualysScheduler({"id": 1}, ["busy.example", "example.com", "example.nl"]).run()
+
+    assert sorted(finished) == ["busy.example", "example.com", "example.nl"]
+
+    # Qualys is at full capacity: new assessments are started after the error interval. The domain that could not be
+    # started keeps its place in line.
+    assert polls[:3] == [
+        (0.0, "busy.example"),
+        (tls_qualys.ERROR_INTERVAL, "busy.example"),
+        (tls_qualys.ERROR_INTERVAL + tls_qualys.NEW_ASSESSMENT_COOL_OFF, "example.com"),
+    ]
+
+    # the third domain is started as soon as the first assessment is finished, not after a fixed delay.
+    first_finished = tls_qualys.ERROR_INTERVAL + 2 * tls_qualys.POLL_INTERVAL
+    assert polls[3:6] == [
+        (tls_qualys.ERROR_INTERVAL + tls_qualys.POLL_INTERVAL, "busy.example"),
+        (tls_qualys.ERROR_INTERVAL + tls_qualys.NEW_ASSESSMENT_COOL_OFF + tls_qualys.POLL_INTERVAL, "example.com"),
+        (first_finished, "busy.example"),
+    ]
+    assert polls[6] == (first_finished, "example.nl")
+
+
+def test_qualys_scheduler_unexpected_responses(monkeypatch):
+    clock = {"now": 0.0}
+    monkeypatch.setattr(tls_qualys, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(tls_qualys, "sleep", lambda seconds: clock.update(now=clock["now"] + seconds))
+    monkeypatch.setattr(
+        tls_qualys, "service_provider_status", lambda proxy: {"max": 25, "current": 0, "this-client-max": 25}
+    )
+
+    polls = defaultdict(int)
+    finished = []
+
+    def scan(proxy, url):
+        polls[url] += 1
+        if url == "empty.example":
+            return {"max": 25, "current": 0, "this-client-max": 25, "data": {}}
+        if url == "html.example" and polls[url] == 1:
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")
+        return {"max": 25, "current": 0, "this-client-max": 25, "data": {"status": "READY", "endpoints": []}}
+
+    monkeypatch.setattr(tls_qualys, "service_provider_scan_via_api_with_limits", scan)
+    monkeypatch.setattr(tls_qualys.scratch, "apply_async", lambda args: None)
+    monkeypatch.setattr(tls_qualys.process_qualys_result, "apply_async", lambda args: finished.append(args[1]))
+
+    QualysScheduler({"id": 1}, ["empty.example", "html.example", "example.com"]).run()
+
+    # responses without a status are retried until the domain is given up, the other domains still finish.
+    assert sorted(finished) == ["example.com", "html.example"]
+    assert polls["empty.example"] == tls_qualys.MAX_ERRORS_PER_DOMAIN
+    assert polls["html.example"] == 2
@@ -94,7 +94,7 @@ INSTALLED_APPS = [
     "websecmap.scanners",
     "websecmap.reporting",
     "websecmap.map",
-    "websecmap.game",
+    "websecmap.game.apps.GameConfig",  # because some signals need this.
     "websecmap.api",
     "django_countries",
     "django.contrib.admindocs",
@@ -634,6 +634,10 @@ SENTRY_PROJECT_URL = "https://sentry.io/%s/%s" % (SENTRY_ORGANIZATION, SENTRY_PR
 NETWORK_SUPPORTS_IPV4 = os.environ.get("NETWORK_SUPPORTS_IPV4", True)
 NETWORK_SUPPORTS_IPV6 = os.environ.get("NETWORK_SUPPORTS_IPV6", False)
 
+# Scanners cache DNS answers in the worker process. When a redis url is set, for example redis://localhost:6379/1,
+# this cache is shared between all workers. Leave empty to only cache per process.
+DNS_CACHE_REDIS_URL = os.environ.get("DNS_CACHE_REDIS_URL", "")
+
 # atomic imports: fail completely, not half
 IMPORT_EXPORT_USE_TRANSACTIONS = True
 